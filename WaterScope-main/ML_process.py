@@ -1,38 +1,97 @@
+'''
+Local job server for the colony analysis.
+
+Clients connect to the unix socket and send one JSON object per line:
+    {"action": "submit", "image": "<path>.jpg"}   -> {"id": ..., "status": "queued", ...}
+    {"action": "status", "id": "<job id>"}         -> current job snapshot
+Every job submitted over a connection is pushed back on that connection as soon as it
+finishes ({"status": "done", "result": {...}} or {"status": "failed", "error": ...}),
+so nothing has to poll the SD card for result files.
+'''
+
 import sys
 sys.path.append("/home/pi/.local/lib/python3.7/site-packages")
+import os
+import json
+import socket
+import socketserver
+import threading
 import time
 
-def analysis_image(input_filename):
-    start = time.time()
-    result = count_colony_yolor.analysis_image(input_filename, input_filename.replace('.jpg', '_result.jpg'))
-    print(result)
-    print("time it tooks: {}".format(time.time() - start))
+import analysis_worker
 
+# Settings
+socket_path = 'ml_process.sock'
 
-if __name__ == "__main__":
-    # wipe up the file for the first time
-    with open('image_to_analyse.txt', 'w+') as file:
-        pass
-        
-    start = time.time()
-    print("loading the ML module, please wait")
-    import count_colony_yolor
-    print("imported the ML module")
-    print("time it tooks: {}".format(time.time() - start))
+
+class JobHandler(socketserver.StreamRequestHandler):
+
+    def setup(self):
+        super(JobHandler, self).setup()
+        self.send_lock = threading.Lock()
+
+    def send(self, message):
+        data = (json.dumps(message) + '\n').encode()
+        with self.send_lock:
+            try:
+                self.wfile.write(data)
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError, ValueError):
+                pass
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+            except ValueError:
+                self.send({'status': 'invalid', 'error': 'not json'})
+                continue
+
+            action = request.get('action', 'submit')
+            if action == 'submit' and request.get('image'):
+                print("incoming image! Processing it! {}".format(request['image']))
+                job = analysis_worker.submit(request['image'], request.get('result'),
+                                             callback=lambda job: self.send(job.to_dict()))
+                self.send(job.to_dict())
+            elif action == 'status':
+                job = analysis_worker.get_job(request.get('id'))
+                if job is None:
+                    self.send({'id': request.get('id'), 'status': 'unknown'})
+                else:
+                    self.send(job.to_dict())
+            else:
+                self.send({'status': 'invalid', 'error': 'unknown request'})
+
+
+def serve(path=socket_path):
+    if os.path.exists(path):
+        os.remove(path)
+    server = socketserver.ThreadingUnixStreamServer(path, JobHandler)
+    server.daemon_threads = True
     print("waiting for incoming image to process....")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(path)
+
 
-    while True:
-        with open('image_to_analyse.txt', 'r') as file:
-            all_image_to_analyse = file.readlines()
-            # print(all_image_to_analyse)
-
-        with open('image_to_analyse.txt', 'w') as file:
-            if len(all_image_to_analyse) > 0:
-                print("incoming image! Processing it!")
-                file.writelines(all_image_to_analyse[1:])
-                analysis_image(all_image_to_analyse[0])
-                print("processed {}".format(all_image_to_analyse[0]))
-                print("waiting for incoming image to process....")
-            
-            time.sleep(1)
+def analysis_image(input_filename, path=socket_path, timeout=None):
+    ''' submit an image to a running ML_process and block until its result is pushed back '''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(path)
+        client.sendall((json.dumps({'action': 'submit', 'image': input_filename}) + '\n').encode())
+        with client.makefile('r') as stream:
+            for line in stream:
+                job = json.loads(line)
+                if job['status'] not in ('queued', 'running'):
+                    return job
 
+
+if __name__ == "__main__":
+    start = time.time()
+    worker = analysis_worker.start()
+    worker.ready.wait()
+    print("time it tooks: {}".format(time.time() - start))
+    serve()
@@ -0,0 +1,183 @@
+import sys
+
+sys.path.append("/home/pi/.local/lib/python3.7/site-packages")
+import threading
+import queue
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future
+
+# number of finished jobs kept around for status queries
+job_history = 50
+
+
+class AnalysisJob(Future):
+    ''' A queued analysis request. It is a Future, so callers can block on result() or
+    attach callbacks, and it carries an id and timestamps for status reporting. '''
+
+    def __init__(self, img_name, result_name, kwargs):
+        super(AnalysisJob, self).__init__()
+        self.id = uuid.uuid4().hex[:12]
+        self.img_name = img_name
+        self.result_name = result_name
+        self.kwargs = kwargs
+        self.queued_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def status(self):
+        if self.cancelled():
+            return 'cancelled'
+        if not self.done():
+            return 'running' if self.running() else 'queued'
+        return 'failed' if self.exception() is not None else 'done'
+
+    def to_dict(self):
+        ''' JSON friendly snapshot of the job '''
+        status = self.status
+        return {
+            'id': self.id,
+            'image': self.img_name,
+            'result_image': self.result_name,
+            'status': status,
+            'result': self.result() if status == 'done' else None,
+            'error': str(self.exception()) if status == 'failed' else None,
+            'queued_at': self.queued_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+
+class AnalysisWorker(threading.Thread):
+    ''' Long-lived colony analysis thread.
+
+    The YOLOR and TFLite models are loaded once when the thread starts (importing
+    count_colony_yolor builds them), so every job afterwards only pays for cropping
+    and inference. Jobs are queued with submit() and their result is delivered
+    through an AnalysisJob (a concurrent.futures.Future). Listeners registered
+    with add_listener() are notified whenever a job finishes.
+    '''
+
+    def __init__(self, warm_up=True):
+        super(AnalysisWorker, self).__init__(name='analysis_worker', daemon=True)
+        self.jobs = queue.Queue()
+        self.ready = threading.Event()
+        self.warm_up = warm_up
+        self.load_time = None
+        self.load_error = None
+        self.history = OrderedDict()
+        self.history_lock = threading.Lock()
+        self.listeners = []
+
+    def run(self):
+        start = time.time()
+        print("loading the ML module, please wait")
+        try:
+            import count_colony_yolor
+            if self.warm_up:
+                count_colony_yolor.warm_up()
+        except BaseException as e:
+            # keep the worker alive so queued jobs fail instead of hanging forever
+            self.load_error = e
+            traceback.print_exc()
+        self.load_time = time.time() - start
+        print("imported the ML module")
+        print("time it tooks: {}".format(self.load_time))
+        self.ready.set()
+
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            if not job.set_running_or_notify_cancel():
+                continue
+            job.started_at = time.time()
+            if self.load_error is not None:
+                job.finished_at = job.started_at
+                job.set_exception(self.load_error)
+                continue
+
+            try:
+                result = count_colony_yolor.analysis_image(job.img_name, job.result_name, **job.kwargs)
+            except BaseException as e:
+                traceback.print_exc()
+                job.finished_at = time.time()
+                job.set_exception(e)
+            else:
+                job.finished_at = time.time()
+                print(result)
+                print("time it tooks: {}".format(job.finished_at - job.started_at))
+                job.set_result(result)
+
+    def submit(self, img_name, result_name=None, callback=None, **kwargs):
+        ''' Queue an image for analysis and return its AnalysisJob, whose result() is the
+        analysis_image() dictionary
+
+        :param img_name: path of the captured image
+        :param result_name: path of the annotated result image, defaults to <img_name>_result.jpg
+        :param callback: optional callable, called with the finished job
+        :param kwargs: passed on to count_colony_yolor.analysis_image
+        '''
+        img_name = img_name.strip()
+        if result_name is None:
+            result_name = img_name.replace('.jpg', '_result.jpg')
+
+        job = AnalysisJob(img_name, result_name, kwargs)
+        with self.history_lock:
+            self.history[job.id] = job
+            while len(self.history) > job_history and next(iter(self.history.values())).done():
+                self.history.popitem(last=False)
+        job.add_done_callback(self._notify)
+        if callback is not None:
+            job.add_done_callback(callback)
+        self.jobs.put(job)
+        return job
+
+    def get_job(self, job_id):
+        ''' return a queued, running or recently finished job by id, None if unknown '''
+        with self.history_lock:
+            return self.history.get(job_id)
+
+    def add_listener(self, listener):
+        ''' call listener(job) every time a job finishes '''
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def _notify(self, job):
+        for listener in list(self.listeners):
+            try:
+                listener(job)
+            except Exception:
+                traceback.print_exc()
+
+    def stop(self):
+        self.jobs.put(None)
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def start(warm_up=True):
+    ''' start the shared analysis worker (only once) and return it '''
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = AnalysisWorker(warm_up=warm_up)
+            _worker.start()
+    return _worker
+
+
+def submit(img_name, result_name=None, callback=None, **kwargs):
+    ''' submit a job to the shared analysis worker, starting it if needed '''
+    return start().submit(img_name, result_name, callback=callback, **kwargs)
+
+
+def get_job(job_id):
+    return start().get_job(job_id)
@@ -36,6 +36,16 @@ from PIL import Image, ImageDraw, ImageFont
 
 import sys
 import threading
+import asyncio
+import analysis_worker
+import focus_search
+from bluetooth_protocol import ProtocolError, payload_validation
+from device_server import DeviceServer
+from file_transfer import chunk_hashes, TransferMeter, TransferAborted, send_parts, negotiate_window, calculate_progress
+import focus_metrics
+import image_encoder
+from focus_history import FocusHistory
+from update_receiver import UpdateManifest, receive_update, update_path
 
 #import thread
 from ctypes import *
@@ -63,8 +73,17 @@ rawCapture = PiRGBArray(camera, size=(640, 480))
 camera.awb_mode = 'off'
 ROI = []
 focus_box_ratio = 0.2
+# sharpness metric of the focus sweep, see focus_metrics.py
+focus_metric = 'laplacian'
+focus_downsample = 1
+# blank plate thresholds, 10 (focus search) and 20 (defogging sweep) on the original BGR float64 Laplacian,
+# rescaled to 'laplacian' on the full resolution ROI. Other metrics or downsampling need their own factor,
+# see focus_metrics.legacy_ratio
+blank_focus_score = 10 * focus_metrics.legacy_laplacian_scale
+blank_defog_score = 20 * focus_metrics.legacy_laplacian_scale
+# focus positions of the last captures, centres the focus search and replaces reading database.csv
+focus_history = FocusHistory().load()
 stream_resolution = (824, 616)
-outstanding_data = None
 
 print(camera.awb_gains)
 
@@ -104,7 +123,7 @@ def autofocus():
 def define_ROI(box_ratio):
         # do some modification
         # the opencv size is (y,x)
-        global image,ROI
+        global image,ROI,roi_box
         image_y, image_x = image.shape[:2]
 
         # a square from the centre of image
@@ -113,16 +132,7 @@ def define_ROI(box_ratio):
             'x1': int(image_x/2-box_size/2), 'y1':int(image_y/2-box_size/2), 
             'x2': int(image_x/2+box_size/2), 'y2':int(image_y/2+box_size/2)}
         
-        # the rectangle affects the laplacian, draw it outside the ROI
-        # draw the rectangle
-        cv2.rectangle(
-            image, 
-            pt1=(roi_box['x1']-5, roi_box['y1']-5),
-            pt2=(roi_box['x2']+5, roi_box['y2']+5), 
-            color=(0,0,255),
-            thickness=2)
-        
-        # crop the image
+        # crop the image, the box is only drawn for previews (focus_metrics.draw_focus)
         ROI = image[roi_box['y1']: roi_box['y2'], roi_box['x1']:roi_box['x2']]
 def defogging(connection='',sample_ID='', sample_comment=''):
     """ Heats the cartridge to reduce condensation buildup 
@@ -148,7 +158,8 @@ def defogging(connection='',sample_ID='', sample_comment=''):
 
             
         # Check if database either doesn't exist, or has less than 10 entries
-        if not os.path.exists("database.csv") or sum(1 for line in open('database.csv')) < 11:
+        # (or too few focus positions to average, e.g. database.csv rows without a focus)
+        if focus_history.total < 10 or len(focus_history) < focus_history.min_samples:
             # In this case, this is the first 10 times this system has been used
             # We should therefore use a regular 90 s defogging cycle
             time.sleep(30)
@@ -176,8 +187,7 @@ def defogging(connection='',sample_ID='', sample_comment=''):
             
 
             # Load current average system focus
-            df = pd.read_csv('database.csv')
-            focus_sys_avg = np.mean(df["focus"].tail(10))
+            focus_sys_avg = focus_history.mean()
             
             # Define delta, (max focus deviation)
             delta = 45
@@ -226,9 +236,9 @@ def defogging(connection='',sample_ID='', sample_comment=''):
                         #continue
 
                     # Check focus score magnitude is valid
-                    # If score over all positions < 20
+                    # If score over all positions < blank_defog_score
                     # Then v. likely to be no fog + no features on filter
-                    if np.max(fs) < 20:
+                    if np.max(fs) < blank_defog_score:
                         print('Defogging complete after %i s - no features' %t)
                         with open(log_name, "a") as myfile:
                             myfile.write("Defogging finished at "+datetime.now().strftime("%m/%d/%Y %H:%M:%S")+"\n")
@@ -276,19 +286,9 @@ def variance_of_laplacian():
             ''' focus calculation ''' 
             global image, ROI
             
-            # compute the Laplacian of the image and then return the focus
-            # measure, which is simply the variance of the Laplacian
-            focus_value = cv2.Laplacian(ROI, cv2.CV_64F).var()
-            #print(focus_value)
-            focus_text = 'f: {:.2f}'.format(focus_value)#
-            
-            # CV font
-            font = cv2.FONT_HERSHEY_DUPLEX
-            cv2.putText(
-                image, focus_text,
-                (int(image.shape[0]*0.1), int(image.shape[1]*0.1)), 
-                font, 2, (0, 0, 255))
-            return focus_value
+            # grayscale float32 ROI scored with focus_metric (the variance of the Laplacian by default),
+            # nothing is drawn on the frame
+            return focus_metrics.focus_score(ROI, focus_metric, focus_downsample)
             
             
 def extract_roi(image, x, y, width, height):
@@ -341,9 +341,9 @@ def Chlorine_analysis(filename):
     # Draw the bounding box around the ROI
     draw.rectangle([x, y, x + width, y + height], outline="red", width=3)
     
-    # Save the modified image
+    # Save the modified image, encoded in the background from the annotated frame
     new_filename = filename.replace('.jpg', '_result.jpg')
-    image.save(new_filename, quality=40, optimize=True)
+    image_encoder.submit(cv2.cvtColor(np.asarray(image), cv2.COLOR_RGB2BGR), {new_filename: {'quality': 40}})
     print("Chlorine level")
     print(cl)
     
@@ -362,6 +362,7 @@ def analysis_result():
     result_db = {}
     flagged = 0
     chlorine_level = 0.0
+    ml_result = None
     with open(log_name, "a") as myfile:
        # now = datetime.now() # current date and time
         myfile.write("Sample ID: "+str(sample_ID)+" at "+datetime.now().strftime("%m/%d/%Y %H:%M:%S")+"\n")
@@ -385,8 +386,8 @@ def analysis_result():
             myfile.close()
         try:
             if(chlorine==0):
-                ML_analysis(filename)
                 print("Running ML")
+                ml_result = ML_analysis(filename)
             else:
                 chlorine_level = Chlorine_analysis(filename)
                 print("Running Chlorine")
@@ -403,67 +404,60 @@ def analysis_result():
             time.sleep(2)
             uart.send_serial('incubator_37')
     if(chlorine==0):
-    
-        while True:
-    
-        # keep checking whether result it out
-            if os.path.exists(filename.replace('.jpg', '_result.txt')):
-                with open(log_name, "a") as myfile:
-                    # now = datetime.now() # current date and time
-                    myfile.write("ML completed at " + datetime.now().strftime("%m/%d/%Y %H:%M:%S") + "\n")
-                    myfile.close()
-                args.preview = filename.replace('.jpg', '_result.jpg')
-
-                with open(filename.replace('.jpg', '_result.txt')) as file:
-                    lines = file.readlines()
-                    result_db["unet_eco"] = re.findall("\d+", lines[0])[0]
-                    result_db["unet_col"] = re.findall("\d+", lines[1])[0]
-                    result_db["yolo_eco"] = re.findall("\d+", lines[2])[0]
-                    result_db["yolo_col"] = re.findall("\d+", lines[3])[0]
-                    result_db["flag_string"] = lines[4].strip()
-                    result_db["uploaded"] = 'no'
-
-                    ecoli_count = lines[5].split()[-1]
-                    coliform_count = lines[6].split()[-1]
-                    result['coliforms'] = coliform_count
-                    result['E.coli'] = ecoli_count
-                    flag_string = lines[4].split()[0]
-                    print(flag_string)
-                    if new_sample == 1:
-                        flagged = 0
-                        result['coliforms'] = 0
-                        result['E.coli'] = 0
-                        flag_string = 'new'
-                    if (flag_string == 'anomalous' or flag_string == 'too_many' or flag_string == 'Result uncertain' or flag_string =='overgrown/smeared'):
-                        #send_serial('LED_RGB=100,0,0')
-                        flagged = 1
-                        if flag_string == 'overgrown/smeared':
-                            flag_string = 'overgrown'
-                            #result['coliforms'] = 250
-                            #result['E.coli'] = 250
-                        flag_message = 'Sample ' + flag_string
-                        if flag_string == 'Result uncertain':
-                            flag_message = 'Result uncertain'
-
-                    break
-
-            else:
-                if new_sample == 1:
-                    flagged = 0
-                    result['coliforms'] = 0
-                    result['E.coli'] = 0
-                    flag_string = 'new'
-
-                    result_db["unet_eco"] = 0
-                    result_db["unet_col"] = 0
-                    result_db["yolo_eco"] = 0
-                    result_db["yolo_col"] = 0
-                    result_db["flag_string"] = 'new sample'
-                    result_db["uploaded"] = 'no'
-                    # new_im.save(filename.replace('.jpg', '_resized_preview.jpg'),quality=10, optimize=False)
-                    
-                    break
-            time.sleep(2)
+        if new_sample == 1:
+            flagged = 0
+            result['coliforms'] = 0
+            result['E.coli'] = 0
+            flag_string = 'new'
+
+            result_db["unet_eco"] = 0
+            result_db["unet_col"] = 0
+            result_db["yolo_eco"] = 0
+            result_db["yolo_col"] = 0
+            result_db["flag_string"] = 'new sample'
+            result_db["uploaded"] = 'no'
+        elif ml_result is None:
+            # the analysis raised, report it instead of waiting for a result that never comes
+            flagged = 1
+            flag_message = 'Analysis failed'
+            result['coliforms'] = 0
+            result['E.coli'] = 0
+            result_db["unet_eco"] = 0
+            result_db["unet_col"] = 0
+            result_db["yolo_eco"] = 0
+            result_db["yolo_col"] = 0
+            result_db["flag_string"] = 'analysis failed'
+            result_db["uploaded"] = 'no'
+        else:
+            with open(log_name, "a") as myfile:
+                # now = datetime.now() # current date and time
+                myfile.write("ML completed at " + datetime.now().strftime("%m/%d/%Y %H:%M:%S") + "\n")
+                myfile.close()
+            args.preview = filename.replace('.jpg', '_result.jpg')
+
+            ecoli_count = ml_result['e.coli']
+            coliform_count = ml_result['coliform']
+            flag_string = ml_result['flag']
+            result_db["unet_eco"] = 0
+            result_db["unet_col"] = 0
+            result_db["yolo_eco"] = ecoli_count
+            result_db["yolo_col"] = coliform_count
+            result_db["flag_string"] = flag_string
+            result_db["uploaded"] = 'no'
+
+            result['coliforms'] = coliform_count
+            result['E.coli'] = ecoli_count
+            print(flag_string)
+            if (flag_string == 'anomalous' or flag_string == 'too_many' or flag_string == 'Result uncertain' or flag_string =='overgrown/smeared'):
+                #send_serial('LED_RGB=100,0,0')
+                flagged = 1
+                if flag_string == 'overgrown/smeared':
+                    flag_string = 'overgrown'
+                    #result['coliforms'] = 250
+                    #result['E.coli'] = 250
+                flag_message = 'Sample ' + flag_string
+                if flag_string == 'Result uncertain':
+                    flag_message = 'Result uncertain'
     else:
                 args.preview = filename.replace('.jpg', '_result.jpg')
                 flagged = 0
@@ -551,64 +545,45 @@ def capture_image(resolution='high_res'):
             camera.shutter_speed = 11000
         else:
             camera.shutter_speed = config['shutter_speed']
-        i = 900
-        arducam_vcm.vcm_write(i)
-        time.sleep(0.2)
-        focus_table = {}
-        for frame in camera.capture_continuous(rawCapture, format="bgr", use_video_port=True):
-           # print("in the loop")
+        frames = camera.capture_continuous(rawCapture, format="bgr", use_video_port=True)
+
+        def measure_focus():
+            # score the next frame of the stream
+            global image
+            frame = next(frames)
             image = frame.array
             define_ROI(focus_box_ratio)
             focus = variance_of_laplacian()
-            # show the frame
-           # cv2.imshow("stream", image)
-            print(str(i) + ',' + str(focus))
-            
-            if(i<1000):
-                i=i+5
-                arducam_vcm.vcm_write(i)
-            focus_table.update({i:focus})
-            key = cv2.waitKey(1) & 0xFF
-            
-
             # clear the stream in preparation for the next frame
             rawCapture.truncate(0)
-            image = 0
-
-            # if the `q` key was pressed, break from the loop
-            if(i==1000):
-                i = 1000
-                optimal_focus_z = max(focus_table, key=focus_table.get) 
-                
-                # Double check focus score is in valid range:
-                max_score = focus_table[optimal_focus_z]
-                if max_score <10:
-                    # Very little to focus on, likely blank
-                    # Likely focused in wrong position
-                    # use average position
-                    print("No features to focus on - using average position")
-                    try: # In the case that the database is big enough
-                        df = pd.read_csv('database.csv')
-                        optimal_focus_z = np.mean(df["focus"].tail(10))
-                        optimal_focus_z = int(optimal_focus_z - optimal_focus_z%5)
-                        
-                    except: # for new systems, use global average
-                        optimal_focus_z = 1000
-                    
-                print("Optimal focus " + str(optimal_focus_z))
-                focus = optimal_focus_z
-                
-                arducam_vcm.vcm_write(optimal_focus_z)
-                time.sleep(3)
-                
-                print("Optimal focus: ")
-                image = frame.array
-                define_ROI(focus_box_ratio)
-                focus = variance_of_laplacian()
-                #define_ROI(focus_box_ratio)
-                #test = variance_of_laplacian()
-                #arducam_vcm.vcm_write(530)
-                break
+            return focus
+
+        # coarse-to-fine search with early stopping around the focus of the last captures,
+        # the settle times come from config_picamera.yaml
+        z_min, z_max = focus_history.window()
+        search = focus_search.from_config(config, arducam_vcm.vcm_write, measure_focus, z_min=z_min, z_max=z_max)
+        optimal_focus_z, max_score = search.run()
+        focus_table = search.table
+
+        # Double check focus score is in valid range:
+        if max_score < blank_focus_score:
+            # Very little to focus on, likely blank
+            # Likely focused in wrong position
+            # use average position
+            print("No features to focus on - using average position")
+            if len(focus_history) > 0: # In the case that there is a focus history
+                optimal_focus_z = focus_history.mean()
+                optimal_focus_z = int(optimal_focus_z - optimal_focus_z%5)
+
+            else: # for new systems, use global average
+                optimal_focus_z = 1000
+            arducam_vcm.vcm_write(optimal_focus_z)
+            time.sleep(search.final_settle_time)
+
+        print("Optimal focus " + str(optimal_focus_z))
+        focus_history.add(optimal_focus_z)
+        focus = measure_focus()
+        frames.close()
        # print(focus_table)
         #with open('focus_table.txt') as table_log:
          #   table_log.write(focus_table)
@@ -631,15 +606,19 @@ def capture_image(resolution='high_res'):
         camera.capture(filename, format = 'jpeg', quality=100, bayer = False)
         #camera.capture(filename)
         image_seq+=1
-        image = Image.open(filename)
+        # the preview and the compressed copy are encoded in the background, the analysis reads the
+        # capture itself and send_file_response waits for them
+        start = time.time()
+        outputs = {}
         if(new_sample==1):
-            image.save(filename.replace('.jpg', '_preview.jpg'),quality=40,optimize=True)
-            time.sleep(0.5)
+            outputs[filename.replace('.jpg', '_preview.jpg')] = {'target_size': image_encoder.preview_target_size}
             args.preview = filename.replace('.jpg', '_preview.jpg')
         if(chlorine==1):    
-            image.save(filename.replace('.jpg', '_compressed.jpg'),quality=40,optimize=True)
+            outputs[filename.replace('.jpg', '_compressed.jpg')] = {'quality': 40}
         else:
-            image.save(filename.replace('.jpg', '_compressed.jpg'),quality=75,optimize=True)
+            outputs[filename.replace('.jpg', '_compressed.jpg')] = {'quality': 75}
+        image_encoder.submit(filename, outputs)
+        print("derived images queued in {:.3f}s".format(time.time() - start))
        # camera.stop_preview()
         args.raw = filename.replace('.jpg', '_compressed.jpg')
         timestamp = datetime.now().strftime('%Y%m%d-%H:%M:%S')
@@ -649,45 +628,19 @@ def capture_image(resolution='high_res'):
         uart.send_serial("led_off")
         return (optimal_focus_z, timestamp)
         
-def package_offsets(size, package_size):
-    return range(0, size, package_size)
-
-
-def package_end(size, offset, package_size):
-    end = offset + package_size
-    return end if end < size else size
-
-
-# noinspection PyShadowingBuiltins
-def info_matches(response, id, type, part):
-    try:
-        return response['id'] == id and response['type'] == type and response['part'] == part
-    except KeyError:
-        return False
-
-
-def calculate_progress(size, offset):
-    return round((offset / size) * 100, 2)
-
-
-
-
 # noinspection PyShadowingBuiltins
-def send_file_response(connection, instruction, file_path, package_size, type, id=None):
-    global outstanding_data
+def send_file_response(connection, instruction, file_path, package_size, type, id=None, window=1):
     logging.info(f'Sending file "{file_path}"')
 
-    with open(file_path, 'rb') as file:
-        data = file.read()
-
-    size = len(data)
-    hashes = []
+    # the preview and compressed images may still be encoded in the background
+    image_encoder.wait(file_path)
+    size = os.path.getsize(file_path)
 
     if package_size < 1:
         package_size = size
 
-    for offset in package_offsets(size, package_size):
-        hashes.append(hashlib.sha1(data[offset:package_end(size, offset, package_size)]).hexdigest())
+    # hashed through a memory map, cached next to the file for repeated requests
+    hashes = chunk_hashes(file_path, package_size)
 
     logging.debug(f'{len(hashes)} file hash{"es" if len(hashes) > 1 else ""} created for "{file_path}".')
 
@@ -696,98 +649,34 @@ def send_file_response(connection, instruction, file_path, package_size, type, i
         'type': type,
         'hashes': hashes,
         'packageSize': package_size,
-        'size': len(data)
+        'size': size,
+        'window': window
     }
 
     send_response(connection, instruction, payload=json.dumps(info).encode('utf-8'))
 
+    meter = TransferMeter()
     with open(file_path, 'rb') as file:
-        for offset in package_offsets(size, package_size):
-            logging.debug(
-                f'Sending file "{file_path}" from offset {offset}, '
-                f'which is equal to {calculate_progress(size, offset)}%.'
+        try:
+            send_parts(connection, file, size, package_size, id, type, window=window, meter=meter)
+        except TransferAborted as e:
+            logging.error(f'Sending file "{file_path}" aborted after {calculate_progress(size, min(meter.sent, size))}%: {e}.')
+            return
+        except socket.timeout:
+            logging.error(
+                f'Sending file "{file_path}" timed out after {calculate_progress(size, min(meter.sent, size))}% has been send.'
             )
-
-            try:
-                connection.sendfile(file, offset, package_end(size, offset, package_size) - offset)
-
-                status = None
-                payload = {'part': None}
-                part = offset // package_size
-                connection.settimeout(30)
-
-                while not (status == 'ok' and info_matches(payload, id, type, part)):
-                    response_raw = connection.recv(1024).decode('utf-8')
-                    try:
-                        print(response_raw)
-                        response1 = json.loads(response_raw)
-                        outstanding_data = None
-                    except:
-                        print("trying to recover")
-                        response1 = json.loads(response_raw.split("}}{")[0]+"}}")
-                        outstanding_data = bytearray("{"+response_raw.split("}}{")[1],'utf-8')
-                        print(outstanding_data)
-                        
-                    if "instruction" in response1:
-                        logging.error(
-                            f'Received new instruction before file "{file_path}" was fully submitted. '
-                            f'Skipping instruction "{response_raw["instruction"]}" and aborting transmission.'
-                        )
-                        return
-                        
-                    payload = read_payload(connection, response1)
-                    if payload is None:
-                        logging.error('Could not read file part response payload. Aborting file transmission.')
-                        return
-
-                    payload = json.loads(payload.decode('utf-8'))
-
-                    if info_matches(payload, id, type, part):
-                        try:
-                            status = response1['status']
-                        except KeyError:
-                            continue
-
-                        if status == 'invalid':
-                            logging.warning(
-                                f'File "{file_path}" got corrupted starting at offset {offset}, '
-                                f'which is equal to {calculate_progress(size, offset)}%. '
-                                f'Resending file starting from this offset.'
-                            )
-                            connection.sendfile(file, offset, package_end(size, offset, package_size) - offset)
-                        elif status == 'failed':
-                            logging.error(
-                                f'Sending file "{file_path}" failed '
-                                f'after {calculate_progress(size, offset)}% has been send.'
-                            )
-                            return
-            except socket.timeout:
-                logging.error(
-                    f'Sending file "{file_path}" timed out after {calculate_progress(size, offset)}% has been send.'
-                )
-                return
-            except OSError:
-                raise ConnectionError
-            finally:
-                connection.settimeout(None)
+            return
+        except OSError:
+            raise ConnectionError
 
     logging.info(f'Successful send file "{file_path}".')
+    meter.log(file_path)
 
 
 def send_sample_update(connection, sample_id, sample_status, result=None):
-    logging.info(f'Sample #{sample_id} reached status "{sample_status}".')
-
-    payload = json.dumps({
-        'id': sample_id,
-        'status': sample_status,
-        'result': result,
-    }).encode('utf-8')
-    for i in range (3):
-        try:
-            send_instruction(connection, 'sample', payload=payload)
-            break
-        except:
-            print("exception")
+    # queued and sent by the device server, the analysis does not wait for the app to acknowledge it
+    connection.push_update(sample_id, sample_status, result)
 
 # noinspection PyShadowingBuiltins
 def send_sample(connection, instruction, id):
@@ -925,6 +814,7 @@ def sample(connection, instruction):
                 args.package_size * 1024,
                 'raw image',
                 id=id,
+                window=negotiate_window(data.get('window')),
             )
         except TimeoutError:
             pass
@@ -937,6 +827,7 @@ def sample(connection, instruction):
                 args.package_size * 1024,
                 'preview image',
                 id=id,
+                window=negotiate_window(data.get('window')),
             )
         except TimeoutError:
             pass
@@ -999,13 +890,6 @@ def sample_history(sample_file_path):
     return entries
 
 
-def calculate_payload_validation(payload):
-    return {
-        'size': len(payload) if payload is not None else 0,
-        'checksum': hashlib.sha1(payload).hexdigest() if payload is not None else None
-    }
-
-
 def send_instruction(connection, instruction_name, payload=None):
     global sender_id
     sender_id += 1
@@ -1016,24 +900,22 @@ def send_instruction(connection, instruction_name, payload=None):
     instruction = {
         'id': id,
         'instruction': instruction_name,
-        'payload': calculate_payload_validation(payload)
+        'payload': payload_validation(payload)
     }
 
     logging.debug(f'Sending instruction.\n{json.dumps(instruction, indent=4)}')
 
-    connection.sendall(json.dumps(instruction).encode("utf-8"))
+    connection.send_message(instruction, payload)
 
     connection.settimeout(5)
 
-    if payload is not None:
-        connection.sendall(payload)
-
     try:
         response = {'status': None, 'id': None}
 
         while not (response['status'] == 'ok' and response['id'] == id):
             try:
-                response = json.loads(connection.recv(1024).decode('utf-8'))
+                response = connection.read_message()
+                connection.read_payload(response)
 
                 if response['id'] == id:
                     if response['status'] == 'invalid':
@@ -1050,7 +932,7 @@ def send_instruction(connection, instruction_name, payload=None):
                 logging.error(f'Instruction "{instruction_name}" with ID "{id}" timed out.')
                 
                 raise TimeoutError
-    except (ValueError, json.decoder.JSONDecodeError, KeyError):
+    except (ProtocolError, KeyError):
         logging.error(f'Reading response for instruction "{instruction_name}" with ID "{id}" failed.')
     finally:
         connection.settimeout(None)
@@ -1061,19 +943,15 @@ def send_response(connection, instruction, status='ok', payload=None):
         'id': instruction['id'],
         'instruction': instruction['instruction'],
         'status': status,
-        'payload': calculate_payload_validation(payload)
+        'payload': payload_validation(payload)
     }
 
     logging.debug(f'Sending response.\n{json.dumps(response, indent=4)}')
 
-    connection.sendall(json.dumps(response).encode("utf-8"))
-
-    if payload is not None:
-        connection.sendall(payload)
+    connection.send_message(response, payload)
 
 
 def read_payload(connection, instruction, retries=5):
-    global outstanding_data
     size = instruction['payload']['size']
     checksum = instruction['payload']['checksum']
 
@@ -1082,22 +960,13 @@ def read_payload(connection, instruction, retries=5):
         return
 
     tries = 0
-    data = bytearray()
-    if(outstanding_data==None):
-        while len(data) < size:
-            data += connection.recv(size - len(data))
-         #   print("getting more data:")
-          #  print(data)
-    else:
-            data = outstanding_data
-           # print(data)
-            outstanding_data=None
+    data = connection.read_bytes(size)
 
     while tries < retries and hashlib.sha1(data).hexdigest() != checksum:
         tries += 1
         logging.info(f'Payload checksum does not match. Retry #{tries}.')
         send_response(connection, instruction, status='invalid')
-        data = connection.recv(size)
+        data = connection.read_bytes(size)
 
     if tries == retries:
         logging.error(f'Payload checksum are not match after retry #{tries} still. Aborting.')
@@ -1152,56 +1021,33 @@ def update(connection, instruction):
     data = json.loads(data.decode('utf-8'))
     size = data["size"]
     package_size = data["packageSize"]
-    buffer_size = package_size
 
-    send_response(connection, instruction)
-
-    with open(instruction['instruction'], 'w+b') as file:
-        # noinspection PyShadowingBuiltins
-        for part, hash in enumerate(data['hashes']):
-            if part == (len(data['hashes']) - 1):
-                buffer_size = size - part * buffer_size
+    manifest = UpdateManifest(update_path(data['type']), size, package_size, data['hashes']).load()
 
-            checksum = None
-
-            while checksum != hash:
-                print(part)
+    # apps asking to resume start at the first part the device is missing, the others start over
+    if data.get('resume') == True:
+        first_part = manifest.first_missing()
+        logging.info(f'Resuming update file "{manifest.path}" at part {first_part}.')
+        send_response(connection, instruction, payload=json.dumps({'part': first_part}).encode('utf-8'))
+    else:
+        first_part = 0
+        send_response(connection, instruction)
 
-                buffer = bytearray()
+    def acknowledge(part, status):
+        send_response(connection, instruction, status=status, payload=json.dumps({
+            'type': data['type'],
+            'part': part,
+        }).encode('utf-8'))
 
-                try:
-                    connection.settimeout(45)
-
-                    while buffer_size != len(buffer):
-                        buffer += connection.recv(buffer_size - len(buffer))
-                except socket.timeout:
-                    logging.error(
-                        f'Receiving update file timed out '
-                        f'after {calculate_progress(size, part * package_size)}% has been received.'
-                    )
-                    return
-                finally:
-                    connection.settimeout(None)
-
-                checksum = hashlib.sha1(buffer).hexdigest()
-
-                if checksum == hash:
-                    status = 'ok'
-                    file.write(buffer)
-                else:
-                    status = 'invalid'
-                    buffer.clear()
-
-                    logging.warning(
-                        f'Update file got corrupted at offset {part * package_size}, '
-                        f'which is equals to {calculate_progress(size, part * package_size)}%. '
-                        f'Retrying transmission from this offset.'
-                    )
-
-                send_response(connection, instruction, status=status, payload=json.dumps({
-                    'type': data['type'],
-                    'part': part,
-                }).encode('utf-8'))
+    try:
+        receive_update(connection, manifest, acknowledge, first_part)
+    except socket.timeout:
+        logging.error(
+            f'Receiving update file timed out '
+            f'after {calculate_progress(size, manifest.received())}% has been received.'
+        )
+        return
+    manifest.remove()
 
     # TODO implement update mechanism
     send_instruction(connection, 'update', json.dumps({
@@ -1209,84 +1055,53 @@ def update(connection, instruction):
     }).encode('utf-8'))
 
 
-def bluetooth_loop():
-    global outstanding_data
-    adapter = bus.get('org.bluez', '/org/bluez/hci0').Address
-    s = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_STREAM, socket.BTPROTO_RFCOMM)
-    s.bind((adapter, 1))
+def send_diagnostics(connection, instruction):
+    logging.info('Diagnostics requested.')
+    send_response(connection, instruction, payload=json.dumps(diagnostics()).encode('utf-8'))
 
-    s.listen(1)
 
-    while True:
-        connection, address = s.accept()
-        address = address[0]
+def send_history(connection, instruction):
+    global samples
 
-        logging.info(f'Established connection with {address}.')
+    logging.info('Sample history requested.')
+    send_response(connection, instruction, payload=json.dumps(list(samples.values())).encode('utf-8'))
 
-        while True:
-            try:
-                connection.settimeout(None)
-                data_raw = connection.recv(1024).decode('utf-8')
 
-                try:
-                    data = json.loads(data_raw)
-                    outstanding_data = None
-                except json.decoder.JSONDecodeError:
-                    logging.warning(
-                        f'Received invalid instructions "{data_raw.strip()}". '
-                        f'The android app might to be updated.'
-                    )
-                    data = json.loads(data_raw.split("}}{")[0]+"}}")
-                    outstanding_data = bytearray(("{"+data_raw.split("}}{")[1]),'utf-8')
-                    
-
-                logging.debug(f'Instruction received.\n{json.dumps(data, indent=4)}')
-                try:
-                    instruction = data['instruction']
-                except KeyError:
-                    logging.warning('Ignoring payload received as instruction. An instruction got skipped most likely.')
-                    continue
+def route_instruction(instruction, payload):
+    ''' handler and executor of an instruction of the app, see device_server.py '''
+    name = instruction['instruction']
+    if name == 'diagnostics':
+        return send_diagnostics, 'quick'
+    elif name == 'history':
+        return send_history, 'quick'
+    elif name == 'sample':
+        try:
+            action = json.loads(payload).get('action')
+        except (ValueError, AttributeError):
+            action = None
+        if action == 'submit':
+            return sample, 'sample'
+        elif action in ('get raw image', 'get preview image'):
+            return sample, 'stream'
+        return sample, 'quick'
+    elif name == 'wifi':
+        return update_wifi, 'quick'
+    elif name == 'update':
+        return update, 'stream'
+    return None, None
 
-                # noinspection PyShadowingBuiltins
-                id = str(data['id'])
 
-                if id[0] == 'w':
-                    logging.warning(f'Received response for timed out instruction "{instruction}" with ID "{id}".')
+def bluetooth_loop():
+    adapter = bus.get('org.bluez', '/org/bluez/hci0').Address
+    s = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_STREAM, socket.BTPROTO_RFCOMM)
+    s.bind((adapter, 1))
 
-                    payload_size = data['payload']['size']
+    s.listen(1)
 
-                    if payload_size > 0:
-                        connection.recv(payload_size)
+    # instructions are answered while a sample is analysed, see device_server.py
+    asyncio.run(DeviceServer(route_instruction).serve(s))
 
-                    continue
 
-                if instruction == 'diagnostics':
-                    logging.info('Diagnostics requested.')
-                    send_response(connection, data, payload=json.dumps(diagnostics()).encode('utf-8'))
-                elif instruction == 'history':
-                    global samples
-
-                    logging.info('Sample history requested.')
-                    send_response(connection, data, payload=json.dumps(list(samples.values())).encode('utf-8'))
-                elif instruction == 'sample':
-                    sample(connection, data)
-                elif instruction == 'wifi':
-                    update_wifi(connection, data)
-                elif instruction == 'update':
-                    update(connection, data)
-                else:
-                    logging.warning('Unavailable instruction received.')
-                    send_response(connection, data, status=f'Instruction "{instruction}" not supported')
-            except UnicodeDecodeError:
-                logging.warning('Received binary data as instruction.')
-            except ConnectionError:
-                logging.info(f'Connection with {address} lost.')
-                break
-            except TimeoutError:
-                logging.info(f'Connection with {address} timed out.')
-                break
-
-        connection.close()
 def uart_loop():
     global sample_ID, new_sample,chlorine
     while True:
@@ -1312,15 +1127,15 @@ def uart_loop():
             subprocess.call(['sudo','/usr/sbin/shutdown','-h','now'])
             
 def ML_analysis(input_filename=''):
-    start = time.time()
-    print("loading the ML module, please wait")
-    import count_colony_yolor
-    print("imported the ML module")
-    print("time it tooks: {}".format(time.time() - start))
+    # the worker keeps the models loaded, so only the first call waits for the import
+    worker = analysis_worker.start()
     if(input_filename!=''):
-        result = count_colony_yolor.analysis_image(input_filename, input_filename.replace('.jpg', '_result.jpg'))
-        print(result)
+        start = time.time()
+        # the dish holder rarely moves between samples, only run the Hough crop when the rim check fails
+        result = worker.submit(input_filename, input_filename.replace('.jpg', '_result.jpg'),
+                               crop_strategy='adaptive').result()
         print("time it tooks: {}".format(time.time() - start))
+        return result
     
 
 if __name__ == '__main__':
@@ -1343,8 +1158,8 @@ if __name__ == '__main__':
     time.sleep(1)
     x = threading.Thread(target = uart_loop)
     x.start()
-    y = threading.Thread(target = ML_analysis)
-    y.start()            
+    # load the ML models in the background while the rest of the device boots
+    analysis_worker.start()
 
 
     parser = argparse.ArgumentParser()
@@ -1401,9 +1216,7 @@ if __name__ == '__main__':
                 if existing_data:
                     writer.writerows(existing_data[1:])   # capture_image()
    # Chlorine_analysis("timelapse_data/666/0000_20231206-22:08:12.jpg")
-    
-    with open('image_to_analyse.txt', 'w+') as file:
-        pass
+
    # analysis_result()
     while True:
         try:
@@ -0,0 +1,179 @@
+'''
+Overgrowth colour check for count_colony.RGB_comparator without cv2.kmeans.
+
+The pixels of the colour check crop are binned in a quantised palette (3 bits per
+channel, 512 bins) with one np.bincount, which also gives the mean colour of every bin.
+The black background (the masked pixels outside the dish) is left out. The bins are then
+clustered with a weighted k-means on at most 512 points, started from a fixed set of
+centres (the most populated bin, then the bins farthest from the centres already picked)
+and stopped after max_iter rounds. The result is deterministic and its cost only depends
+on the image size through the bincount.
+
+The dominant colours and the overgrown decision follow the k-means version: average
+the n_dominant largest clusters and flag the plate when the blue or green channel is
+more than 120 below white.
+
+compare_decisions() runs both classifiers on an archive of plates and prints where they
+disagree. count_colony keeps 'kmeans' as its colour_method until the agreement on real
+archive plates has been measured, 'palette' is opt-in.
+'''
+
+import glob
+import os
+import time
+
+import cv2
+import numpy as np
+
+# Settings
+palette_bits = 3  # bits per channel of the quantised palette
+max_iter = 10
+diff_thresh = 120
+
+
+def palette_histogram(img, bits=palette_bits):
+    '''
+    :param img: BGR uint8 image, black pixels are background
+    :return: (counts, mean colours) of the occupied palette bins, without the background
+    '''
+    pixels = img.reshape(-1, 3)
+    pixels = pixels[pixels.any(axis=1)]
+    shift = 8 - bits
+    q = (pixels >> shift).astype(np.int32)
+    bins = (q[:, 0] << (2 * bits)) | (q[:, 1] << bits) | q[:, 2]
+    n_bins = 1 << (3 * bits)
+    counts = np.bincount(bins, minlength=n_bins)
+    occupied = counts > 0
+    sums = np.stack([np.bincount(bins, weights=pixels[:, c], minlength=n_bins) for c in range(3)], axis=1)
+    return counts[occupied], sums[occupied] / counts[occupied, None]
+
+
+def initial_centres(colours, weights, n_clusters):
+    ''' the most populated colour, then repeatedly the colour farthest from the centres picked so far '''
+    picked = [int(np.argmax(weights))]
+    distance = ((colours - colours[picked[0]]) ** 2).sum(axis=1)
+    while len(picked) < min(n_clusters, len(colours)):
+        picked.append(int(np.argmax(distance)))
+        distance = np.minimum(distance, ((colours - colours[picked[-1]]) ** 2).sum(axis=1))
+    return colours[picked].copy()
+
+
+def weighted_kmeans(colours, weights, n_clusters, max_iter=max_iter):
+    '''
+    k-means on the palette colours, each weighted by its pixel count
+
+    :return: (cluster sizes in pixels, cluster centres)
+    '''
+    centres = initial_centres(colours, weights, n_clusters)
+    for _ in range(max_iter):
+        labels = ((colours[:, None, :] - centres[None, :, :]) ** 2).sum(axis=2).argmin(axis=1)
+        sizes = np.bincount(labels, weights=weights, minlength=len(centres))
+        new_centres = centres.copy()
+        for c in range(3):
+            sums = np.bincount(labels, weights=weights * colours[:, c], minlength=len(centres))
+            new_centres[sizes > 0, c] = sums[sizes > 0] / sizes[sizes > 0]
+        if np.allclose(new_centres, centres, atol=0.1):
+            break
+        centres = new_centres
+    labels = ((colours[:, None, :] - centres[None, :, :]) ** 2).sum(axis=2).argmin(axis=1)
+    return np.bincount(labels, weights=weights, minlength=len(centres)), centres
+
+
+def dominant_colours(img, n_colors=6, n_dominant=2):
+    ''' the n_dominant largest colour clusters of the dish, largest first (n_colors counts the background, as for k-means) '''
+    counts, colours = palette_histogram(img)
+    if len(counts) == 0:
+        return np.zeros((0, 3))
+    sizes, centres = weighted_kmeans(colours, counts.astype(np.float64), n_colors - 1)
+    return centres[np.argsort(sizes)[::-1][:n_dominant]]
+
+
+def palette_overgrown(img, n_colors=6, n_dominant=2):
+    ''' overgrown flag from the average difference of the dominant colours with white '''
+    colours = dominant_colours(img, n_colors, n_dominant)
+    if len(colours) == 0:
+        return False
+    avg_diff = np.int_((np.array([255, 255, 255]) - colours).mean(axis=0))
+    return bool(avg_diff[0] > diff_thresh or avg_diff[1] > diff_thresh)
+
+
+def kmeans_overgrown(cropped_img, n_colors=6, n_dominant=2):
+    ''' the original cv2.kmeans decision of RGB_comparator '''
+    pixels = np.float32(cropped_img.reshape(-1, 3))
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 200, .1)
+    _, labels, palette = cv2.kmeans(pixels, n_colors, None, criteria, 10, cv2.KMEANS_RANDOM_CENTERS)
+    _, counts = np.unique(labels, return_counts=True)
+    indices_with_black = np.argsort(counts)[::-1]
+    indices = indices_with_black
+    for j, index in enumerate(indices_with_black):
+        if np.array_equal(np.uint8(palette[index]), np.array([0, 0, 0])):
+            indices = np.delete(indices_with_black, j)
+    diff = 0
+    for i in range(n_dominant):
+        diff += np.array([255, 255, 255]) - palette[indices[i]]
+    avg_diff = np.int_(diff / n_dominant)
+    return bool(avg_diff[0] > diff_thresh or avg_diff[1] > diff_thresh)
+
+
+def compare_decisions(images, names=None):
+    '''
+    run the k-means and the palette classifier on the same colour check crops
+
+    :param images: BGR crops, as given to RGB_comparator
+    :return: one record per image
+    '''
+    if names is None:
+        names = [str(i) for i in range(len(images))]
+    records = []
+    for name, img in zip(names, images):
+        record = {'image': name}
+        for method, classify in (('kmeans', kmeans_overgrown), ('palette', palette_overgrown)):
+            start = time.time()
+            record[method] = classify(img)
+            record[method + '_time'] = time.time() - start
+        records.append(record)
+        if record['kmeans'] != record['palette']:
+            print('{}: k-means {}, palette {}'.format(name, record['kmeans'], record['palette']))
+
+    agree = sum(r['kmeans'] == r['palette'] for r in records)
+    print('{} of {} decisions agree, k-means {:.1f} ms, palette {:.1f} ms per image'.format(
+        agree, len(records), 1000 * np.mean([r['kmeans_time'] for r in records]),
+        1000 * np.mean([r['palette_time'] for r in records])))
+    return records
+
+
+def synthetic_plate(medium, colonies=(), size=256, seed=0):
+    ''' black square with a dish of the medium colour and a few colony colours, like the colour check crop '''
+    generator = np.random.RandomState(seed)
+    img = np.zeros((size, size, 3), dtype=np.uint8)
+    cv2.circle(img, (size // 2, size // 2), size // 2 - 2, medium, -1)
+    for colour in colonies:
+        for _ in range(20):
+            x, y = generator.randint(size // 4, 3 * size // 4, 2)
+            cv2.circle(img, (int(x), int(y)), int(generator.randint(2, 8)), colour, -1)
+    noise = generator.randint(-8, 9, img.shape)
+    return np.where(img.any(axis=2, keepdims=True), np.clip(img + noise, 1, 255), 0).astype(np.uint8)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='compare the palette and the k-means overgrowth decisions')
+    parser.add_argument('folder', nargs='?', help='archive of plate images, synthetic plates if omitted')
+    parser.add_argument('--raw', action='store_true',
+                        help='the images are raw captures, crop them with count_colony.raw_to_cropped_color_check')
+    args = parser.parse_args()
+
+    if args.folder:
+        paths = sorted(glob.glob(os.path.join(args.folder, '*.jpg')) + glob.glob(os.path.join(args.folder, '*.png')))
+        images = [cv2.imread(path) for path in paths]
+        if args.raw:
+            from count_colony import raw_to_cropped_color_check
+            images = [raw_to_cropped_color_check(img, dim=(256, 256)) for img in images]
+        compare_decisions(images, [os.path.basename(path) for path in paths])
+    else:
+        # clear, yellowish, pink and purple/blue media, BGR
+        media = [(235, 240, 240), (150, 215, 225), (190, 150, 230), (150, 80, 110), (120, 90, 60)]
+        colonies = [(), [(130, 60, 90)], [(200, 100, 80), (60, 60, 200)]]
+        plates = [synthetic_plate(m, c, seed=i) for i, (m, c) in enumerate((m, c) for m in media for c in colonies)]
+        compare_decisions(plates)
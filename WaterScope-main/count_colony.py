@@ -4,12 +4,26 @@ from tensorflow.keras import backend as K
 import cv2
 import random as rng
 from skimage.feature import peak_local_max
+from colony_segmentation import watershed_colonies, random_colors, colour_labels, tiered_count
+from colour_classifier import palette_overgrown
 import os
 import time
 import tensorflow as tf
 from PIL import Image
 from integrate_folder.yolo import YOLO
-from tflite_runtime.interpreter import Interpreter  # on Pi, uncomment this; otherwise, use tf.lite.Interpreter
+from tflite_pool import InterpreterPool
+
+# Settings
+count_method = 'tiered'  # 'watershed' to split every U-net prediction with the full watershed
+# overgrowth check of RGB_comparator: 'kmeans' (cv2.kmeans clustering, the original) or 'palette' (opt-in, only
+# compared on synthetic plates so far, run colour_classifier.py on archive plates and record the agreement first)
+colour_method = 'kmeans'
+unet_model_path = '11_april_256_multi-res_filter_24_bs_16_last_epoch.tflite'
+unet_pool_size = 1  # U-net predictions that can run at the same time
+unet_num_threads = 4  # kernel threads of each U-net interpreter
+
+# tier that produced the last count of each colour, see colony_segmentation.tiered_count
+count_tiers = {}
 
 
 def raw_to_cropped_old(raw_image, dim, color_check=False, print_log=False):
@@ -1337,11 +1351,13 @@ def raw_to_cropped_hi_res(raw_image, dim, color_check=False, print_log=False, mu
 
 
 
-def RGB_comparator(cropped_img, n_colors=6, n_dominant=2):
+def RGB_comparator(cropped_img, n_colors=6, n_dominant=2, method=None):
     '''
     :parameter: cropped_img
                 n_colors [1 + number of dominant colors to be found by k-means clustering (plus 1 due to black background]
                 n_dominant [top n_dominant colors to use for calculation of average difference from white color]
+                method ['palette' clusters a quantised colour histogram with fixed initial centres, see
+                colour_classifier.py, 'kmeans' runs cv2.kmeans on every pixel. None uses colour_method]
     :return:    based on the average difference of the top n_dominant colors from white color
                 if
                     first or second element (Red or Green channel) of the average difference is > 120
@@ -1350,6 +1366,11 @@ def RGB_comparator(cropped_img, n_colors=6, n_dominant=2):
                 else
                     return overgrown_flag = False
     '''
+    if method is None:
+        method = colour_method
+    if method == 'palette':
+        return palette_overgrown(cropped_img, n_colors, n_dominant)
+
     # flatten the 3 color channels
     pixels = np.float32(cropped_img.reshape(-1, 3))
 
@@ -1399,33 +1420,15 @@ def predict_from_model(cropped_img, pred_thresh = 0.42):
     IMG_HEIGHT = 256
     IMG_CHANNELS = 3
 
-    # Getting image into numpy array for prediction
-    X_env_test = np.zeros((1, IMG_HEIGHT, IMG_WIDTH, IMG_CHANNELS), dtype=np.uint8)
-    img = cropped_img
-    X_env_test[0] = img
-
-    # setting up interpreter and inputs
-
-    # Predict colonies
-    input_data2 = input_data
-    input_data2[0] = cropped_img
-    interpreter.set_tensor(input_details[0]['index'], input_data2)
-    interpreter.invoke()
+    # Predict colonies, the crop is written straight into the input tensor of a pooled interpreter
+    with unet_pool.interpreter() as unet:
+        unet.input()[0] = cropped_img
+        unet.invoke()
 
-    output_data = interpreter.get_tensor(output_details[0]['index'])
-    preds_env_test = output_data
-
-    # Threshold predictions for blue and purple
-    preds_env_test_t = preds_env_test
-    preds_env_test_t[0, :, :, 0] = (preds_env_test_t[0, :, :, 0] < pred_thresh).astype(np.uint8)
-    preds_env_test_t[0, :, :, 1] = (preds_env_test_t[0, :, :, 1] < pred_thresh).astype(np.uint8)
-
-    thresholded_blue = (np.squeeze(preds_env_test_t[0, :, :, 0]))
-    thresholded_blue = thresholded_blue * 255
-    thresholded_blue = thresholded_blue.astype('uint8')
-    thresholded_purple = (np.squeeze(preds_env_test_t[0, :, :, 1]))
-    thresholded_purple = thresholded_purple * 255
-    thresholded_purple = thresholded_purple.astype('uint8')
+        # Threshold predictions for blue and purple, read from the output tensor before the interpreter is released,
+        # no view of the tensor is kept past the with block
+        thresholded_blue = (unet.output()[0, :, :, 0] < pred_thresh).astype('uint8') * 255
+        thresholded_purple = (unet.output()[0, :, :, 1] < pred_thresh).astype('uint8') * 255
 
     return [thresholded_blue, thresholded_purple]
 
@@ -1447,126 +1450,45 @@ def segment_and_count(predicted_image, return_image='False'):
     bw = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     bw = cv2.GaussianBlur(bw, (7, 7), 3)
     ret, bw = cv2.threshold(bw, 30, 255, cv2.THRESH_BINARY)
-    bw2 = cv2.cvtColor(bw, cv2.COLOR_GRAY2BGR)
-    bw2 = bw2.astype('uint8')
-
-    # distance transform performed to obtain the distance map (output is a float of value between 0 to ~15, the further away a pixel is to the edge, the higher the value)
-    dist2 = cv2.distanceTransform(bw, cv2.DIST_L2, 5)
-
-    # Normalize the distance image for range = {0.0, 1.0}
-    cv2.normalize(dist2, dist2, 0, 1.0, cv2.NORM_MINMAX)
-
-    # Convert to unsigned 8-bit integer (compatible for cv2.imshow)
-    dist2 = dist2 * 255
-    dist2 = np.uint8(dist2)
-
-    # Obtain coordinates of local maxima (output type = numpy array of maxima coordinates)
-    coordinates = peak_local_max(dist2, min_distance=10)
-
-    # Create empty mask
-    markers2 = np.zeros(dist2.shape, dtype=np.int32)
-
-    # Draw the colony markers as points
-    for i in coordinates:
-        cv2.circle(markers2, tuple((i[1], i[0])), 1, (255, 255, 255), -1)
-
-    markers2show = markers2.astype("uint8")
-
-    # Find total markers using findContours
-    contours, _ = cv2.findContours(markers2show, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-    # Create the marker image for the watershed algorithm
-    markers = np.zeros(dist2.shape, dtype=np.int32)
-
-    # Draw the foreground markers
-    for i in range(len(contours)):
-        cv2.drawContours(markers, contours, i, (i + 1), -1)
-
-    # Draw the background marker at (1,1) to reduce possibility of background segmentation
-    cv2.rectangle(markers, (1, 1), (511, 511), (255, 255, 255), 1)
 
-    # Using the markers, segment the binary image
-    cv2.watershed(bw2, markers)
+    # watershed with a marker of radius 1 at each distance transform peak
+    markers, n_colonies = watershed_colonies(bw, min_distance=10, marker_radius=1)
 
-    # Generate random colors
-    colors = []
-    for contour in contours:
-        colors.append((rng.randint(0, 256), rng.randint(0, 256), rng.randint(200, 256)))
-
-    # Create the result image
-    dst = np.zeros((markers.shape[0], markers.shape[1], 3), dtype=np.uint8)
     # Fill labeled objects with random colors
-    for i in range(markers.shape[0]):
-        for j in range(markers.shape[1]):
-            index = markers[i, j]
-            if index > 0 and index <= len(contours):
-                dst[i, j, :] = colors[index - 1]
+    dst = colour_labels(markers, random_colors(n_colonies))
 
     if return_image == 'True':
-        return dst, len(contours)
+        return dst, n_colonies
     else:
-        return len(contours)
+        return n_colonies
 
 
-def segment_and_count_boundary(input_img, return_image='True', color='Blue'):
+def segment_and_count_boundary(input_img, return_image='True', color='Blue', count_method='watershed'):
     img = input_img
 
-    bw2 = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
-    bw2 = bw2.astype('uint8')
-
-    # distance transform performed to obtain the distance map (output is a float of value between 0 to ~15, the further away a pixel is to the edge, the higher the value)
-    dist2 = cv2.distanceTransform(img, cv2.DIST_L2, 5)
-
-    # Normalize the distance image for range = {0.0, 1.0}
-    cv2.normalize(dist2, dist2, 0, 1.0, cv2.NORM_MINMAX)
-
-    # Convert to unsigned 8-bit integer (compatible for cv2.imshow)
-    dist2 = dist2 * 255
-    dist2 = np.uint8(dist2)
-
-    # Obtain coordinates of local maxima (output type = numpy array of maxima coordinates)
-    coordinates = peak_local_max(dist2, min_distance=2)
-
-    # Create empty mask
-    markers2 = np.zeros(dist2.shape, dtype=np.int32)
-
-    # Draw the colony markers as points
-    for i in coordinates:
-        cv2.circle(markers2, tuple((i[1], i[0])), 0, (255, 255, 255), -1)
-
-    markers2show = markers2.astype("uint8")
-
-    # Find total markers using findContours
-    contours, _ = cv2.findContours(markers2show, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-    # Create the marker image for the watershed algorithm
-    markers = np.zeros(dist2.shape, dtype=np.int32)
-
-    # Draw the foreground markers
-    for i in range(len(contours)):
-        cv2.drawContours(markers, contours, i, (i + 1), -1)
-
-    # Draw the background marker at (1,1) to reduce possibility of background segmentation
-    cv2.rectangle(markers, (1, 1), (511, 511), (255, 255, 255), 1)
-
-    # Using the markers, segment the binary image
-    watershed = cv2.watershed(bw2, markers)
-    boundary = (watershed < 1).astype(np.uint8) * 255
+    if count_method == 'tiered':
+        # connected components, watershed only for the merged colonies
+        n_colonies, boundary, count_tiers[color] = tiered_count(img, min_distance=2, marker_radius=0)
+    else:
+        # watershed with a single pixel marker at each distance transform peak
+        watershed, n_colonies = watershed_colonies(img, min_distance=2, marker_radius=0)
+        boundary = (watershed < 1).astype(np.uint8) * 255
+        count_tiers[color] = {'tier': 'watershed', 'components': 0, 'escalated': 0, 'watershed': n_colonies}
 
     if color == 'Blue':
         boundary_colored = cv2.cvtColor(boundary, cv2.COLOR_GRAY2BGR)
         boundary_colored[:, :, 1:] = boundary_colored[:, :, 1:] * 0
         if return_image == 'True':
-            return boundary_colored, len(contours)
+            return boundary_colored, n_colonies
         else:
-            return len(contours)
+            return n_colonies
     else:
         boundary_colored = cv2.cvtColor(boundary, cv2.COLOR_GRAY2BGR)
         boundary_colored[:, :, :2] = boundary_colored[:, :, :2] * 0
         if return_image == 'True':
-            return boundary_colored, len(contours)
+            return boundary_colored, n_colonies
         else:
-            return len(contours)
+            return n_colonies
 
 
 def get_count(inputimg, color):
@@ -2396,8 +2318,12 @@ def analysis_image(img_name='image.jpg', result='result.jpg', predict_thresh = 0
         blue_predict = np.multiply(mask_test, blue_predict)
         purple_predict = np.multiply(mask_test, purple_predict)
 
-        blue, purple = segment_and_count_boundary(blue_predict, return_image='True', color='Blue'), \
-                       segment_and_count_boundary(purple_predict, return_image='True', color='Purple')
+        blue, purple = segment_and_count_boundary(blue_predict, return_image='True', color='Blue',
+                                                  count_method=count_method), \
+                       segment_and_count_boundary(purple_predict, return_image='True', color='Purple',
+                                                  count_method=count_method)
+        if print_log == True:
+            print('count tiers: e.coli {}, coliform {}'.format(count_tiers['Blue'], count_tiers['Purple']))
         blue_image, blue_count = blue[0], blue[1]
         purple_image, purple_count = purple[0], purple[1]
 
@@ -2463,8 +2389,12 @@ def analysis_image(img_name='image.jpg', result='result.jpg', predict_thresh = 0
         blue_predict = np.multiply(mask_test, blue_predict)
         purple_predict = np.multiply(mask_test, purple_predict)
 
-        blue, purple = segment_and_count_boundary(blue_predict, return_image='True', color='Blue'), \
-                       segment_and_count_boundary(purple_predict, return_image='True', color='Purple')
+        blue, purple = segment_and_count_boundary(blue_predict, return_image='True', color='Blue',
+                                                  count_method=count_method), \
+                       segment_and_count_boundary(purple_predict, return_image='True', color='Purple',
+                                                  count_method=count_method)
+        if print_log == True:
+            print('count tiers: e.coli {}, coliform {}'.format(count_tiers['Blue'], count_tiers['Purple']))
         blue_image, blue_count = blue[0], blue[1]
         purple_image, purple_count = purple[0], purple[1]
         flag_type = flagging_version2(blue_count, len(out_label['blue']), purple_count, len(out_label['coliform']),
@@ -2616,17 +2546,8 @@ def jacard(y_true, y_pred):
     return intersection / union
 
 
-# Load the TFLite model and allocate tensors.
-interpreter = Interpreter(model_path='11_april_256_multi-res_filter_24_bs_16_last_epoch.tflite')
-interpreter.allocate_tensors()
-
-# Get input and output tensors.
-input_details = interpreter.get_input_details()
-output_details = interpreter.get_output_details()
-
-# # Test the model on random input data.
-input_shape = input_details[0]['shape']
-input_data = np.array(np.random.random_sample(input_shape), dtype=np.float32)
+# Load the TFLite model, predict_from_model can be called from several threads
+unet_pool = InterpreterPool(unet_model_path, size=unet_pool_size, num_threads=unet_num_threads)
 
 FLAGS = {'image': True, 'input': 'integrate_folder/normal_yolo_evaluate/',
          'output': 'integrate_folder/',
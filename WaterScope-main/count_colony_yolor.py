@@ -17,152 +17,18 @@ from yolor_pi.inference_script.models.models import *
 from yolor_pi.inference_script.utils.datasets import *
 from yolor_pi.inference_script.utils.general import *
 
-from tflite_runtime.interpreter import Interpreter  # on Pi, uncomment this; otherwise, use tf.lite.Interpreter
+from tflite_pool import InterpreterPool
 
 import numpy as np
 from skimage.restoration import denoise_tv_chambolle, denoise_bilateral
 import skimage
 
+from crop_engine import crop_circle, crop_disc
+from dish_detection import rough_crop_estimate, hough_estimate, estimate_dish, adaptive_estimator
+from crop_calibration import CropCalibration
+from yolor_model import load_model, load_backend, letterbox_tensor
+from tiled_inference import detect_tiled
 
-def rough_crop_estimate(im,zero=False, mm13=False, mm25=True):
-    """ Apply a rough, square, 3*sigma crop to the input image
-    (This should help speed up the next step)
-    This is done using empirical values.
-    Also returns some useful values.
-    """
-    
-    # Define empirical measures for regular system
-    if mm13 == True:
-        # Measured empirical data from previous images
-        # 13 mm
-        original_shape = (1944,2592)
-        ye, xe = (1057,1298)
-        re = 500
-        sd_x, sd_y, sd_r = 20, 60, 31
-        
-    if mm25 == True:
-        # 25 mm
-        original_shape = (1944,2592)
-        ye, xe = (1024,1280)
-        re = 900
-
-        # Standard deviations of measurements
-        sd_x, sd_y, sd_r = 50,50,50
-    
-    # Define empirical measures for zero system
-    if zero==True:
-        # Measured empirical data from previous images
-        # Old WS Zero
-#         original_shape = (1944,2592)
-#         ye, xe = (980,1249)
-#         re = 744
-#         # Standard deviations of measurements
-#         sd_x, sd_y, sd_r = 47, 36, 48
-
-        # New WS Zero
-        original_shape = (3496, 4656)
-        ye,xe = (1307,2485)
-        re = 620
-        sd_x,sd_y,sd_r = 100,70,100
-        
-    # Check if the shape is the same
-    if np.shape(im) == original_shape:
-        factor=1
-
-    # Otherwise, we can simply scale everything
-    else:
-        # f>1 --> input is bigger than original
-        # f<1 --> input is smaller than original
-        factor =  np.shape(im)[0]/original_shape[0]
-        
-    # Apply scale to get new empirical values
-    xn,yn,rn = xe*factor,ye*factor,re*factor
-       
-    # Generous 3*sigma initial crop to speed hough step
-    sig=3.5
-    xl,xu = int(xn-sig*sd_x*factor - (rn+sig*sd_r*factor)),int(xn+sig*sd_x*factor + (rn+sig*sd_r*factor))
-    yl,yu = int(yn-sig*sd_y*factor - (rn+sig*sd_r*factor)),int(yn+sig*sd_x*factor + (rn+sig*sd_r*factor))
-    
-    # Catch exceptions where limits might be beyond original image space
-    if xl < 0:
-        xl=0
-    if yl < 0:
-        yl=0
-    if xu>np.shape(im)[1]:
-        xu=np.shape(im)[1]
-    if yu>np.shape(im)[0]:
-        yu=np.shape(im)[0]
-    
-    # Crop the image
-    im_roughcrop = im[yl:yu,xl:xu]
-    
-    if mm25 == True:
-    
-        ### Make the border more prominent
-            # Change contrast
-        im_roughcrop = cv2.equalizeHist(im)
-
-            # Blur
-        im_roughcrop = cv2.GaussianBlur(im_roughcrop,(111,111),10)
-
-            # Edge
-        im_roughcrop = cv2.Canny(im_roughcrop,20,1)
-
-            # Hull mask
-        hull = skimage.morphology.convex_hull_image(im_roughcrop)
-        kernel = np.ones((310,310),'uint8')
-        inner= cv2.dilate(1-hull.astype(np.uint8),kernel)
-        inner = 255-(inner-hull)
-        outer= cv2.erode(1-hull.astype(np.uint8),kernel)
-        outer = -outer
-        inner[inner<100]=0
-        inner[inner>=100]=1
-        outer[outer<100]=0
-        outer[outer>=100]=1
-        mask = inner-outer
-
-            # Apply mask 
-        im_roughcrop = im_roughcrop*mask
-    
-    # get new empirical centre of cropped image
-    xn_rough = xn - int(xn-3*sd_x*factor - (rn+3*sd_r*factor))
-    yn_rough = yn - int(yn-3*sd_y*factor - (rn+3*sd_r*factor))
-    
-    return im_roughcrop,xn_rough,yn_rough,rn,factor,xl,yl,sd_x, sd_y, sd_r 
-    
-def hough_estimate(im,zero=False, mm13=False, mm25=True):
-    """" Try to improve on the empirical guess using the
-    Hough circle transform"""
-    
-    # Get empirical guess
-    im_rough,xre,yre,re,f,xl,yl,sd_x, sd_y, sd_r  = rough_crop_estimate(im,zero=zero, mm13=mm13, mm25=mm25)
-    
-    # dp = accumulator resolution ratio
-    # mindist = min between circles
-    # p1 = high canny threshold (low canny will be half)
-    # p2 = accumulator threshold
-    p1,p2 = 20,30
-    if zero == True:
-        # old zero
-        #p1,p2 = 50, 50
-        # New zero
-        p1,p2 = 50, 100
-    circles = cv2.HoughCircles(im_rough, cv2.HOUGH_GRADIENT, 1, 100,
-                                               param1=p1, param2=p2, minRadius=int((re-3*sd_r)*f), maxRadius=int((re+3*sd_r)*f))
-    
-    # Standard deviation in x & y are 20 & 60
-    # We also know the algorithm typically overestimates radius
-    # So we will use the smallest radius at which x & y are within 2 sigma
-        # circles is always in an extra list, and has smallest radii at the end, so let's flip it
-    try:
-        # Get biggest circle
-        circles = circles[0]
-        c=circles[0]
-        xh, yh, rh = c[0],c[1],c[2]
-        return (xh+xl)*1/f,(yh+yl)*1/f,rh*1/f
-    except:
-        # If none identified, return empirical
-        return xre+xl,yre+yl,re
 
 def create_circular_mask(h, w, center=None, radius=None):
     """ Create circular array of 0/1 of specified image height/width and circle centre/radius """
@@ -179,34 +45,8 @@ def create_circular_mask(h, w, center=None, radius=None):
 
 def apply_crop(im,x,y,r):
     """ Apply crop to image given circle centre and radius """
-    # get shape
-    h,w = np.shape(im)
-    
-    # Create mask
-    mask = create_circular_mask(h,w,center=(x,y),radius=r)
-    
-    # Apply mask
-    masked_img = im
-    masked_img[~mask] = 0
-    
-    # Crop around the edge
-    yl=int(y-r)
-    yu = int(y+r)
-    xl=int(x-r)
-    xu = int(x+r)
-
-    if xl < 0:
-        xl=0
-    if yl < 0:
-        yl=0
-    if xu>np.shape(masked_img)[1]:
-        xu=np.shape(masked_img)[1]
-    if yu>np.shape(masked_img)[0]:
-        yu=np.shape(masked_img)[0]
-
-    masked_img = masked_img[yl:yu,xl:xu]
-    
-    return masked_img
+    # mask and crop around the edge, only the bounding square of the circle is touched
+    return crop_circle(im,x,y,r)
 
 def crop_colour_im(im,x,y,r,zero = False, mm13=False, mm25=True):
     """ Apply circular crop to color image """
@@ -215,16 +55,8 @@ def crop_colour_im(im,x,y,r,zero = False, mm13=False, mm25=True):
         # RGB channels need swapping
         im = cv2.cvtColor(im,cv2.COLOR_BGR2RGB)
     
-    # Split image into colour channels
-    red,g,b = cv2.split(im)
-    
-    # Crop each channel
-    b = apply_crop(b,x,y,r)
-    g = apply_crop(g,x,y,r)
-    red = apply_crop(red,x,y,r)
-    
-    # Merge results back together
-    cropped = cv2.merge((red,g,b))
+    # Crop all colour channels in one pass
+    cropped = crop_circle(im,x,y,r)
     
     return cropped
 
@@ -381,41 +213,6 @@ def raw_to_cropped_ori_resol(raw_image, dim, color_check=False, print_log=False,
                     crop_color = cv2.merge((crop_img_combine_2, crop_img_combine_3, crop_img_combine_1))
                     return crop_color
     else:  # if color_check=False, crop as usual
-        # def masking(mask, image, x, y, radius, dim):
-        #     cropimg = cv2.subtract(mask, image)
-        #     cropimg = cv2.subtract(mask, cropimg)
-        #     cropimg = cropimg[y - radius:y + radius, x - radius:x + radius]
-        #     # cropimg = cv2.resize(cropimg, dim, interpolation=cv2.INTER_AREA)
-        #     return cropimg
-
-        def masking(mask, image, x, y, radius, dim):
-            real_y, real_x = mask.shape
-            new_y_upper = np.clip(y + radius, 0, real_y)
-            new_y_lower = np.clip(y - radius, 0, real_y)
-            new_x_upper = np.clip(x + radius, 0, real_x)
-            new_x_lower = np.clip(x - radius, 0, real_x)
-            old_y_upper = y + radius
-            old_y_lower = y - radius
-            old_x_upper = x + radius
-            old_x_lower = x - radius
-            left_patch = abs(new_x_lower - old_x_lower)
-            bottom_patch = abs(new_y_lower - old_y_lower)
-            right_patch = abs(new_x_upper - old_x_upper)
-            top_patch = abs(new_y_upper - old_y_upper)
-            # print(
-            #     'left : {}\nright : {}\ntop : {}\nbottom : {}'.format(left_patch, right_patch, top_patch, bottom_patch))
-            mask_to_patch = np.zeros((2 * radius, 2 * radius), dtype=np.uint8)
-
-            cropimg = cv2.subtract(mask, image)
-            cropimg = cv2.subtract(mask, cropimg)
-            # print('shape of cropimg is {}'.format(cropimg.shape))
-            # print('shape of mask_to_patch is {}'.format(mask_to_patch.shape))
-
-            mask_to_patch[0 + bottom_patch: 2 * radius - top_patch,
-            0 + left_patch: 2 * radius - right_patch] = cropimg[new_y_lower:new_y_upper, new_x_lower:new_x_upper]
-            # cropimg = cv2.resize(cropimg, dim, interpolation=cv2.INTER_AREA)
-            return mask_to_patch
-
         img = cv2.cvtColor(raw_image, cv2.COLOR_BGR2GRAY)
         img_color = raw_image
         r = 1200.0 / img.shape[1]
@@ -424,16 +221,8 @@ def raw_to_cropped_ori_resol(raw_image, dim, color_check=False, print_log=False,
         # img_color = cv2.resize(img_color, dimension, interpolation=cv2.INTER_AREA)
 
         
-        # BGR channel
-        blue, green, red = cv2.split(img_color)
-        img_combine_1 = red
-        img_combine_2 = blue
-        img_combine_3 = green
-
         # Detecting ROI
-        mask = np.zeros((901, 1200), dtype=np.uint8)
 
-        mask = np.zeros((original_dim[0], original_dim[1]), dtype=np.uint8)
         scale_to_ori = original_dim[1] / 1200
         circles = cv2.HoughCircles(img, cv2.HOUGH_GRADIENT, 1, 300,
                                    param1=70, param2=40, minRadius=230, maxRadius=250)
@@ -445,11 +234,7 @@ def raw_to_cropped_ori_resol(raw_image, dim, color_check=False, print_log=False,
                 x = int(x * scale_to_ori)
                 y = int(y * scale_to_ori)
                 radius = int(radius * scale_to_ori)
-                cv2.circle(mask, (x, y), radius, (255, 255, 255), -1, 8, 0)
-                crop_img_combine_1 = masking(mask, img_combine_1, x, y, radius, dim)
-                crop_img_combine_2 = masking(mask, img_combine_2, x, y, radius, dim)
-                crop_img_combine_3 = masking(mask, img_combine_3, x, y, radius, dim)
-                crop_color = cv2.merge((crop_img_combine_2, crop_img_combine_3, crop_img_combine_1))
+                crop_color = crop_disc(img_color, x, y, radius)
                 # if print_log == True:
                 #   print(x, y, radius)
 
@@ -462,11 +247,7 @@ def raw_to_cropped_ori_resol(raw_image, dim, color_check=False, print_log=False,
                 x = int(x * scale_to_ori)
                 y = int(y * scale_to_ori)
                 radius = int(radius * scale_to_ori)
-                cv2.circle(mask, (x, y), radius, (255, 255, 255), -1, 8, 0)
-                crop_img_combine_1 = masking(mask, img_combine_1, x, y, radius, dim)
-                crop_img_combine_2 = masking(mask, img_combine_2, x, y, radius, dim)
-                crop_img_combine_3 = masking(mask, img_combine_3, x, y, radius, dim)
-                crop_color = cv2.merge((crop_img_combine_2, crop_img_combine_3, crop_img_combine_1))
+                crop_color = crop_disc(img_color, x, y, radius)
                 # if print_log == True:
                 #   print(x, y, radius)
 
@@ -483,13 +264,7 @@ def raw_to_cropped_ori_resol(raw_image, dim, color_check=False, print_log=False,
                 x = int(x * scale_to_ori)
                 y = int(y * scale_to_ori)
                 radius = int(radius * scale_to_ori)
-                cv2.circle(mask, (x, y), radius, (255, 255, 255), -1, 8, 0)
-                # print(mask.shape)
-                # print(img_combine_1.shape)
-                crop_img_combine_1 = masking(mask, img_combine_1, x, y, radius, dim)
-                crop_img_combine_2 = masking(mask, img_combine_2, x, y, radius, dim)
-                crop_img_combine_3 = masking(mask, img_combine_3, x, y, radius, dim)
-                crop_color = cv2.merge((crop_img_combine_2, crop_img_combine_3, crop_img_combine_1))
+                crop_color = crop_disc(img_color, x, y, radius)
                 # if print_log == True:
                 #   print(x, y, radius)
 
@@ -507,11 +282,7 @@ def raw_to_cropped_ori_resol(raw_image, dim, color_check=False, print_log=False,
                         x = int(x * scale_to_ori)
                         y = int(y * scale_to_ori)
                         radius = int(radius * scale_to_ori)
-                        cv2.circle(mask, (x, y), radius, (255, 255, 255), -1, 8, 0)
-                        crop_img_combine_1 = masking(mask, img_combine_1, x, y, radius, dim)
-                        crop_img_combine_2 = masking(mask, img_combine_2, x, y, radius, dim)
-                        crop_img_combine_3 = masking(mask, img_combine_3, x, y, radius, dim)
-                        crop_color = cv2.merge((crop_img_combine_2, crop_img_combine_3, crop_img_combine_1))
+                        crop_color = crop_disc(img_color, x, y, radius)
                         # if print_log == True:
                         #   print(x, y,radius)
 
@@ -523,11 +294,7 @@ def raw_to_cropped_ori_resol(raw_image, dim, color_check=False, print_log=False,
                         x = int(x * scale_to_ori)
                         y = int(y * scale_to_ori)
                         radius = int(radius * scale_to_ori)
-                        cv2.circle(mask, (x, y), radius, (255, 255, 255), -1, 8, 0)
-                        crop_img_combine_1 = masking(mask, img_combine_1, x, y, radius, dim)
-                        crop_img_combine_2 = masking(mask, img_combine_2, x, y, radius, dim)
-                        crop_img_combine_3 = masking(mask, img_combine_3, x, y, radius, dim)
-                        crop_color = cv2.merge((crop_img_combine_2, crop_img_combine_3, crop_img_combine_1))
+                        crop_color = crop_disc(img_color, x, y, radius)
                         # if print_log == True:
                         #   print(x, y,radius)
 
@@ -545,11 +312,7 @@ def raw_to_cropped_ori_resol(raw_image, dim, color_check=False, print_log=False,
                             x = int(x * scale_to_ori)
                             y = int(y * scale_to_ori)
                             radius = int(radius * scale_to_ori)
-                            cv2.circle(mask, (x, y), radius, (255, 255, 255), -1, 8, 0)
-                            crop_img_combine_1 = masking(mask, img_combine_1, x, y, radius, dim)
-                            crop_img_combine_2 = masking(mask, img_combine_2, x, y, radius, dim)
-                            crop_img_combine_3 = masking(mask, img_combine_3, x, y, radius, dim)
-                            crop_color = cv2.merge((crop_img_combine_2, crop_img_combine_3, crop_img_combine_1))
+                            crop_color = crop_disc(img_color, x, y, radius)
                             # if print_log == True:
                             #   print(x, y,radius)
 
@@ -561,11 +324,7 @@ def raw_to_cropped_ori_resol(raw_image, dim, color_check=False, print_log=False,
                             x = int(x * scale_to_ori)
                             y = int(y * scale_to_ori)
                             radius = int(radius * scale_to_ori)
-                            cv2.circle(mask, (x, y), radius, (255, 255, 255), -1, 8, 0)
-                            crop_img_combine_1 = masking(mask, img_combine_1, x, y, radius, dim)
-                            crop_img_combine_2 = masking(mask, img_combine_2, x, y, radius, dim)
-                            crop_img_combine_3 = masking(mask, img_combine_3, x, y, radius, dim)
-                            crop_color = cv2.merge((crop_img_combine_2, crop_img_combine_3, crop_img_combine_1))
+                            crop_color = crop_disc(img_color, x, y, radius)
                             # if print_log == True:
                             #   print(x, y,radius)
 
@@ -581,11 +340,7 @@ def raw_to_cropped_ori_resol(raw_image, dim, color_check=False, print_log=False,
                         x = int(x * scale_to_ori)
                         y = int(y * scale_to_ori)
                         radius = int(radius * scale_to_ori)
-                        cv2.circle(mask, (x, y), radius, (255, 255, 255), -1, 8, 0)
-                        crop_img_combine_1 = masking(mask, img_combine_1, x, y, radius, dim)
-                        crop_img_combine_2 = masking(mask, img_combine_2, x, y, radius, dim)
-                        crop_img_combine_3 = masking(mask, img_combine_3, x, y, radius, dim)
-                        crop_color = cv2.merge((crop_img_combine_2, crop_img_combine_3, crop_img_combine_1))
+                        crop_color = crop_disc(img_color, x, y, radius)
                         # if print_log == True:
                         #   print(x, y,radius)
                         return crop_color, x, y, radius
@@ -608,43 +363,13 @@ def raw_to_cropped_hi_res(raw_image, dim, color_check=False, print_log=False, mu
         color_check_radius_multiplier = 3
         color_check_dimension = (64, 64)
 
-        def masking(mask, image, x, y, radius, dim):
-            real_y, real_x = mask.shape
-            new_y_upper = np.clip(y + radius, 0, real_y)
-            new_y_lower = np.clip(y - radius, 0, real_y)
-            new_x_upper = np.clip(x + radius, 0, real_x)
-            new_x_lower = np.clip(x - radius, 0, real_x)
-            old_y_upper = y + radius
-            old_y_lower = y - radius
-            old_x_upper = x + radius
-            old_x_lower = x - radius
-            left_patch = abs(new_x_lower - old_x_lower)
-            bottom_patch = abs(new_y_lower - old_y_lower)
-            right_patch = abs(new_x_upper - old_x_upper)
-            top_patch = abs(new_y_upper - old_y_upper)
-            mask_to_patch = np.zeros((2 * radius, 2 * radius), dtype=np.uint8)
-
-            cropimg = cv2.subtract(mask, image)
-            cropimg = cv2.subtract(mask, cropimg)
-
-            mask_to_patch[0 + bottom_patch: 2 * radius - top_patch,
-            0 + left_patch: 2 * radius - right_patch] = cropimg[new_y_lower:new_y_upper, new_x_lower:new_x_upper]
-            return mask_to_patch
-
         img = cv2.cvtColor(raw_image, cv2.COLOR_BGR2GRAY)
         img_color = raw_image
         r = 1200.0 / img.shape[1]
         dimension = (1200, int(img.shape[0] * r))
         img = cv2.resize(img, dimension, interpolation=cv2.INTER_AREA)
 
-        # BGR channel
-        blue, green, red = cv2.split(img_color)
-        img_combine_1 = red
-        img_combine_2 = blue
-        img_combine_3 = green
-
         # Detecting ROI
-        mask = np.zeros((original_dim[0], original_dim[1]), dtype=np.uint8)
         circles = cv2.HoughCircles(img, cv2.HOUGH_GRADIENT, 1, 300,
                                    param1=70, param2=50, minRadius=350, maxRadius=380)
         if type(circles) != type(None):
@@ -655,11 +380,7 @@ def raw_to_cropped_hi_res(raw_image, dim, color_check=False, print_log=False, mu
                 y = int(y * scale_to_ori)
                 radius += int(radius * multiplier)
                 radius = int(radius * color_check_radius_multiplier)
-                cv2.circle(mask, (x, y), radius, (255, 255, 255), -1, 8, 0)
-                crop_img_combine_1 = masking(mask, img_combine_1, x, y, radius, dim)
-                crop_img_combine_2 = masking(mask, img_combine_2, x, y, radius, dim)
-                crop_img_combine_3 = masking(mask, img_combine_3, x, y, radius, dim)
-                crop_color = cv2.merge((crop_img_combine_2, crop_img_combine_3, crop_img_combine_1))
+                crop_color = crop_disc(img_color, x, y, radius)
                 crop_color = cv2.resize(crop_color, color_check_dimension, interpolation=cv2.INTER_AREA)
                 return crop_color, x, y, radius
             else:
@@ -669,11 +390,7 @@ def raw_to_cropped_hi_res(raw_image, dim, color_check=False, print_log=False, mu
                 y = int(y * scale_to_ori)
                 radius += int(radius * multiplier)
                 radius = int(radius * color_check_radius_multiplier)
-                cv2.circle(mask, (x, y), radius, (255, 255, 255), -1, 8, 0)
-                crop_img_combine_1 = masking(mask, img_combine_1, x, y, radius, dim)
-                crop_img_combine_2 = masking(mask, img_combine_2, x, y, radius, dim)
-                crop_img_combine_3 = masking(mask, img_combine_3, x, y, radius, dim)
-                crop_color = cv2.merge((crop_img_combine_2, crop_img_combine_3, crop_img_combine_1))
+                crop_color = crop_disc(img_color, x, y, radius)
                 crop_color = cv2.resize(crop_color, color_check_dimension, interpolation=cv2.INTER_AREA)
                 return crop_color, x, y, radius
         else:
@@ -689,11 +406,7 @@ def raw_to_cropped_hi_res(raw_image, dim, color_check=False, print_log=False, mu
                 y = int(y * scale_to_ori)
                 radius += int(radius * multiplier)
                 radius = int(radius * color_check_radius_multiplier)
-                cv2.circle(mask, (x, y), radius, (255, 255, 255), -1, 8, 0)
-                crop_img_combine_1 = masking(mask, img_combine_1, x, y, radius, dim)
-                crop_img_combine_2 = masking(mask, img_combine_2, x, y, radius, dim)
-                crop_img_combine_3 = masking(mask, img_combine_3, x, y, radius, dim)
-                crop_color = cv2.merge((crop_img_combine_2, crop_img_combine_3, crop_img_combine_1))
+                crop_color = crop_disc(img_color, x, y, radius)
                 crop_color = cv2.resize(crop_color, color_check_dimension, interpolation=cv2.INTER_AREA)
                 return crop_color, x, y, radius
             else:
@@ -709,11 +422,7 @@ def raw_to_cropped_hi_res(raw_image, dim, color_check=False, print_log=False, mu
                         y = int(y * scale_to_ori)
                         radius += int(radius * multiplier)
                         radius = int(radius * color_check_radius_multiplier)
-                        cv2.circle(mask, (x, y), radius, (255, 255, 255), -1, 8, 0)
-                        crop_img_combine_1 = masking(mask, img_combine_1, x, y, radius, dim)
-                        crop_img_combine_2 = masking(mask, img_combine_2, x, y, radius, dim)
-                        crop_img_combine_3 = masking(mask, img_combine_3, x, y, radius, dim)
-                        crop_color = cv2.merge((crop_img_combine_2, crop_img_combine_3, crop_img_combine_1))
+                        crop_color = crop_disc(img_color, x, y, radius)
                         crop_color = cv2.resize(crop_color, color_check_dimension, interpolation=cv2.INTER_AREA)
                         return crop_color, x, y, radius
                     else:
@@ -723,11 +432,7 @@ def raw_to_cropped_hi_res(raw_image, dim, color_check=False, print_log=False, mu
                         y = int(y * scale_to_ori)
                         radius += int(radius * multiplier)
                         radius = int(radius * color_check_radius_multiplier)
-                        cv2.circle(mask, (x, y), radius, (255, 255, 255), -1, 8, 0)
-                        crop_img_combine_1 = masking(mask, img_combine_1, x, y, radius, dim)
-                        crop_img_combine_2 = masking(mask, img_combine_2, x, y, radius, dim)
-                        crop_img_combine_3 = masking(mask, img_combine_3, x, y, radius, dim)
-                        crop_color = cv2.merge((crop_img_combine_2, crop_img_combine_3, crop_img_combine_1))
+                        crop_color = crop_disc(img_color, x, y, radius)
                         crop_color = cv2.resize(crop_color, color_check_dimension, interpolation=cv2.INTER_AREA)
                         return crop_color, x, y, radius
                 else:
@@ -738,42 +443,10 @@ def raw_to_cropped_hi_res(raw_image, dim, color_check=False, print_log=False, mu
                     y = int(y * scale_to_ori)
                     radius += int(radius * multiplier)
                     radius = int(radius * color_check_radius_multiplier)
-                    cv2.circle(mask, (x, y), radius, (255, 255, 255), -1, 8, 0)
-                    crop_img_combine_1 = masking(mask, img_combine_1, x, y, radius, dim)
-                    crop_img_combine_2 = masking(mask, img_combine_2, x, y, radius, dim)
-                    crop_img_combine_3 = masking(mask, img_combine_3, x, y, radius, dim)
-                    crop_color = cv2.merge((crop_img_combine_2, crop_img_combine_3, crop_img_combine_1))
+                    crop_color = crop_disc(img_color, x, y, radius)
                     crop_color = cv2.resize(crop_color, color_check_dimension, interpolation=cv2.INTER_AREA)
                     return crop_color, x, y, radius
     else:  # if color_check=False, crop as usual
-        def masking(mask, image, x, y, radius, dim):
-            real_y, real_x = mask.shape
-            new_y_upper = np.clip(y + radius, 0, real_y)
-            new_y_lower = np.clip(y - radius, 0, real_y)
-            new_x_upper = np.clip(x + radius, 0, real_x)
-            new_x_lower = np.clip(x - radius, 0, real_x)
-            old_y_upper = y + radius
-            old_y_lower = y - radius
-            old_x_upper = x + radius
-            old_x_lower = x - radius
-            left_patch = abs(new_x_lower - old_x_lower)
-            bottom_patch = abs(new_y_lower - old_y_lower)
-            right_patch = abs(new_x_upper - old_x_upper)
-            top_patch = abs(new_y_upper - old_y_upper)
-            # print(
-            #     'left : {}\nright : {}\ntop : {}\nbottom : {}'.format(left_patch, right_patch, top_patch, bottom_patch))
-            mask_to_patch = np.zeros((2 * radius, 2 * radius), dtype=np.uint8)
-
-            cropimg = cv2.subtract(mask, image)
-            cropimg = cv2.subtract(mask, cropimg)
-            # print('shape of cropimg is {}'.format(cropimg.shape))
-            # print('shape of mask_to_patch is {}'.format(mask_to_patch.shape))
-
-            mask_to_patch[0 + bottom_patch: 2 * radius - top_patch,
-            0 + left_patch: 2 * radius - right_patch] = cropimg[new_y_lower:new_y_upper, new_x_lower:new_x_upper]
-            # cropimg = cv2.resize(cropimg, dim, interpolation=cv2.INTER_AREA)
-            return mask_to_patch
-
         img = cv2.cvtColor(raw_image, cv2.COLOR_BGR2GRAY)
         img_color = raw_image
         r = 1200.0 / img.shape[1]
@@ -781,15 +454,7 @@ def raw_to_cropped_hi_res(raw_image, dim, color_check=False, print_log=False, mu
         img = cv2.resize(img, dimension, interpolation=cv2.INTER_AREA)
         # img_color = cv2.resize(img_color, dimension, interpolation=cv2.INTER_AREA)
 
-        # BGR channel
-        blue, green, red = cv2.split(img_color)
-        img_combine_1 = red
-        img_combine_2 = blue
-        img_combine_3 = green
-
         # Detecting ROI
-        mask = np.zeros((899, 1200), dtype=np.uint8)
-        mask = np.zeros((original_dim[0], original_dim[1]), dtype=np.uint8)
         circles = cv2.HoughCircles(img, cv2.HOUGH_GRADIENT, 1, 300,
                                    param1=70, param2=50, minRadius=350, maxRadius=380)
         if type(circles) != type(None):
@@ -800,11 +465,7 @@ def raw_to_cropped_hi_res(raw_image, dim, color_check=False, print_log=False, mu
                 x = int(x * scale_to_ori)
                 y = int(y * scale_to_ori)
                 radius = int(radius * scale_to_ori)
-                cv2.circle(mask, (x, y), radius, (255, 255, 255), -1, 8, 0)
-                crop_img_combine_1 = masking(mask, img_combine_1, x, y, radius, dim)
-                crop_img_combine_2 = masking(mask, img_combine_2, x, y, radius, dim)
-                crop_img_combine_3 = masking(mask, img_combine_3, x, y, radius, dim)
-                crop_color = cv2.merge((crop_img_combine_2, crop_img_combine_3, crop_img_combine_1))
+                crop_color = crop_disc(img_color, x, y, radius)
                 # if print_log == True:
                 #   print(x, y, radius)
 
@@ -816,11 +477,7 @@ def raw_to_cropped_hi_res(raw_image, dim, color_check=False, print_log=False, mu
                 x = int(x * scale_to_ori)
                 y = int(y * scale_to_ori)
                 radius = int(radius * scale_to_ori)
-                cv2.circle(mask, (x, y), radius, (255, 255, 255), -1, 8, 0)
-                crop_img_combine_1 = masking(mask, img_combine_1, x, y, radius, dim)
-                crop_img_combine_2 = masking(mask, img_combine_2, x, y, radius, dim)
-                crop_img_combine_3 = masking(mask, img_combine_3, x, y, radius, dim)
-                crop_color = cv2.merge((crop_img_combine_2, crop_img_combine_3, crop_img_combine_1))
+                crop_color = crop_disc(img_color, x, y, radius)
                 # if print_log == True:
                 #   print(x, y, radius)
 
@@ -838,11 +495,7 @@ def raw_to_cropped_hi_res(raw_image, dim, color_check=False, print_log=False, mu
                 x = int(x * scale_to_ori)
                 y = int(y * scale_to_ori)
                 radius = int(radius * scale_to_ori)
-                cv2.circle(mask, (x, y), radius, (255, 255, 255), -1, 8, 0)
-                crop_img_combine_1 = masking(mask, img_combine_1, x, y, radius, dim)
-                crop_img_combine_2 = masking(mask, img_combine_2, x, y, radius, dim)
-                crop_img_combine_3 = masking(mask, img_combine_3, x, y, radius, dim)
-                crop_color = cv2.merge((crop_img_combine_2, crop_img_combine_3, crop_img_combine_1))
+                crop_color = crop_disc(img_color, x, y, radius)
                 # if print_log == True:
                 #   print(x, y, radius)
 
@@ -862,11 +515,7 @@ def raw_to_cropped_hi_res(raw_image, dim, color_check=False, print_log=False, mu
                         x = int(x * scale_to_ori)
                         y = int(y * scale_to_ori)
                         radius = int(radius * scale_to_ori)
-                        cv2.circle(mask, (x, y), radius, (255, 255, 255), -1, 8, 0)
-                        crop_img_combine_1 = masking(mask, img_combine_1, x, y, radius, dim)
-                        crop_img_combine_2 = masking(mask, img_combine_2, x, y, radius, dim)
-                        crop_img_combine_3 = masking(mask, img_combine_3, x, y, radius, dim)
-                        crop_color = cv2.merge((crop_img_combine_2, crop_img_combine_3, crop_img_combine_1))
+                        crop_color = crop_disc(img_color, x, y, radius)
                         # if print_log == True:
                         #   print(x, y,radius)
 
@@ -878,11 +527,7 @@ def raw_to_cropped_hi_res(raw_image, dim, color_check=False, print_log=False, mu
                         x = int(x * scale_to_ori)
                         y = int(y * scale_to_ori)
                         radius = int(radius * scale_to_ori)
-                        cv2.circle(mask, (x, y), radius, (255, 255, 255), -1, 8, 0)
-                        crop_img_combine_1 = masking(mask, img_combine_1, x, y, radius, dim)
-                        crop_img_combine_2 = masking(mask, img_combine_2, x, y, radius, dim)
-                        crop_img_combine_3 = masking(mask, img_combine_3, x, y, radius, dim)
-                        crop_color = cv2.merge((crop_img_combine_2, crop_img_combine_3, crop_img_combine_1))
+                        crop_color = crop_disc(img_color, x, y, radius)
                         # if print_log == True:
                         #   print(x, y,radius)
 
@@ -898,11 +543,7 @@ def raw_to_cropped_hi_res(raw_image, dim, color_check=False, print_log=False, mu
                     x = int(x * scale_to_ori)
                     y = int(y * scale_to_ori)
                     radius = int(radius * scale_to_ori)
-                    cv2.circle(mask, (x, y), radius, (255, 255, 255), -1, 8, 0)
-                    crop_img_combine_1 = masking(mask, img_combine_1, x, y, radius, dim)
-                    crop_img_combine_2 = masking(mask, img_combine_2, x, y, radius, dim)
-                    crop_img_combine_3 = masking(mask, img_combine_3, x, y, radius, dim)
-                    crop_color = cv2.merge((crop_img_combine_2, crop_img_combine_3, crop_img_combine_1))
+                    crop_color = crop_disc(img_color, x, y, radius)
                     # if print_log == True:
                     #   print(x, y,radius)
                     return crop_color, x, y, radius
@@ -913,51 +554,7 @@ def raw_to_cropped_ori_resol_moving_avg(raw_image, dim, x, y, radius):
         - using moving average of 10 previous cropping locations, crop image
     '''
 
-    def masking(mask, image, x, y, radius, dim):
-        real_y, real_x = mask.shape
-        new_y_upper = np.clip(y + radius, 0, real_y)
-        new_y_lower = np.clip(y - radius, 0, real_y)
-        new_x_upper = np.clip(x + radius, 0, real_x)
-        new_x_lower = np.clip(x - radius, 0, real_x)
-        old_y_upper = y + radius
-        old_y_lower = y - radius
-        old_x_upper = x + radius
-        old_x_lower = x - radius
-        left_patch = abs(new_x_lower - old_x_lower)
-        bottom_patch = abs(new_y_lower - old_y_lower)
-        right_patch = abs(new_x_upper - old_x_upper)
-        top_patch = abs(new_y_upper - old_y_upper)
-        # print(
-        #     'left : {}\nright : {}\ntop : {}\nbottom : {}'.format(left_patch, right_patch, top_patch, bottom_patch))
-        mask_to_patch = np.zeros((2 * radius, 2 * radius), dtype=np.uint8)
-
-        cropimg = cv2.subtract(mask, image)
-        cropimg = cv2.subtract(mask, cropimg)
-        # print('shape of cropimg is {}'.format(cropimg.shape))
-        # print('shape of mask_to_patch is {}'.format(mask_to_patch.shape))
-
-        mask_to_patch[0 + bottom_patch: 2 * radius - top_patch,
-        0 + left_patch: 2 * radius - right_patch] = cropimg[new_y_lower:new_y_upper, new_x_lower:new_x_upper]
-        # cropimg = cv2.resize(cropimg, dim, interpolation=cv2.INTER_AREA)
-        return mask_to_patch
-
-    original_dim = raw_image.shape
-
-    # BGR channel
-    blue, green, red = cv2.split(raw_image)
-    img_combine_1 = red
-    img_combine_2 = blue
-    img_combine_3 = green
-
-    # Detecting ROI
-    mask = np.zeros((original_dim[0], original_dim[1]), dtype=np.uint8)
-
-    cv2.circle(mask, (x, y), radius, (255, 255, 255), -1, 8, 0)
-
-    crop_img_combine_1 = masking(mask, img_combine_1, x, y, radius, original_dim)
-    crop_img_combine_2 = masking(mask, img_combine_2, x, y, radius, original_dim)
-    crop_img_combine_3 = masking(mask, img_combine_3, x, y, radius, original_dim)
-    crop_color = cv2.merge((crop_img_combine_2, crop_img_combine_3, crop_img_combine_1))
+    crop_color = crop_disc(raw_image, x, y, radius)
 
     return crop_color, x, y, radius
 
@@ -967,80 +564,29 @@ def raw_to_cropped_hi_res_moving_avg(raw_image, dim, x, y, radius):
         - using moving average of 10 previous cropping locations, crop image
     '''
 
-    original_dim = raw_image.shape
-
-    def masking(mask, image, x, y, radius, dim):
-        real_y, real_x = mask.shape
-        new_y_upper = np.clip(y + radius, 0, real_y)
-        new_y_lower = np.clip(y - radius, 0, real_y)
-        new_x_upper = np.clip(x + radius, 0, real_x)
-        new_x_lower = np.clip(x - radius, 0, real_x)
-        old_y_upper = y + radius
-        old_y_lower = y - radius
-        old_x_upper = x + radius
-        old_x_lower = x - radius
-        left_patch = abs(new_x_lower - old_x_lower)
-        bottom_patch = abs(new_y_lower - old_y_lower)
-        right_patch = abs(new_x_upper - old_x_upper)
-        top_patch = abs(new_y_upper - old_y_upper)
-        # print(
-        #     'left : {}\nright : {}\ntop : {}\nbottom : {}'.format(left_patch, right_patch, top_patch, bottom_patch))
-        mask_to_patch = np.zeros((2 * radius, 2 * radius), dtype=np.uint8)
-
-        cropimg = cv2.subtract(mask, image)
-        cropimg = cv2.subtract(mask, cropimg)
-        # print('shape of cropimg is {}'.format(cropimg.shape))
-        # print('shape of mask_to_patch is {}'.format(mask_to_patch.shape))
-
-        mask_to_patch[0 + bottom_patch: 2 * radius - top_patch,
-        0 + left_patch: 2 * radius - right_patch] = cropimg[new_y_lower:new_y_upper, new_x_lower:new_x_upper]
-        # cropimg = cv2.resize(cropimg, dim, interpolation=cv2.INTER_AREA)
-        return mask_to_patch
-
-    # BGR channel
-    blue, green, red = cv2.split(raw_image)
-    img_combine_1 = red
-    img_combine_2 = blue
-    img_combine_3 = green
-
-    # Detecting ROI
-    mask = np.zeros((original_dim[0], original_dim[1]), dtype=np.uint8)
-
-    cv2.circle(mask, (x, y), radius, (255, 255, 255), -1, 8, 0)
-
-    crop_img_combine_1 = masking(mask, img_combine_1, x, y, radius, original_dim)
-    crop_img_combine_2 = masking(mask, img_combine_2, x, y, radius, original_dim)
-    crop_img_combine_3 = masking(mask, img_combine_3, x, y, radius, original_dim)
-    crop_color = cv2.merge((crop_img_combine_2, crop_img_combine_3, crop_img_combine_1))
+    crop_color = crop_disc(raw_image, x, y, radius)
 
     return crop_color, x, y, radius
 
 def RGB_comparator(inputimg, unsure_low_thresh=0.79, unsure_gap_percent=0.01):
-    IMG_WIDTH = 64
-    IMG_HEIGHT = 64
-    IMG_CHANNELS = 3
-
-    # Getting image into numpy array for prediction
-    X_env_test = np.zeros((1, IMG_HEIGHT, IMG_WIDTH, IMG_CHANNELS), dtype=np.uint8)
-    X_env_test[0] = inputimg/255
-    # setting up interpreter and inputs
-
-    # Predict colonies
-    input_data_RGB2 = input_data_RGB
-    input_data_RGB2[0] = inputimg/255
-    interpreter_RGB.set_tensor(input_details_RGB[0]['index'], input_data_RGB2)
-    interpreter_RGB.invoke()
-
-    output_data = interpreter_RGB.get_tensor(output_details_RGB[0]['index'])
+    # Predict colour, the 64x64 crop is written into the input tensor of one of the pooled interpreters
+    score = RGB_pool.run(inputimg / 255, read=lambda output: float(output[0][0]))
 
-    if output_data[0][0] > (unsure_low_thresh + unsure_gap_percent * (1 - unsure_low_thresh)):
+    if score > (unsure_low_thresh + unsure_gap_percent * (1 - unsure_low_thresh)):
         return 'overgrown/smeared'
-    elif output_data[0][0] > unsure_low_thresh:
+    elif score > unsure_low_thresh:
         return 'unsure'
     else:
         return 'normal'
 
-def analysis_image(img_name='image.jpg', result='result.jpg', predict_thresh = 0.42, print_log=False, use_avg_cropping=False, analyse_time=False, check_color_dimension=(64,64), imgsz=640):
+def reduce_ROI_radius(inputimg, percent=0.7):
+    lala = inputimg[int(((1 - percent) / 2) * inputimg.shape[0]):inputimg.shape[0] - int(
+        ((1 - percent) / 2) * inputimg.shape[0]),
+           int(((1 - percent) / 2) * inputimg.shape[0]):inputimg.shape[0] - int(
+               ((1 - percent) / 2) * inputimg.shape[0]), :]
+    return lala
+
+def analysis_image(img_name='image.jpg', result='result.jpg', predict_thresh = 0.42, print_log=False, use_avg_cropping=False, analyse_time=False, check_color_dimension=(64,64), imgsz=640, crop_strategy='hough', save_crop=False, tiled=False):
 
     # file path assertion
     if '.jpg' not in img_name[-4:] and '.png' not in img_name[-4:]:
@@ -1055,35 +601,6 @@ def analysis_image(img_name='image.jpg', result='result.jpg', predict_thresh = 0
 
     count_name = result_name[:-3] + 'txt'
 
-    def reduce_ROI_radius(inputimg, percent=0.7):
-        lala = inputimg[int(((1 - percent) / 2) * inputimg.shape[0]):inputimg.shape[0] - int(
-            ((1 - percent) / 2) * inputimg.shape[0]),
-               int(((1 - percent) / 2) * inputimg.shape[0]):inputimg.shape[0] - int(
-                   ((1 - percent) / 2) * inputimg.shape[0]), :]
-        return lala
-
-    def outlier_filter(data, m=2.):
-        """
-        :param data: the np.array with size >= 8, holding the crop location (x,y,r)
-        :param m: tolerance threshold to determine outlier, smaller 'm' = smaller tolerance
-        :return: outlier-filtered data array
-        """
-        d = np.abs(data - np.median(data))
-        mdev = np.median(d)
-
-        # mdev can sometimes be 0, so assert a small mdev to be 0.01, this prevents undefined 's' variable
-        if abs(mdev) < 0.01:
-            mdev = 0.01
-        s = d / mdev
-        return data[s < m]
-
-    def find_missing_index(running_avg_filtered, running_avg_ori):
-        index_list = []
-        for index, element in enumerate(running_avg_ori):
-            if element not in running_avg_filtered:
-                index_list.append(index)
-        return index_list
-
     if '.jpg' not in img_name[-4:] and '.png' not in img_name[-4:]:
         img_name = img_name + '.jpg'
     else:
@@ -1095,287 +612,55 @@ def analysis_image(img_name='image.jpg', result='result.jpg', predict_thresh = 0
     ##############################################################
     ############## CROPPING ######################################
     ##############################################################
-    if os.path.exists('cropped')==False:
-        os.mkdir('cropped')
     time1 = timeit.default_timer()
     if use_avg_cropping == True:
-        if os.path.exists('running_avg.txt') == True:
-            running_avg = np.loadtxt('running_avg.txt', dtype=int)
-
-            if len(running_avg) == 0:
-                # previous filtering removed all crop location ...
-                if print_log == True:
-                    print('not enough cropping position data to deduce moving average, crop no. 0')
-                if inputimg.shape[1] > 3500:
-                    cropped_out, ROI_x, ROI_y, cropped_radius = raw_to_cropped_hi_res(inputimg, (imgsz, imgsz))
-                else:
-                    cropped_out, ROI_x, ROI_y, cropped_radius = raw_to_cropped_ori_resol(inputimg, (imgsz, imgsz))
-
-                if print_log == True:
-                    print('{} : time taken to crop'.format(str(timeit.default_timer() - time1)))
-                if analyse_time == True:
-                    time_analysis['crop'] = timeit.default_timer() - time1
-
-                cropped_dimension = cropped_out.shape[0]
-                cropped = cv2.resize(cropped_out, (imgsz, imgsz), interpolation=cv2.INTER_AREA)
-                cropped_out_reduced_radius = reduce_ROI_radius(cropped, percent=0.7)
-                cropped_check_color = cv2.resize(cropped_out_reduced_radius, check_color_dimension,
-                                                 interpolation=cv2.INTER_AREA)
-                time2 = timeit.default_timer()
-                overgrown_flag = RGB_comparator(cropped_check_color)
-                if print_log == True:
-                    print('{} : time taken to RGB compare'.format(str(timeit.default_timer() - time2)))
-                if analyse_time == True:
-                    time_analysis['RGB_compare'] = timeit.default_timer() - time2
-
-                ROI_r = int(cropped_radius)
-
-                running_avg = [[0], [0], [0]]
-
-                running_avg[0].append(ROI_x)
-                running_avg[1].append(ROI_y)
-                running_avg[2].append(ROI_r)
-                running_avg = np.array(running_avg)
-                np.savetxt('running_avg.txt', running_avg, fmt='%d')
-
-                cv2.imwrite('cropped/'+str(Path(img_name).name), cropped)
-
-            # if the previous filtering reduced running_avg.txt to only single element, they will be read as a single list, the below code fixes that by reshaping
-            elif type(running_avg[0]) == np.int32:
-                running_avg = running_avg.reshape(3, 1)
-
-                if print_log == True:
-                    print('not enough cropping position data to deduce moving average, crop no. {}'.format(
-                        str(len(running_avg[0]))))
-                running_avg = [list(x) for x in running_avg]
-
-                if inputimg.shape[1] > 3500:
-                    cropped_out, ROI_x, ROI_y, cropped_radius = raw_to_cropped_hi_res(inputimg, (imgsz, imgsz))
-                else:
-                    cropped_out, ROI_x, ROI_y, cropped_radius = raw_to_cropped_ori_resol(inputimg, (imgsz, imgsz))
-
-                if print_log == True:
-                    print('{} : time taken to crop'.format(str(timeit.default_timer() - time1)))
-                if analyse_time == True:
-                    time_analysis['crop'] = timeit.default_timer() - time1
-
-                cropped_dimension = cropped_out.shape[0]
-                cropped = cv2.resize(cropped_out, (imgsz, imgsz), interpolation=cv2.INTER_AREA)
-                cropped_out_reduced_radius = reduce_ROI_radius(cropped, percent=0.7)
-                cropped_check_color = cv2.resize(cropped_out_reduced_radius, check_color_dimension,
-                                                 interpolation=cv2.INTER_AREA)
-
-                time2 = timeit.default_timer()
-                overgrown_flag = RGB_comparator(cropped_check_color)
-                if print_log == True:
-                    print('{} : time taken to RGB compare'.format(str(timeit.default_timer() - time2)))
-                if analyse_time == True:
-                    time_analysis['RGB_compare'] = timeit.default_timer() - time2
-
-                ROI_r = int(cropped_radius)
-
-                # after the 11th insert of x,y,radius, do outlier detection
-
-                running_avg[0].append(ROI_x)
-                running_avg[1].append(ROI_y)
-                running_avg[2].append(ROI_r)
-
-                running_avg = np.array(running_avg)
-                np.savetxt('running_avg.txt', running_avg, fmt='%d')
-
-                cv2.imwrite('cropped/'+str(Path(img_name).name), cropped)
-
-            # if accumulated running avg crop between 2 to 10
-            elif len(running_avg[0]) < 11:
-
-                if print_log == True:
-                    print('not enough cropping position data to deduce moving average, crop no. {}'.format(
-                        str(len(running_avg[0]))))
-                running_avg = [list(x) for x in running_avg]
-
-                if inputimg.shape[1] > 3500:
-                    cropped_out, ROI_x, ROI_y, cropped_radius = raw_to_cropped_hi_res(inputimg, (imgsz, imgsz))
-                else:
-                    cropped_out, ROI_x, ROI_y, cropped_radius = raw_to_cropped_ori_resol(inputimg, (imgsz, imgsz))
-
-                if print_log == True:
-                    print('{} : time taken to crop'.format(str(timeit.default_timer() - time1)))
-                if analyse_time == True:
-                    time_analysis['crop'] = timeit.default_timer() - time1
-
-                cropped_dimension = cropped_out.shape[0]
-                cropped = cv2.resize(cropped_out, (imgsz, imgsz), interpolation=cv2.INTER_AREA)
-                cropped_out_reduced_radius = reduce_ROI_radius(cropped, percent=0.7)
-                cropped_check_color = cv2.resize(cropped_out_reduced_radius, check_color_dimension,
-                                                 interpolation=cv2.INTER_AREA)
-
-                time2 = timeit.default_timer()
-                overgrown_flag = RGB_comparator(cropped_check_color)
-                if print_log == True:
-                    print('{} : time taken to RGB compare'.format(str(timeit.default_timer() - time2)))
-                if analyse_time == True:
-                    time_analysis['RGB_compare'] = timeit.default_timer() - time2
-
-                ROI_r = int(cropped_radius)
-
-                # after the 11th insert of x,y,radius, do outlier detection
-
-                running_avg[0].append(ROI_x)
-                running_avg[1].append(ROI_y)
-                running_avg[2].append(ROI_r)
-
-                cv2.imwrite('cropped/'+str(Path(img_name).name), cropped)
-
-
-                if len(running_avg[0]) >= 8:
-                    #################################### ROBUST ANOMALOUS CROPPING DETECTION STARTS ############################
-                    # once you have collected 8 crop location data, start measuring median + detect anomalous cropping
-                    # using m=4. is good enough to filter any outliers that are >70 from the biggest / <70 from the smallest..
-                    # use smaller m to filter away more inconsistent crop, and hence get a more well calibrated average cropping
-                    # however, this comes at the cost of more filter == more normal cropping before average cropping can be
-                    # kickstarted (once it reaches 10 accumulated values). This means longer compute time.
-                    running_avg_filter1 = outlier_filter(np.array(running_avg[0]), m=4.)
-                    running_avg_filter2 = outlier_filter(np.array(running_avg[1]), m=4.)
-                    running_avg_filter3 = outlier_filter(np.array(running_avg[2]), m=4.)
-
-                    missing_index = find_missing_index(running_avg_filter1, running_avg[0]) + find_missing_index(
-                        running_avg_filter2, running_avg[1]) + find_missing_index(running_avg_filter3, running_avg[2])
-                    missing_index = list(set(missing_index))
-
-                    missing_index = sorted(missing_index, reverse=True)
-
-                    # print('missing index is : {}'.format(str(missing_index)))
-                    # print('length of running average BEFORE removing = {}'.format(str(len(running_avg[0]))))
-
-                    for remove_index in missing_index:
-                        # print('removing anomalous cropping index : {} ######################'.format(remove_index))
-                        del running_avg[0][remove_index]
-                        del running_avg[1][remove_index]
-                        del running_avg[2][remove_index]
-
-                    # print('length of running average AFTER removing = {}'.format(str(len(running_avg[0]))))
-                    # print('running_avg after removing : {} with type : {}'.format(str(running_avg[0]), str(type(running_avg[0]))))
-
-                    #################################### ROBUST ANOMALOUS CROPPING DETECTION ENDS ############################
-
-                running_avg = np.array(running_avg)
-                np.savetxt('running_avg.txt', running_avg, fmt='%d')
-
-            # have enough running avg crop values, e.g. 11, but only use the latest 10
-            else:
-                if print_log == True:
-                    print('use moving average for cropping')
-                moving_x, moving_y, moving_r = np.average(running_avg[:, 1:], axis=1)
-
-                if inputimg.shape[1] > 3500:
-                    cropped_out, ROI_x, ROI_y, cropped_radius = raw_to_cropped_hi_res_moving_avg(inputimg, (imgsz, imgsz),
-                                                                                                 int(moving_x),
-                                                                                                 int(moving_y),
-                                                                                                 int(moving_r))
-                else:
-                    cropped_out, ROI_x, ROI_y, cropped_radius = raw_to_cropped_ori_resol_moving_avg(inputimg,
-                                                                                                    (imgsz, imgsz),
-                                                                                                    int(moving_x),
-                                                                                                    int(moving_y),
-                                                                                                    int(moving_r))
-                if print_log == True:
-                    print('{} : time taken to crop'.format(str(timeit.default_timer() - time1)))
-                if analyse_time == True:
-                    time_analysis['crop'] = timeit.default_timer() - time1
-
-                cropped_dimension = cropped_out.shape[0]
-                cropped = cv2.resize(cropped_out, (imgsz, imgsz), interpolation=cv2.INTER_AREA)
-                cropped_out_reduced_radius = reduce_ROI_radius(cropped, percent=0.7)
-                cropped_check_color = cv2.resize(cropped_out_reduced_radius, check_color_dimension,
-                                                 interpolation=cv2.INTER_AREA)
-                time2 = timeit.default_timer()
-                overgrown_flag = RGB_comparator(cropped_check_color)
-                if print_log == True:
-                    print('{} : time taken to RGB compare'.format(str(timeit.default_timer() - time2)))
-                if analyse_time == True:
-                    time_analysis['RGB_compare'] = timeit.default_timer() - time2
-
-                ROI_r = int(cropped_radius)
-
-                running_avg = running_avg[:, 1:]
-
-                running_avg = [list(x) for x in running_avg]
-
-                running_avg[0].append(ROI_x)
-                running_avg[1].append(ROI_y)
-                running_avg[2].append(ROI_r)
-
-                cv2.imwrite('cropped/'+str(Path(img_name).name), cropped)
-
-                #################################### ROBUST ANOMALOUS CROPPING DETECTION STARTS ############################
-                # using m=4. is good enough to filter any outliers that are >70 from the biggest / <70 from the smallest..
-                # use smaller m to filter away more inconsistent crop, and hence get a more well calibrated average cropping
-                # however, this comes at the cost of more filter == more normal cropping before average cropping can be
-                # kickstarted (once it reaches 10 accumulated values). This means longer compute time.
-                running_avg_filter1 = outlier_filter(np.array(running_avg[0]), m=4.)
-                running_avg_filter2 = outlier_filter(np.array(running_avg[1]), m=4.)
-                running_avg_filter3 = outlier_filter(np.array(running_avg[2]), m=4.)
-
-                missing_index = find_missing_index(running_avg_filter1, running_avg[0]) + find_missing_index(
-                    running_avg_filter2, running_avg[1]) + find_missing_index(running_avg_filter3, running_avg[2])
-                missing_index = list(set(missing_index))
-
-                missing_index = sorted(missing_index, reverse=True)
-
-                # print('missing index is : {}'.format(str(missing_index)))
-                # print('length of running average BEFORE removing = {}'.format(str(len(running_avg[0]))))
-
-                for remove_index in missing_index:
-                    # print('removing anomalous cropping index : {} ######################'.format(remove_index))
-                    del running_avg[0][remove_index]
-                    del running_avg[1][remove_index]
-                    del running_avg[2][remove_index]
-
-                # print('length of running average AFTER removing = {}'.format(str(len(running_avg[0]))))
-                # print('running_avg after removing : {} with type : {}'.format(str(running_avg[0]),
-                #                                                               str(type(running_avg[0]))))
-
-                #################################### ROBUST ANOMALOUS CROPPING DETECTION ENDS ############################
-
-                running_avg = np.array(running_avg)
-                np.savetxt('running_avg.txt', running_avg, fmt='%d')
-
-        else:
+        moving_avg = crop_calibration.estimate()
+        if moving_avg is None:
+            # not enough crop locations yet, crop with the Hough circle and remember where the dish was
             if print_log == True:
-                print('not enough cropping position data to deduce moving average, crop no. 0')
+                print('not enough cropping position data to deduce moving average, crop no. {}'.format(
+                    str(len(crop_calibration))))
             if inputimg.shape[1] > 3500:
                 cropped_out, ROI_x, ROI_y, cropped_radius = raw_to_cropped_hi_res(inputimg, (imgsz, imgsz))
             else:
                 cropped_out, ROI_x, ROI_y, cropped_radius = raw_to_cropped_ori_resol(inputimg, (imgsz, imgsz))
 
+            crop_path = 'hough (calibrating)'
+            # anomalous crop locations (median/MAD, m=4) are not stored
+            if crop_calibration.add(ROI_x, ROI_y, int(cropped_radius)) == False and print_log == True:
+                print('anomalous crop location {}, {}, {} not used for the moving average'.format(
+                    ROI_x, ROI_y, int(cropped_radius)))
+            crop_calibration.save()
+        else:
             if print_log == True:
-                print('{} : time taken to crop'.format(str(timeit.default_timer() - time1)))
-            if analyse_time == True:
-                time_analysis['crop'] = timeit.default_timer() - time1
-
-            cropped_dimension = cropped_out.shape[0]
-            cropped = cv2.resize(cropped_out, (imgsz, imgsz), interpolation=cv2.INTER_AREA)
-            cropped_out_reduced_radius = reduce_ROI_radius(cropped, percent=0.7)
-            cropped_check_color = cv2.resize(cropped_out_reduced_radius, check_color_dimension,
-                                             interpolation=cv2.INTER_AREA)
-            time2 = timeit.default_timer()
-            overgrown_flag = RGB_comparator(cropped_check_color)
-            if print_log == True:
-                print('{} : time taken to RGB compare'.format(str(timeit.default_timer() - time2)))
-            if analyse_time == True:
-                time_analysis['RGB_compare'] = timeit.default_timer() - time2
-
-            ROI_r = int(cropped_radius)
+                print('use moving average for cropping')
+            moving_x, moving_y, moving_r = moving_avg
+            crop_path = 'moving_avg'
 
-            running_avg = [[0], [0], [0]]
+            if inputimg.shape[1] > 3500:
+                cropped_out, ROI_x, ROI_y, cropped_radius = raw_to_cropped_hi_res_moving_avg(inputimg, (imgsz, imgsz),
+                                                                                             moving_x, moving_y, moving_r)
+            else:
+                cropped_out, ROI_x, ROI_y, cropped_radius = raw_to_cropped_ori_resol_moving_avg(inputimg, (imgsz, imgsz),
+                                                                                                moving_x, moving_y, moving_r)
 
-            running_avg[0].append(ROI_x)
-            running_avg[1].append(ROI_y)
-            running_avg[2].append(ROI_r)
-            running_avg = np.array(running_avg)
-            np.savetxt('running_avg.txt', running_avg, fmt='%d')
+        crop_time = timeit.default_timer() - time1
+        print('crop path: {}, {:.3f}s'.format(crop_path, crop_time))
+        if analyse_time == True:
+            time_analysis['crop'] = crop_time
+            time_analysis['crop_path'] = crop_path
 
-            cv2.imwrite('cropped/' + str(Path(img_name).name), cropped)
+        cropped_dimension = cropped_out.shape[0]
+        cropped = cv2.resize(cropped_out, (imgsz, imgsz), interpolation=cv2.INTER_AREA)
+        cropped_out_reduced_radius = reduce_ROI_radius(cropped, percent=0.7)
+        cropped_check_color = cv2.resize(cropped_out_reduced_radius, check_color_dimension,
+                                         interpolation=cv2.INTER_AREA)
+        time2 = timeit.default_timer()
+        overgrown_flag = RGB_comparator(cropped_check_color)
+        if print_log == True:
+            print('{} : time taken to RGB compare'.format(str(timeit.default_timer() - time2)))
+        if analyse_time == True:
+            time_analysis['RGB_compare'] = timeit.default_timer() - time2
 
     else:
         # This code will run if 'use_avg_cropping' is False
@@ -1389,14 +674,21 @@ def analysis_image(img_name='image.jpg', result='result.jpg', predict_thresh = 0
         
         # New cropping implementation
         im_gray = np.asarray(cv2.cvtColor(inputimg, cv2.COLOR_BGR2GRAY))
-        ROI_x,ROI_y,cropped_radius = hough_estimate(im_gray,zero=False, mm13=False, mm25=True)
+        # crop_strategy picks the dish detector, see dish_detection.crop_strategies
+        # 'adaptive' reuses the last circle while the rim has not moved and only falls back to Hough otherwise
+        ROI_x,ROI_y,cropped_radius = estimate_dish(im_gray, strategy=crop_strategy, zero=False, mm13=False, mm25=True)
+        if crop_strategy == 'adaptive':
+            crop_path = adaptive_estimator.last_path
+        else:
+            crop_path = crop_strategy
         cropped_out = crop_colour_im(inputimg,ROI_x,ROI_y,cropped_radius,zero=False) 
         
 
-        if print_log == True:
-            print('{} : time taken to crop'.format(str(timeit.default_timer() - time1)))
+        crop_time = timeit.default_timer() - time1
+        print('crop path: {}, {:.3f}s'.format(crop_path, crop_time))
         if analyse_time == True:
-            time_analysis['crop'] = timeit.default_timer() - time1
+            time_analysis['crop'] = crop_time
+            time_analysis['crop_path'] = crop_path
 
         cropped_dimension = cropped_out.shape[0]
         cropped = cv2.resize(cropped_out, (imgsz, imgsz), interpolation=cv2.INTER_AREA)
@@ -1410,12 +702,16 @@ def analysis_image(img_name='image.jpg', result='result.jpg', predict_thresh = 0
         if analyse_time == True:
             time_analysis['RGB_compare'] = timeit.default_timer() - time2
 
-        cv2.imwrite('cropped/' + str(Path(img_name).name), cropped)
-
     ##############################################################
     ############## CROPPING ENDS HER #############################
     ##############################################################
 
+    # the crop goes straight to the model, writing it out is only a debugging aid
+    if save_crop == True:
+        if os.path.exists('cropped')==False:
+            os.mkdir('cropped')
+        cv2.imwrite('cropped/' + str(Path(img_name).name), cropped)
+
     # Settings
     agnostic_nms = True
     save_txt = False
@@ -1433,13 +729,12 @@ def analysis_image(img_name='image.jpg', result='result.jpg', predict_thresh = 0
     conf_thresh = 0.17
 
     with torch.no_grad():
-        dataset = LoadImages('cropped/' + str(Path(img_name).name), img_size=imgsz, auto_size=64)
-
         # inference
         t0 = time.time()
         img = torch.zeros((1, 3, imgsz, imgsz), device=device)  # init img
         _ = model(img.half() if half else img) if device.type != 'cpu' else None  # run once
-        for path, img, im0s, vid_cap in dataset:
+        # a single in-memory image, prepared like LoadImages does
+        for path, img, im0s in [(img_name, letterbox_tensor(cropped, imgsz), cropped)]:
             img = torch.from_numpy(img).to(device)
             img = img.half() if half else img.float()  # uint8 to fp16/32
             img /= 255.0  # 0 - 255 to 0.0 - 1.0
@@ -1448,10 +743,19 @@ def analysis_image(img_name='image.jpg', result='result.jpg', predict_thresh = 0
 
             # Inference
             t1 = time_synchronized()
-            pred = model(img, augment=False)[0]
+            if tiled == True and cropped_dimension > imgsz:
+                # overlapping imgsz tiles of the full resolution crop, merged by a cross-tile NMS
+                det, n_tiles = detect_tiled(model, cropped_out, imgsz, conf_thresh, iou_thresh, device=device, half=half)
+                # back to the coordinates of the imgsz x imgsz crop the rest of the analysis works on
+                det[:, :4] *= imgsz / cropped_dimension
+                pred = [det]
+                if print_log == True:
+                    print('tiled inference: {} tiles of {}x{}'.format(n_tiles, cropped_dimension, cropped_dimension))
+            else:
+                pred = model(img, augment=False)[0]
 
-            # Apply NMS
-            pred = non_max_suppression(pred, conf_thresh, iou_thresh, classes=None, agnostic=agnostic_nms)
+                # Apply NMS
+                pred = non_max_suppression(pred, conf_thresh, iou_thresh, classes=None, agnostic=agnostic_nms)
             t2 = time_synchronized()
 
             json_data = {}
@@ -1561,16 +865,13 @@ def analysis_image(img_name='image.jpg', result='result.jpg', predict_thresh = 0
 
                 # Save results (image with detections)
                 if save_img:
-                    if dataset.mode == 'images':
-                        cv2.putText(im0, overgrown_flag,
-                                    (int(0.1*im0.shape[0]), int(0.9*im0.shape[1])),
-                                    cv2.FONT_HERSHEY_SIMPLEX,
-                                    1.0,
-                                    (255, 255, 255),
-                                    2)
-                        cv2.imwrite(save_path, im0)
-                    else:
-                        print('wrong dataset mode')
+                    cv2.putText(im0, overgrown_flag,
+                                (int(0.1*im0.shape[0]), int(0.9*im0.shape[1])),
+                                cv2.FONT_HERSHEY_SIMPLEX,
+                                1.0,
+                                (255, 255, 255),
+                                2)
+                    cv2.imwrite(save_path, im0)
 
             with open('{}.json'.format(result_name[:-4]), 'w') as f:
                 json.dump(json_data, f)
@@ -1580,9 +881,130 @@ def analysis_image(img_name='image.jpg', result='result.jpg', predict_thresh = 0
 
         print('Done. (%.3fs)' % (time.time() - t0))
 
-    os.remove('cropped/' + str(Path(img_name).name))
+    return {'e.coli': int(ecoli_count), 'coliform': int(coliform_count), 'flag': overgrown_flag,
+            'crop_path': crop_path, 'crop_time': crop_time}
+
+def list_plate_images(paths):
+    ''' expand folders (e.g. timelapse_data/<sample_ID>) into the raw plate images they hold, result images are skipped '''
+    images = []
+    for path in paths:
+        if os.path.isdir(path):
+            for extension in ('*.jpg', '*.png'):
+                images.extend(str(p) for p in sorted(Path(path).rglob(extension))
+                              if not p.stem.endswith('_result'))
+        else:
+            images.append(path)
+    return images
+
+def crop_plate(img_name, imgsz=640, check_color_dimension=(64,64), crop_strategy='hough'):
+    '''
+    Crop one raw plate image for analyse_batch, the same Hough cropping as analysis_image
+    but kept in memory.
+    :return: dict with the cropped image (imgsz x imgsz), its colour check thumbnail and the dish location
+    '''
+    time1 = timeit.default_timer()
+    inputimg = cv2.imread(img_name)
+    if inputimg is None:
+        raise IOError('cannot read {}'.format(img_name))
+    im_gray = cv2.cvtColor(inputimg, cv2.COLOR_BGR2GRAY)
+    ROI_x, ROI_y, cropped_radius = estimate_dish(im_gray, strategy=crop_strategy, zero=False, mm13=False, mm25=True)
+    cropped_out = crop_colour_im(inputimg, ROI_x, ROI_y, cropped_radius, zero=False)
+    cropped = cv2.resize(cropped_out, (imgsz, imgsz), interpolation=cv2.INTER_AREA)
+    cropped_check_color = cv2.resize(reduce_ROI_radius(cropped, percent=0.7), check_color_dimension,
+                                     interpolation=cv2.INTER_AREA)
+    return {'cropped': cropped, 'check_color': cropped_check_color, 'ROI_x': float(ROI_x), 'ROI_y': float(ROI_y),
+            'radius': float(cropped_radius), 'crop_time': timeit.default_timer() - time1}
+
+def write_records(records, output):
+    ''' write the analyse_batch records as one table, Parquet for a .parquet path and CSV otherwise '''
+    import pandas as pd
+    table = pd.DataFrame.from_records(records)
+    if output.endswith('.parquet'):
+        # needs pyarrow or fastparquet
+        table.to_parquet(output, index=False)
+    else:
+        table.to_csv(output, index=False)
+    return table
+
+def analyse_batch(paths, batch_size=4, output=None, workers=4, crop_strategy='hough', imgsz=640,
+                  check_color_dimension=(64,64), conf_thresh=0.17, iou_thresh=0.5):
+    '''
+    Analyse many plate images, e.g. an archive of timelapse_data/<sample_ID>/ folders.
 
-    return {'e.coli': ecoli_count, 'coliform': coliform_count}
+    The images are cropped and colour checked in a thread pool (OpenCV and TFLite release
+    the GIL, the colour checks share RGB_pool) and the crops are stacked into (batch_size, 3, imgsz, imgsz) tensors, so Darknet runs once per batch.
+    NMS is applied per image with the same thresholds as analysis_image. Nothing is
+    written to cropped/, the crops stay in memory.
+
+    :param paths: image files and/or folders, see list_plate_images
+    :param output: optional .csv or .parquet path for the records
+    :return: one record (dict) per image
+    '''
+    from collections import deque
+    from itertools import islice
+    from concurrent.futures import ThreadPoolExecutor
+
+    images = list_plate_images(paths)
+    records = []
+    if crop_strategy == 'adaptive':
+        # the adaptive strategy keeps one shared circle cache
+        workers = 1
+
+    def crop_or_error(img_name):
+        try:
+            crop = crop_plate(img_name, imgsz, check_color_dimension, crop_strategy)
+            # the colour check runs on the pooled interpreters, next to the cropping
+            crop['flag'] = RGB_comparator(crop['check_color'])
+            return crop
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # the pool crops the next images while the current batch is in the model, only
+        # batch_size * 2 crops (full resolution reads) are in flight or waiting at a time
+        queued = iter(images)
+        in_flight = deque(pool.submit(crop_or_error, img_name) for img_name in islice(queued, batch_size * 2))
+        for start in range(0, len(images), batch_size):
+            batch = []
+            for img_name in images[start:start + batch_size]:
+                crop = in_flight.popleft().result()
+                next_name = next(queued, None)
+                if next_name is not None:
+                    in_flight.append(pool.submit(crop_or_error, next_name))
+                record = {'image': img_name, 'sample_ID': Path(img_name).parent.name}
+                if isinstance(crop, Exception):
+                    record['error'] = str(crop)
+                    records.append(record)
+                    continue
+                record.update({k: crop[k] for k in ('ROI_x', 'ROI_y', 'radius', 'crop_time', 'flag')})
+                batch.append((record, crop['cropped']))
+                records.append(record)
+            if not batch:
+                continue
+
+            img = np.stack([letterbox_tensor(cropped, imgsz) for _, cropped in batch])
+            with torch.no_grad():
+                img = torch.from_numpy(img).to(device)
+                img = img.half() if half else img.float()  # uint8 to fp16/32
+                img /= 255.0  # 0 - 255 to 0.0 - 1.0
+
+                t1 = time_synchronized()
+                pred = model(img, augment=False)[0]
+                pred = non_max_suppression(pred, conf_thresh, iou_thresh, classes=None, agnostic=True)
+                inference_time = (time_synchronized() - t1) / len(batch)
+
+            for (record, _), det in zip(batch, pred):
+                classes = det[:, -1] if det is not None else torch.zeros(0)
+                record['e.coli'] = int((classes == 0).sum())
+                record['coliform'] = int((classes == 1).sum())
+                record['inference_time'] = inference_time
+                print('{}: {} E. coli, {} coliforms, {}'.format(record['image'], record['e.coli'],
+                                                                  record['coliform'], record['flag']))
+
+    if output is not None:
+        write_records(records, output)
+        print('Results saved to %s' % output)
+    return records
 
 # Settings
 cfg = 'yolor_pi/inference_script/yolor_p6small_filter'
@@ -1591,38 +1013,65 @@ names = 'yolor_pi/inference_script/yolor.names'
 
 imgsz = 640
 
+# YOLOR inference backend: 'eager' (Darknet), 'torchscript', 'onnx' (onnxruntime) or 'int8' (qnnpack, built by
+# yolor_quantize.py), see yolor_model.load_backend
+inference_backend = 'eager'
+# exported graph used by the other backends, torchscript/onnx are written on first use if missing
+# (None -> yolor_640.torchscript.pt, yolor_640.onnx or yolor_640_int8.torchscript.pt)
+exported_model = None
+# compare the fused and folded model with the original at boot (a deep copy and two extra forwards), the
+# export and benchmark in yolor_model.py always check it
+check_prepared_model = False
+
 time_analysis = {}
 
+# moving-average crop locations, kept in memory and flushed to crop_calibration.json
+crop_calibration = CropCalibration().load()
+
 # MODEL SETTINGS
 RGB_model_path = '2022_April_19_RGB.tflite' #'RGB_CNN_model.tflite'
+RGB_pool_size = 4  # colour checks that can run at the same time, one per cropping thread of analyse_batch
+RGB_num_threads = 1  # the 64x64 model is too small to split across cores
 
 # LOAD RGB ML MODEL
-# define model
-interpreter_RGB = Interpreter(model_path='{}'.format(RGB_model_path))
-# interpreter = tf.lite.Interpreter(
-#     model_path='{}.tflite'.format(model_to_check))
-interpreter_RGB.allocate_tensors()
-
-# Get input and output tensors.
-input_details_RGB = interpreter_RGB.get_input_details()
-output_details_RGB = interpreter_RGB.get_output_details()
-
-# # Test the model on random input data.
-input_shape_RGB = input_details_RGB[0]['shape']
-input_data_RGB = np.array(np.random.random_sample(input_shape_RGB), dtype=np.float32)
+# one interpreter per concurrent RGB_comparator call
+RGB_pool = InterpreterPool(RGB_model_path, size=RGB_pool_size, num_threads=RGB_num_threads)
 
 with torch.no_grad():
     # Initialize
     device = select_device('cpu')
     half = device.type != 'cpu'
 
-    # Load model
-    model = Darknet(cfg, imgsz).cpu()
-    model.load_state_dict(torch.load(weights[0], map_location=device)['model'])
-    model.to(device).eval()
+    # Load model, fused and folded for inference
+    model = load_model(cfg, weights[0], imgsz, device=device, check=check_prepared_model)
     if half:
         model.half()
+    # optionally run the traced graph instead of the layer by layer Darknet forward
+    model = load_backend(inference_backend, model, exported_model, imgsz)
 
     # Get names and box plotting colors
     names = load_classes(names)
     colors = [[0, 255, 0], [0, 255, 255]]
+
+
+def warm_up():
+    ''' run one dummy pass through both models so the first real sample does not pay for lazy allocation '''
+    RGB_pool.warm_up()
+    with torch.no_grad():
+        img = torch.zeros((1, 3, imgsz, imgsz), device=device)
+        model(img.half() if half else img)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='count colonies on archived plate images')
+    parser.add_argument('paths', nargs='+', help='plate images or folders, e.g. timelapse_data/<sample_ID>')
+    parser.add_argument('--batch-size', type=int, default=4, help='images per Darknet forward pass')
+    parser.add_argument('--workers', type=int, default=4, help='cropping threads')
+    parser.add_argument('--crop-strategy', default='hough', help='dish detector, see dish_detection.crop_strategies')
+    parser.add_argument('--output', default='analysis_batch.csv', help='.csv or .parquet table of the results')
+    args = parser.parse_args()
+
+    start = time.time()
+    records = analyse_batch(args.paths, batch_size=args.batch_size, output=args.output, workers=args.workers,
+                            crop_strategy=args.crop_strategy)
+    print('{} images in {:.1f}s'.format(len(records), time.time() - start))
@@ -0,0 +1,167 @@
+'''
+Crop calibration store for the moving-average cropping.
+
+Keeps the last crop locations (x, y, radius) found by the Hough cropping in a fixed-size
+ring buffer. A new location is rejected when it is an outlier (median/MAD test, as the
+old running_avg.txt filtering did) and the average crop is recomputed once per insert,
+so looking it up is O(1). The state lives in memory and is flushed to a JSON file with
+an atomic replace, so a power cut while writing leaves either the old or the new file.
+'''
+
+import os
+import json
+import tempfile
+from collections import deque
+
+import numpy as np
+
+# Settings
+calibration_path = 'crop_calibration.json'
+legacy_path = 'running_avg.txt'
+
+
+def outlier_mask(data, m=4.):
+    """
+    :param data: np.array holding one coordinate of the crop locations
+    :param m: tolerance threshold to determine outlier, smaller 'm' = smaller tolerance
+    :return: boolean array, True for the values that are kept
+    """
+    d = np.abs(data - np.median(data))
+    mdev = np.median(d)
+    # mdev can sometimes be 0, so assert a small mdev to be 0.01
+    if abs(mdev) < 0.01:
+        mdev = 0.01
+    return d / mdev < m
+
+
+def atomic_write(path, text):
+    ''' write text to path through a temporary file in the same directory and os.replace '''
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path), suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    # make the rename itself durable
+    if hasattr(os, 'O_DIRECTORY'):
+        dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+class CropCalibration(object):
+    '''
+    Ring buffer of the latest crop locations.
+
+    capacity -> number of crop locations averaged, the moving-average crop is used once the buffer is full
+    min_samples -> outlier rejection starts once this many locations are stored
+    m -> median/MAD tolerance of the outlier rejection
+    '''
+
+    def __init__(self, path=calibration_path, capacity=10, min_samples=7, m=4.):
+        self.path = path
+        self.capacity = capacity
+        self.min_samples = min_samples
+        self.m = m
+        self.samples = deque(maxlen=capacity)
+        self.rejected = 0
+        self._estimate = None
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, x, y, r):
+        ''' store a crop location found by the Hough cropping, return False if it was rejected as outlier '''
+        location = (int(x), int(y), int(r))
+        if len(self.samples) >= self.min_samples:
+            data = np.array(list(self.samples) + [location], dtype=float)
+            keep = np.all([outlier_mask(data[:, i], m=self.m) for i in range(3)], axis=0)
+            if not keep[-1]:
+                self.rejected += 1
+                if self.rejected > self.capacity:
+                    # the dish keeps turning up somewhere else, the stored locations are stale
+                    print('crop location moved, restarting the crop calibration')
+                    self.samples.clear()
+                else:
+                    return False
+        self.rejected = 0
+        self.samples.append(location)
+        self._update()
+        return True
+
+    def _update(self):
+        if len(self.samples) < self.capacity:
+            self._estimate = None
+        else:
+            x, y, r = np.average(np.array(self.samples, dtype=float), axis=0)
+            self._estimate = (int(x), int(y), int(r))
+
+    def estimate(self):
+        ''' averaged crop location (x, y, r), None until enough locations are collected '''
+        return self._estimate
+
+    def reset(self):
+        self.samples.clear()
+        self.rejected = 0
+        self._update()
+
+    def save(self):
+        atomic_write(self.path, json.dumps({
+            'capacity': self.capacity,
+            'samples': [list(location) for location in self.samples],
+        }))
+
+    def load(self):
+        ''' restore the saved state, migrating running_avg.txt when there is no calibration file yet '''
+        self.samples.clear()
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    self.samples.extend(tuple(location) for location in json.load(f)['samples'])
+            except (ValueError, KeyError, TypeError) as e:
+                print('ignoring unreadable crop calibration {}: {}'.format(self.path, e))
+                self.samples.clear()
+        elif os.path.exists(legacy_path):
+            self.samples.extend(load_running_avg(legacy_path))
+            self.save()
+        self._update()
+        return self
+
+
+def load_running_avg(path=legacy_path):
+    ''' crop locations stored by the old moving-average cropping (3 rows: x, y, radius, padded with a 0 column) '''
+    running_avg = np.loadtxt(path, dtype=int, ndmin=2)
+    if running_avg.shape[0] != 3:
+        return []
+    return [tuple(int(v) for v in location) for location in running_avg.T if any(location)]
+
+
+if __name__ == '__main__':
+    import time
+
+    # the moving average should come from inliers only and survive a reload
+    path = os.path.join(tempfile.mkdtemp(), calibration_path)
+    calibration = CropCalibration(path)
+    locations = [(1296 + i % 3, 972 - i % 2, 870 + i % 4) for i in range(9)]
+    for location in locations[:7]:
+        assert calibration.add(*location)
+    assert not calibration.add(1600, 972, 870), 'outlier accepted'
+    for location in locations[7:]:
+        assert calibration.add(*location)
+    calibration.add(1297, 971, 872)
+    calibration.save()
+    assert calibration.estimate() is not None
+    assert CropCalibration(path).load().estimate() == calibration.estimate()
+
+    start = time.time()
+    for _ in range(10000):
+        calibration.estimate()
+    print('estimate {} in {:.2f} us'.format(calibration.estimate(), (time.time() - start) * 100))
@@ -0,0 +1,185 @@
+'''
+Shared circular crop for the colony analysis.
+
+The masks are only built inside the bounding square of the circle. The last two masks
+at integer positions are cached, so repeated crops at a calibrated location do not
+rebuild them, the float Hough circles never repeat and are not cached. All channels are masked in one pass straight from a view of the input
+image, without splitting and merging the channels.
+
+crop_circle() matches crop_colour_im/apply_crop (Euclidean distance <= r, window
+clipped to the image) and crop_disc() matches the cv2.circle + 2r x 2r canvas masking
+of the raw_to_cropped_* functions, both bit for bit.
+'''
+
+import time
+from functools import lru_cache
+
+import cv2
+import numpy as np
+
+
+@lru_cache(maxsize=2)
+def circle_window_mask(h, w, x, y, r):
+    ''' 0/1 mask of the pixels within r of (x, y), only for the clipped bounding square
+
+    :return: (mask, (yl, yu, xl, xu)) where the mask covers image[yl:yu, xl:xu]
+    '''
+    yl = max(int(y - r), 0)
+    yu = min(int(y + r), h)
+    xl = max(int(x - r), 0)
+    xu = min(int(x + r), w)
+
+    Y, X = np.ogrid[yl:yu, xl:xu]
+    dist_from_center = np.sqrt((X - x)**2 + (Y - y)**2)
+    mask = (dist_from_center <= r).astype(np.uint8)
+    mask.setflags(write=False)
+    return mask, (yl, yu, xl, xu)
+
+
+@lru_cache(maxsize=8)
+def disc(radius):
+    ''' filled cv2.circle of the given radius on a (2r+1) x (2r+1) canvas '''
+    canvas = np.zeros((2 * radius + 1, 2 * radius + 1), dtype=np.uint8)
+    cv2.circle(canvas, (radius, radius), radius, (255, 255, 255), -1, 8, 0)
+    canvas.setflags(write=False)
+    return canvas
+
+
+@lru_cache(maxsize=2)
+def disc_window_mask(h, w, x, y, radius):
+    ''' cv2.circle mask for the 2r x 2r window around (x, y), 0 where the window leaves the image
+
+    :return: (mask, (yl, yu, xl, xu)) where the valid part of the window is image[yl:yu, xl:xu]
+    '''
+    # window pixel (i, j) is image pixel (y - radius + i, x - radius + j), just like disc()
+    yl = min(max(y - radius, 0), h)
+    yu = min(max(y + radius, 0), h)
+    xl = min(max(x - radius, 0), w)
+    xu = min(max(x + radius, 0), w)
+
+    mask = np.zeros((2 * radius, 2 * radius), dtype=np.uint8)
+    top, left = yl - (y - radius), xl - (x - radius)
+    window = (slice(top, top + yu - yl), slice(left, left + xu - xl))
+    mask[window] = disc(radius)[window]
+    mask.setflags(write=False)
+    return mask, (yl, yu, xl, xu)
+
+
+def crop_circle(im, x, y, r):
+    ''' Circular crop of a grey or colour image, same output as apply_crop on every channel '''
+    h, w = im.shape[:2]
+    if all(float(v).is_integer() for v in (x, y, r)):
+        mask, (yl, yu, xl, xu) = circle_window_mask(h, w, int(x), int(y), int(r))
+    else:
+        mask, (yl, yu, xl, xu) = circle_window_mask.__wrapped__(h, w, x, y, r)
+
+    # copyTo zero-fills the new array outside the mask
+    return cv2.copyTo(im[yl:yu, xl:xu], mask)
+
+
+def crop_disc(im, x, y, radius):
+    ''' Circular crop onto a 2r x 2r canvas, same output as the cv2.circle/cv2.subtract masking '''
+    x, y, radius = int(x), int(y), int(radius)
+    h, w = im.shape[:2]
+    mask, (yl, yu, xl, xu) = disc_window_mask(h, w, x, y, radius)
+
+    if (yu - yl, xu - xl) == mask.shape:
+        return cv2.copyTo(im[yl:yu, xl:xu], mask)
+
+    # the circle leaves the image, the outside part of the canvas stays black
+    cropped = np.zeros((2 * radius, 2 * radius) + im.shape[2:], dtype=im.dtype)
+    top, left = yl - (y - radius), xl - (x - radius)
+    window = (slice(top, top + yu - yl), slice(left, left + xu - xl))
+    cropped[window] = cv2.copyTo(im[yl:yu, xl:xu], mask[window])
+    return cropped
+
+
+# Reference implementations, kept only to check and benchmark the crops above
+
+
+def _legacy_crop_colour_im(im, x, y, r):
+    def apply_crop(im, x, y, r):
+        h, w = np.shape(im)
+        Y, X = np.ogrid[:h, :w]
+        mask = np.sqrt((X - x)**2 + (Y - y)**2) <= r
+        im[~mask] = 0
+        yl, yu, xl, xu = max(int(y - r), 0), min(int(y + r), h), max(int(x - r), 0), min(int(x + r), w)
+        return im[yl:yu, xl:xu]
+
+    red, g, b = cv2.split(im)
+    return cv2.merge((apply_crop(red, x, y, r), apply_crop(g, x, y, r), apply_crop(b, x, y, r)))
+
+
+def _legacy_crop_disc(raw_image, x, y, radius):
+    def masking(mask, image, x, y, radius):
+        real_y, real_x = mask.shape
+        new_y_upper = np.clip(y + radius, 0, real_y)
+        new_y_lower = np.clip(y - radius, 0, real_y)
+        new_x_upper = np.clip(x + radius, 0, real_x)
+        new_x_lower = np.clip(x - radius, 0, real_x)
+        left_patch = abs(new_x_lower - (x - radius))
+        bottom_patch = abs(new_y_lower - (y - radius))
+        right_patch = abs(new_x_upper - (x + radius))
+        top_patch = abs(new_y_upper - (y + radius))
+        mask_to_patch = np.zeros((2 * radius, 2 * radius), dtype=np.uint8)
+        cropimg = cv2.subtract(mask, image)
+        cropimg = cv2.subtract(mask, cropimg)
+        mask_to_patch[0 + bottom_patch: 2 * radius - top_patch,
+        0 + left_patch: 2 * radius - right_patch] = cropimg[new_y_lower:new_y_upper, new_x_lower:new_x_upper]
+        return mask_to_patch
+
+    blue, green, red = cv2.split(raw_image)
+    mask = np.zeros(raw_image.shape[:2], dtype=np.uint8)
+    cv2.circle(mask, (x, y), radius, (255, 255, 255), -1, 8, 0)
+    return cv2.merge((masking(mask, blue, x, y, radius),
+                      masking(mask, green, x, y, radius),
+                      masking(mask, red, x, y, radius)))
+
+
+def benchmark(img, repeat=5):
+    ''' check the crops against the reference implementations and time both '''
+    h, w = img.shape[:2]
+    circles = [(w / 2, h / 2, 0.8 * 900 * h / 1944), (w // 2, h // 2, int(h * 0.4)),
+               (np.float32(w * 0.52), np.float32(h * 0.47), np.float32(0.8) * np.float32(h * 0.45)),
+               (40.5, h - 30.25, h / 3)]
+    discs = [(w // 2, h // 2, int(h * 0.45)), (w // 3, h // 2, int(h * 0.49)), (30, h - 20, h // 3)]
+
+    for name, new, legacy, cases in (('crop_circle', crop_circle, _legacy_crop_colour_im, circles),
+                                     ('crop_disc', crop_disc, _legacy_crop_disc, discs)):
+        for case in cases:
+            assert np.array_equal(new(img, *case), legacy(img, *case)), '{} differs for {}'.format(name, case)
+
+        start = time.time()
+        for _ in range(repeat):
+            for case in cases:
+                legacy(img, *case)
+        legacy_time = (time.time() - start) / (repeat * len(cases))
+
+        # first crop at a location builds the mask, later ones at the same integer position reuse it
+        start = time.time()
+        for _ in range(repeat):
+            for case in cases:
+                circle_window_mask.cache_clear()
+                disc_window_mask.cache_clear()
+                disc.cache_clear()
+                new(img, *case)
+        cold_time = (time.time() - start) / (repeat * len(cases))
+
+        start = time.time()
+        for _ in range(repeat):
+            for case in cases:
+                new(img, *case)
+        cached_time = (time.time() - start) / (repeat * len(cases))
+
+        print('{}: identical, legacy {:.1f} ms, new {:.1f} ms ({:.1f}x), repeated {:.1f} ms ({:.1f}x)'.format(
+            name, legacy_time * 1000, cold_time * 1000, legacy_time / cold_time,
+            cached_time * 1000, legacy_time / cached_time))
+
+
+if __name__ == '__main__':
+    import sys
+
+    path = sys.argv[1] if len(sys.argv) > 1 else 'yolor_pi/inference_script/images/sample11_low_res.jpg'
+    img = cv2.imread(path)
+    # the camera captures are 2592x1944, benchmark at that resolution
+    benchmark(cv2.resize(img, (2592, 1944), interpolation=cv2.INTER_LINEAR))
@@ -0,0 +1,459 @@
+'''
+asyncio instruction server of the Bluetooth connection.
+
+bluetooth_loop used to read one instruction and run its handler to the end before reading
+the next one. A sample submission runs capture, incubation and analysis inline, with
+its time.sleep calls, so 'diagnostics' and 'history' went unanswered for minutes.
+
+DeviceServer reads every connection in an asyncio task and hands each instruction to
+the handler that router(instruction, payload) picks. The router also names the executor
+that runs the handler:
+
+    'quick'   short requests (diagnostics, history, a sample lookup), several at a time
+    'sample'  capture and analysis, one plate at a time
+    'stream'  handlers that read the raw stream (file transfers, the update file), they
+              get the bytes of the connection to themselves until they return
+
+The handlers are the blocking functions of autofocus.py. They get a ThreadChannel, which
+has the Channel interface of bluetooth_protocol.py and goes through the event loop. The
+payload is read and checked before the handler starts (the 'invalid' retries included),
+and read_payload() gets it from the channel as before.
+
+Progress updates (autofocus.send_sample_update) go through push_update() into a queue.
+The session sends them as 'sample' instructions and waits for the acknowledgement of
+the app, while the analysis carries on. Responses of the app to these instructions
+(IDs starting with 'w') resolve the pending update instead of being handled as
+instructions.
+
+`python device_server.py` submits a simulated analysis over a local socket and times the
+'diagnostics' round trips during it, for this server and for the sequential loop.
+'''
+
+import asyncio
+import hashlib
+import itertools
+import json
+import logging
+import socket
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from bluetooth_protocol import Channel, MessageParser, ProtocolError, encode, payload_size, payload_validation, recv_size
+
+# Settings
+quick_workers = 2
+update_timeout = 5  # seconds the app gets to acknowledge a sample update
+update_attempts = 3
+payload_retries = 5
+
+sender_ids = itertools.count(1)
+
+
+class ThreadChannel(Channel):
+    '''
+    the Channel of a handler running in an executor thread, reads come from the bytes the session
+    forwards while the handler owns the stream, writes are scheduled on the event loop
+    '''
+
+    def __init__(self, session, payload=b''):
+        self.session = session
+        self.parser = MessageParser()
+        self.parser.feed(payload)
+        self.timeout = None
+        self.incoming = []
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def feed(self, data):
+        ''' called on the event loop thread '''
+        if not data:
+            return
+        with self.condition:
+            self.incoming.append(data)
+            self.condition.notify_all()
+
+    def close_stream(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def fill(self):
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.incoming or self.closed, self.timeout):
+                raise socket.timeout('timed out')
+            if not self.incoming:
+                raise ConnectionError('connection closed')
+            data = b''.join(self.incoming)
+            self.incoming.clear()
+        self.parser.feed(data)
+
+    def read_message(self):
+        while True:
+            header = super(ThreadChannel, self).read_message()
+            if not str(header.get('id')).startswith('w') or str(header['id']) not in self.session.pending:
+                return header
+            # the app acknowledging a sample update while this handler owns the stream
+            self.read_payload(header)
+            self.session.loop.call_soon_threadsafe(self.session.resolve, header)
+
+    def recv_into(self, view):
+        if self.parser.buffer:
+            return super(ThreadChannel, self).recv_into(view)
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.incoming or self.closed, self.timeout):
+                raise socket.timeout('timed out')
+            if not self.incoming:
+                return 0
+            chunk = memoryview(self.incoming[0])
+            n = min(len(view), len(chunk))
+            view[:n] = chunk[:n]
+            if n < len(chunk):
+                self.incoming[0] = chunk[n:]
+            else:
+                self.incoming.pop(0)
+            return n
+
+    def leftover(self):
+        ''' bytes received but not read by the handler, once it returned '''
+        with self.condition:
+            return bytes(self.parser.buffer) + b''.join(self.incoming)
+
+    def send_message(self, header, payload=None):
+        self.session.call(self.session.send_message(header, payload))
+
+    def sendall(self, data):
+        self.session.call(self.session.write(data))
+
+    def sendfile(self, file, offset=0, count=None):
+        file.seek(offset)
+        data = file.read(count) if count is not None else file.read()
+        self.sendall(data)
+        return len(data)
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def push_update(self, sample_id, sample_status, result=None):
+        self.session.push_update(sample_id, sample_status, result)
+
+    def close(self):
+        self.session.call(self.session.close())
+
+
+class Session(object):
+    ''' one connected app: the reading task, the update queue and the instructions waiting for the app '''
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+        self.parser = MessageParser()
+        self.retry = None  # (instruction, tries) while a payload is resent after 'invalid'
+        self.owner = None  # ThreadChannel of the handler owning the stream
+        self.write_lock = asyncio.Lock()
+        self.stream_lock = asyncio.Lock()
+        self.pending = {}
+        self.updates = asyncio.Queue()
+        self.tasks = set()
+
+    async def write(self, data):
+        if self.writer.is_closing():
+            raise ConnectionError('connection closed')
+        async with self.write_lock:
+            self.writer.write(data)
+            await self.writer.drain()
+
+    async def send_message(self, header, payload=None):
+        await self.write(encode(header, payload, framed=self.parser.framed == True))
+
+    async def send_response(self, instruction, status='ok', payload=None):
+        await self.send_message({
+            'id': instruction['id'],
+            'instruction': instruction['instruction'],
+            'status': status,
+            'payload': payload_validation(payload)
+        }, payload)
+
+    async def close(self):
+        self.writer.close()
+
+    def call(self, coroutine):
+        ''' run a coroutine on the event loop from a handler thread and wait for it '''
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def push_update(self, sample_id, sample_status, result=None):
+        ''' queue a sample update, safe from any thread, the caller does not wait for the app '''
+        logging.info(f'Sample #{sample_id} reached status "{sample_status}".')
+        self.loop.call_soon_threadsafe(self.updates.put_nowait, (sample_id, sample_status, result))
+
+    async def send_instruction(self, instruction_name, payload=None):
+        ''' send an instruction to the app and wait for its response '''
+        # 'w' as every device ID, 'wu' keeps them apart from the IDs of autofocus.send_instruction
+        id = 'wu' + str(next(sender_ids))
+        future = self.loop.create_future()
+        self.pending[id] = future
+        try:
+            await self.send_message({
+                'id': id,
+                'instruction': instruction_name,
+                'payload': payload_validation(payload)
+            }, payload)
+            return await asyncio.wait_for(future, update_timeout)
+        finally:
+            self.pending.pop(id, None)
+
+    def resolve(self, response):
+        ''' hand the response of the app to the instruction waiting for it '''
+        id = str(response['id'])
+        future = self.pending.get(id)
+        if future is None or future.done():
+            logging.warning(f'Received response for timed out instruction "{response["instruction"]}" with ID "{id}".')
+        else:
+            future.set_result(response)
+
+    async def send_updates(self):
+        while True:
+            sample_id, sample_status, result = await self.updates.get()
+            payload = json.dumps({'id': sample_id, 'status': sample_status, 'result': result}).encode('utf-8')
+            for attempt in range(update_attempts):
+                try:
+                    response = await self.send_instruction('sample', payload)
+                except asyncio.TimeoutError:
+                    logging.error(f'Update "{sample_status}" of sample #{sample_id} timed out.')
+                    continue
+                if response.get('status') == 'ok':
+                    break
+                if response.get('status') != 'invalid':
+                    logging.error(f'Update "{sample_status}" of sample #{sample_id} '
+                                  f'failed with status {response.get("status")}.')
+                    break
+                logging.warning(f'Retrying update "{sample_status}" of sample #{sample_id}.')
+
+    def start(self, coroutine):
+        task = self.loop.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def run(self):
+        updates = self.loop.create_task(self.send_updates())
+        try:
+            while True:
+                data = await self.reader.read(recv_size)
+                if not data:
+                    break
+                if self.owner is not None:
+                    self.owner.feed(data)
+                else:
+                    self.parser.feed(data)
+                    await self.dispatch_all()
+        finally:
+            updates.cancel()
+            if self.owner is not None:
+                self.owner.close_stream()
+            for future in self.pending.values():
+                future.cancel()
+            self.writer.close()
+
+    async def next_instruction(self):
+        ''' next instruction with a verified payload, None while it is incomplete '''
+        while True:
+            if self.retry is not None:
+                instruction, tries = self.retry
+                payload = self.parser.take(payload_size(instruction))
+                if payload is None:
+                    return None
+            else:
+                message = self.parser.next_message()
+                if message is None:
+                    return None
+                instruction, payload = message
+                tries = 0
+            self.retry = None
+            checksum = (instruction.get('payload') or {}).get('checksum')
+            if 'instruction' not in instruction or not payload or hashlib.sha1(payload).hexdigest() == checksum:
+                return instruction, payload
+            if tries < payload_retries:
+                logging.info(f'Payload checksum does not match. Retry #{tries + 1}.')
+                self.retry = (instruction, tries + 1)
+                await self.send_response(instruction, status='invalid')
+            else:
+                logging.error(f'Payload checksum are not match after retry #{tries} still. Aborting.')
+                await self.send_response(instruction, status='failed')
+
+    async def dispatch_all(self):
+        while self.owner is None:
+            try:
+                message = await self.next_instruction()
+            except ProtocolError as e:
+                logging.warning(f'Received invalid instruction, {e}. The android app might need to be updated.')
+                continue
+            if message is None:
+                return
+            await self.dispatch(*message)
+
+    async def dispatch(self, instruction, payload):
+        logging.debug(f'Instruction received.\n{json.dumps(instruction, indent=4)}')
+        if 'instruction' not in instruction:
+            logging.warning('Ignoring payload received as instruction. An instruction got skipped most likely.')
+            return
+
+        if str(instruction.get('id')).startswith('w'):
+            self.resolve(instruction)
+            return
+
+        handler, executor = self.server.router(instruction, payload)
+        if handler is None:
+            logging.warning('Unavailable instruction received.')
+            await self.send_response(instruction, status=f'Instruction "{instruction["instruction"]}" not supported')
+            return
+        self.start(self.run_handler(handler, executor, instruction, payload))
+
+    async def run_handler(self, handler, executor, instruction, payload):
+        channel = ThreadChannel(self, payload)
+        try:
+            if executor == 'stream':
+                async with self.stream_lock:
+                    # the bytes after the last dispatched message belong to the handler from now on
+                    self.owner = channel
+                    channel.feed(bytes(self.parser.buffer))
+                    del self.parser.buffer[:]
+                    try:
+                        await self.loop.run_in_executor(self.server.executors[executor], handler, channel, instruction)
+                    finally:
+                        self.owner = None
+                        self.parser.feed(channel.leftover())
+                        await self.dispatch_all()
+            else:
+                await self.loop.run_in_executor(self.server.executors[executor], handler, channel, instruction)
+        except (ConnectionError, TimeoutError, socket.timeout):
+            logging.info(f'Instruction "{instruction["instruction"]}" ended with the connection.')
+        except Exception as e:
+            logging.error(f'Instruction "{instruction["instruction"]}" failed.\n{e}\n\n{traceback.format_exc()}')
+
+
+class DeviceServer(object):
+    '''
+    router -> callable (instruction, payload) returning (handler, executor name), (None, None) for
+    unsupported instructions, the handler is called as handler(channel, instruction)
+    '''
+
+    def __init__(self, router, quick_workers=quick_workers):
+        self.router = router
+        self.executors = {
+            'quick': ThreadPoolExecutor(quick_workers, thread_name_prefix='quick'),
+            'sample': ThreadPoolExecutor(1, thread_name_prefix='sample'),
+            'stream': ThreadPoolExecutor(1, thread_name_prefix='stream'),
+        }
+
+    async def handle_connection(self, reader, writer):
+        address = writer.get_extra_info('peername')
+        logging.info(f'Established connection with {address}.')
+        await Session(self, reader, writer).run()
+        logging.info(f'Connection with {address} lost.')
+
+    async def serve(self, sock):
+        ''' accept connections on a bound, listening socket (RFCOMM on the device) forever '''
+        server = await asyncio.start_server(self.handle_connection, sock=sock)
+        async with server:
+            await server.serve_forever()
+
+
+def _legacy_serve(sock, router):
+    ''' the sequential loop of the old bluetooth_loop, one instruction after the other '''
+    connection = _LegacyChannel(sock.accept()[0])
+    try:
+        while True:
+            instruction = connection.read_message()
+            if str(instruction['id']).startswith('w'):
+                connection.read_payload(instruction)
+                continue
+            handler, _ = router(instruction, None)
+            handler(connection, instruction)
+    except ConnectionError:
+        pass
+
+
+class _LegacyChannel(Channel):
+
+    def push_update(self, sample_id, sample_status, result=None):
+        payload = json.dumps({'id': sample_id, 'status': sample_status, 'result': result}).encode('utf-8')
+        self.send_message({'id': 'w' + str(next(sender_ids)), 'instruction': 'sample',
+                           'payload': payload_validation(payload)}, payload)
+
+
+def _simulated_router(analysis_time):
+    import time
+
+    def respond(connection, instruction, payload=None):
+        connection.send_message({'id': instruction['id'], 'instruction': instruction['instruction'],
+                                 'status': 'ok', 'payload': payload_validation(payload)}, payload)
+
+    def diagnostics(connection, instruction):
+        respond(connection, instruction, json.dumps({'temperature': 36.5}).encode('utf-8'))
+
+    def submit(connection, instruction):
+        data = json.loads(connection.read_payload(instruction))
+        respond(connection, instruction)
+        for status in ('analysing', 'autofocusing', 'counting'):
+            connection.push_update(data['id'], status)
+            time.sleep(analysis_time / 3.)
+        connection.push_update(data['id'], 'result', {'eColiform': 3, 'otherColiform': 7})
+
+    def router(instruction, payload):
+        if instruction['instruction'] == 'diagnostics':
+            return diagnostics, 'quick'
+        if instruction['instruction'] == 'sample':
+            return submit, 'sample'
+        return None, None
+    return router
+
+
+def _simulated_app(address, duration, interval=0.1):
+    ''' submit a sample, then request diagnostics every interval and time the answers '''
+    import time
+
+    channel = Channel(socket.create_connection(address))
+    payload = json.dumps({'action': 'submit', 'id': 1}).encode('utf-8')
+    channel.send_message({'id': 1, 'instruction': 'sample', 'payload': payload_validation(payload)}, payload)
+    latencies = []
+    updates = []
+    start = time.time()
+    id = 1
+    while time.time() - start < duration:
+        id += 1
+        sent = time.time()
+        channel.send_message({'id': id, 'instruction': 'diagnostics', 'payload': payload_validation(None)})
+        while True:
+            message = channel.read_message()
+            data = channel.read_payload(message)
+            if str(message['id']).startswith('w'):
+                updates.append(json.loads(data)['status'])
+                channel.send_message({'id': message['id'], 'instruction': 'sample', 'status': 'ok',
+                                      'payload': payload_validation(None)})
+            elif message['id'] == id:
+                latencies.append(time.time() - sent)
+                break
+        time.sleep(interval)
+    channel.close()
+    return latencies, updates
+
+
+if __name__ == '__main__':
+    analysis_time = 3.
+    for name in ('sequential loop', 'asyncio server'):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(1)
+        router = _simulated_router(analysis_time)
+        if name == 'asyncio server':
+            target, args = asyncio.run, (DeviceServer(router).serve(sock),)
+        else:
+            target, args = _legacy_serve, (sock, router)
+        threading.Thread(target=target, args=args, daemon=True).start()
+        latencies, updates = _simulated_app(sock.getsockname(), duration=analysis_time + 0.5)
+        latencies.sort()
+        print('{:16s} {:3d} diagnostics during a {:.0f}s analysis: median {:7.1f} ms, max {:7.1f} ms, updates {}'.format(
+            name, len(latencies), analysis_time, 1000 * latencies[len(latencies) // 2], 1000 * latencies[-1],
+            ', '.join(updates)))
@@ -0,0 +1,381 @@
+'''
+Petri dish detection for the colony analysis.
+
+hough_estimate() is the original detector: a rough empirical crop, then contrast
+equalisation, a 111x111 blur, Canny, a convex hull and 310x310 morphology, all at full
+sensor resolution, before cv2.HoughCircles. multiscale_estimate() runs the same
+blur and morphology on a 4-8x downsampled frame, replaces the skimage convex hull by
+cv2.convexHull and only goes back to full resolution for the edges and the Hough
+transform, restricted to the rim band.
+
+AdaptiveDishEstimator keeps the last location found and only runs the detector again
+when the rim profile around that location no longer matches (the dish was moved).
+
+The strategies are selected by name through estimate_dish(), see crop_strategies.
+'''
+
+import time
+
+import cv2
+import numpy as np
+import skimage
+import skimage.morphology
+
+
+def rough_crop_estimate(im,zero=False, mm13=False, mm25=True):
+    """ Apply a rough, square, 3*sigma crop to the input image
+    (This should help speed up the next step)
+    This is done using empirical values.
+    Also returns some useful values.
+    """
+    
+    # Define empirical measures for regular system
+    if mm13 == True:
+        # Measured empirical data from previous images
+        # 13 mm
+        original_shape = (1944,2592)
+        ye, xe = (1057,1298)
+        re = 500
+        sd_x, sd_y, sd_r = 20, 60, 31
+        
+    if mm25 == True:
+        # 25 mm
+        original_shape = (1944,2592)
+        ye, xe = (1024,1280)
+        re = 900
+
+        # Standard deviations of measurements
+        sd_x, sd_y, sd_r = 50,50,50
+    
+    # Define empirical measures for zero system
+    if zero==True:
+        # Measured empirical data from previous images
+        # Old WS Zero
+#         original_shape = (1944,2592)
+#         ye, xe = (980,1249)
+#         re = 744
+#         # Standard deviations of measurements
+#         sd_x, sd_y, sd_r = 47, 36, 48
+
+        # New WS Zero
+        original_shape = (3496, 4656)
+        ye,xe = (1307,2485)
+        re = 620
+        sd_x,sd_y,sd_r = 100,70,100
+        
+    # Check if the shape is the same
+    if np.shape(im) == original_shape:
+        factor=1
+
+    # Otherwise, we can simply scale everything
+    else:
+        # f>1 --> input is bigger than original
+        # f<1 --> input is smaller than original
+        factor =  np.shape(im)[0]/original_shape[0]
+        
+    # Apply scale to get new empirical values
+    xn,yn,rn = xe*factor,ye*factor,re*factor
+       
+    # Generous 3*sigma initial crop to speed hough step
+    sig=3.5
+    xl,xu = int(xn-sig*sd_x*factor - (rn+sig*sd_r*factor)),int(xn+sig*sd_x*factor + (rn+sig*sd_r*factor))
+    yl,yu = int(yn-sig*sd_y*factor - (rn+sig*sd_r*factor)),int(yn+sig*sd_x*factor + (rn+sig*sd_r*factor))
+    
+    # Catch exceptions where limits might be beyond original image space
+    if xl < 0:
+        xl=0
+    if yl < 0:
+        yl=0
+    if xu>np.shape(im)[1]:
+        xu=np.shape(im)[1]
+    if yu>np.shape(im)[0]:
+        yu=np.shape(im)[0]
+    
+    # Crop the image
+    im_roughcrop = im[yl:yu,xl:xu]
+    
+    if mm25 == True:
+    
+        ### Make the border more prominent
+            # Change contrast
+        im_roughcrop = cv2.equalizeHist(im)
+
+            # Blur
+        im_roughcrop = cv2.GaussianBlur(im_roughcrop,(111,111),10)
+
+            # Edge
+        im_roughcrop = cv2.Canny(im_roughcrop,20,1)
+
+            # Hull mask
+        hull = skimage.morphology.convex_hull_image(im_roughcrop)
+        kernel = np.ones((310,310),'uint8')
+        inner= cv2.dilate(1-hull.astype(np.uint8),kernel)
+        inner = 255-(inner-hull)
+        outer= cv2.erode(1-hull.astype(np.uint8),kernel)
+        outer = -outer
+        inner[inner<100]=0
+        inner[inner>=100]=1
+        outer[outer<100]=0
+        outer[outer>=100]=1
+        mask = inner-outer
+
+            # Apply mask 
+        im_roughcrop = im_roughcrop*mask
+    
+    # get new empirical centre of cropped image
+    xn_rough = xn - int(xn-3*sd_x*factor - (rn+3*sd_r*factor))
+    yn_rough = yn - int(yn-3*sd_y*factor - (rn+3*sd_r*factor))
+    
+    return im_roughcrop,xn_rough,yn_rough,rn,factor,xl,yl,sd_x, sd_y, sd_r 
+    
+def hough_estimate(im,zero=False, mm13=False, mm25=True):
+    """" Try to improve on the empirical guess using the
+    Hough circle transform"""
+    
+    # Get empirical guess
+    im_rough,xre,yre,re,f,xl,yl,sd_x, sd_y, sd_r  = rough_crop_estimate(im,zero=zero, mm13=mm13, mm25=mm25)
+    
+    # dp = accumulator resolution ratio
+    # mindist = min between circles
+    # p1 = high canny threshold (low canny will be half)
+    # p2 = accumulator threshold
+    p1,p2 = 20,30
+    if zero == True:
+        # old zero
+        #p1,p2 = 50, 50
+        # New zero
+        p1,p2 = 50, 100
+    circles = cv2.HoughCircles(im_rough, cv2.HOUGH_GRADIENT, 1, 100,
+                                               param1=p1, param2=p2, minRadius=int((re-3*sd_r)*f), maxRadius=int((re+3*sd_r)*f))
+    
+    # Standard deviation in x & y are 20 & 60
+    # We also know the algorithm typically overestimates radius
+    # So we will use the smallest radius at which x & y are within 2 sigma
+        # circles is always in an extra list, and has smallest radii at the end, so let's flip it
+    try:
+        # Get biggest circle
+        circles = circles[0]
+        c=circles[0]
+        xh, yh, rh = c[0],c[1],c[2]
+        return (xh+xl)*1/f,(yh+yl)*1/f,rh*1/f
+    except:
+        # If none identified, return empirical
+        return xre+xl,yre+yl,re
+
+
+def _rim_band(hull_points, shape, f):
+    """ 0/1 mask of the band inside the convex hull of the edges where the rim is searched,
+    the same band rough_crop_estimate builds for the 25 mm system (310 px wide at full scale) """
+    hull = np.zeros(shape, dtype=np.uint8)
+    cv2.fillConvexPoly(hull, hull_points, 1)
+    size = max(int(310*f), 1)
+    kernel = np.ones((size, size), 'uint8')
+    # the edges are all inside the hull, so the band is what lies close to the outside
+    return cv2.dilate(1 - hull, kernel)
+
+
+def multiscale_estimate(im, zero=False, mm13=False, mm25=True, scale=4):
+    """ Find the dish rim like hough_estimate, but with the preprocessing done on a
+    downsampled frame.
+
+    The equalisation, 111 px blur and the band morphology run on a 1/scale image. The
+    blurred frame is smooth, so it is upsampled back for Canny and the Hough transform
+    runs at full resolution on those edges, only inside the rim band.
+    Unlike hough_estimate, the returned centre is in plain image coordinates (no rough
+    crop offset is added). Only the 25 mm system is supported, the other systems fall
+    back to hough_estimate.
+    """
+    if zero == True or mm13 == True or mm25 != True:
+        return hough_estimate(im, zero=zero, mm13=mm13, mm25=mm25)
+
+    # empirical measures of the 25 mm system, see rough_crop_estimate
+    ye, xe = (1024, 1280)
+    re = 900
+    sd_r = 50
+
+    h, w = im.shape[:2]
+    factor = h / 1944
+
+    small = cv2.resize(im, (w // scale, h // scale), interpolation=cv2.INTER_AREA)
+    f = small.shape[0] / 1944
+    size = int(111*f) | 1
+    smooth = cv2.GaussianBlur(cv2.equalizeHist(small), (size, size), 10*f)
+
+    # back to full resolution for the edges, the faint outer edges do not survive Canny at low resolution
+    smooth = cv2.resize(smooth, (w, h), interpolation=cv2.INTER_LINEAR)
+    edges = cv2.Canny(smooth, 20, 1)
+
+    # the band morphology is done at low resolution, only the rim band is kept for the Hough transform
+    points = cv2.findNonZero(edges)
+    if points is None or len(points) < 3:
+        # dark or featureless frame, no rim to find, return empirical as hough_estimate does
+        return xe*factor, ye*factor, re*factor
+    hull_points = cv2.convexHull(points)
+    hull_points = np.round(hull_points * (small.shape[0] / h)).astype(np.int32)
+    band = _rim_band(hull_points, small.shape, f)
+    edges = edges * cv2.resize(band, (w, h), interpolation=cv2.INTER_NEAREST)
+
+    circles = cv2.HoughCircles(edges, cv2.HOUGH_GRADIENT, 1, 100,
+                               param1=20, param2=30, minRadius=int((re-3*sd_r)*factor), maxRadius=int((re+3*sd_r)*factor))
+    if circles is None:
+        # If none identified, return empirical
+        return xe*factor, ye*factor, re*factor
+    # biggest accumulator first
+    xh, yh, rh = circles[0][0]
+    return xh, yh, rh
+
+
+def rim_profile(im, x, y, r, scale=4, band=0.15, n_radii=16, n_angles=90):
+    """ Radial gradient of the equalised, blurred frame around the predicted rim.
+
+    The frame goes through the same equalisation and blur as the detectors, on a 1/scale
+    image, and is sampled on a polar grid from (1-band) r to (1+band) r.
+    :return: n_angles x (n_radii-1) float32 array
+    """
+    h, w = im.shape[:2]
+    small = cv2.resize(im, (w // scale, h // scale), interpolation=cv2.INTER_AREA)
+    f = small.shape[0] / 1944
+    size = int(111*f) | 1
+    smooth = cv2.GaussianBlur(cv2.equalizeHist(small), (size, size), 10*f).astype(np.float32)
+
+    radii = np.linspace(1 - band, 1 + band, n_radii) * r / scale
+    angles = np.linspace(0, 2*np.pi, n_angles, endpoint=False)
+    map_x = (x / scale + np.outer(np.cos(angles), radii)).astype(np.float32)
+    map_y = (y / scale + np.outer(np.sin(angles), radii)).astype(np.float32)
+    polar = cv2.remap(smooth, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+    return np.diff(polar, axis=1)
+
+
+def rim_score(profile, reference):
+    """ Normalised correlation of two rim profiles: ~1 when the rim is where it was,
+    it drops below 0.8 once the dish moved by ~1.5% of the radius """
+    a = profile - profile.mean()
+    b = reference - reference.mean()
+    norm = np.sqrt(np.sum(a*a) * np.sum(b*b))
+    if norm == 0:
+        return 0.
+    return float(np.sum(a*b) / norm)
+
+
+class AdaptiveDishEstimator(object):
+    '''
+    Reuse the last dish location while the rim has not moved.
+
+    The first image runs the full detector and keeps the rim profile around the circle
+    found. The next images only compute the rim profile at that circle (a few ms) and
+    reuse the circle when it correlates with the kept profile, otherwise the detector
+    runs again and the cache is replaced.
+
+    strategy -> detector from crop_strategies used when the check fails
+    threshold -> minimal rim_score to trust the cached circle
+    last_path, last_score and last_time describe the latest estimate()
+    '''
+
+    def __init__(self, strategy='hough', threshold=0.8):
+        self.strategy = strategy
+        self.threshold = threshold
+        self.reset()
+
+    def reset(self):
+        self.circle = None
+        self.reference = None
+        self.last_path = None
+        self.last_score = None
+        self.last_time = None
+
+    def estimate(self, im, zero=False, mm13=False, mm25=True):
+        """ dish centre x, y and radius, in the coordinates returned by the strategy """
+        start = time.time()
+        self.last_score = None
+        if self.circle is not None:
+            # the profile is sampled at the circle as returned (hough_estimate includes its
+            # rough crop offset), the reference was sampled at the same place
+            self.last_score = rim_score(rim_profile(im, *self.circle), self.reference)
+            if self.last_score >= self.threshold:
+                self.last_path = 'cached'
+                self.last_time = time.time() - start
+                return self.circle
+
+        self.circle = crop_strategies[self.strategy](im, zero=zero, mm13=mm13, mm25=mm25)
+        self.reference = rim_profile(im, *self.circle)
+        self.last_path = self.strategy
+        self.last_time = time.time() - start
+        return self.circle
+
+
+# shared cache for the 'adaptive' strategy
+adaptive_estimator = AdaptiveDishEstimator()
+
+# name -> function(im_gray, zero, mm13, mm25) returning the dish centre x, y and radius
+crop_strategies = {
+    'hough': hough_estimate,
+    'multiscale': multiscale_estimate,
+    'adaptive': adaptive_estimator.estimate,
+}
+
+
+def estimate_dish(im, strategy='hough', zero=False, mm13=False, mm25=True):
+    """ Locate the dish in a grey image with the named strategy from crop_strategies """
+    if strategy not in crop_strategies:
+        raise ValueError('unknown crop strategy {}, expected one of {}'.format(strategy, list(crop_strategies)))
+    return crop_strategies[strategy](im, zero=zero, mm13=mm13, mm25=mm25)
+
+
+def regression_test(paths, scales=(4, 6, 8), centre_tolerance=0.1, radius_tolerance=0.05):
+    """ Compare multiscale_estimate with hough_estimate on the given images.
+
+    hough_estimate adds the rough crop offset (xl, yl) to its centre even though the
+    Hough transform runs on the whole frame, so that offset is removed before comparing.
+    The tolerances are relative to the radius: the original detector itself moves its
+    centre by up to ~0.1 r when the same image is re-encoded as JPEG quality 75.
+    """
+    passed = True
+    for path in paths:
+        im = cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2GRAY)
+        xl, yl = rough_crop_estimate(im)[5:7]
+
+        start = time.time()
+        x, y, r = hough_estimate(im)
+        hough_time = time.time() - start
+        x, y = x - xl, y - yl
+        print('{}\n  hough      : x {:.1f}, y {:.1f}, r {:.1f} ({:.2f}s)'.format(path, x, y, r, hough_time))
+
+        for scale in scales:
+            start = time.time()
+            xm, ym, rm = multiscale_estimate(im, scale=scale)
+            multiscale_time = time.time() - start
+            centre_error = np.hypot(xm - x, ym - y) / r
+            radius_error = abs(rm - r) / r
+            ok = centre_error <= centre_tolerance and radius_error <= radius_tolerance
+            passed = passed and ok
+            print('  multiscale {}: x {:.1f}, y {:.1f}, r {:.1f} ({:.2f}s, {:.1f}x faster) centre {:.3f} r, radius {:.3f} r {}'.format(
+                scale, xm, ym, rm, multiscale_time, hough_time / multiscale_time, centre_error, radius_error,
+                'ok' if ok else 'FAILED'))
+    return passed
+
+
+def adaptive_test(paths, shift=40):
+    """ The adaptive strategy must reuse its circle for the same dish and run the
+    detector again once the dish moved (image shifted by `shift` px) """
+    passed = True
+    for path in paths:
+        im = cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2GRAY)
+        estimator = AdaptiveDishEstimator()
+        paths_taken = []
+        for frame in (im, cv2.add(im, 10), np.roll(im, shift, axis=1)):
+            estimator.estimate(frame)
+            paths_taken.append(estimator.last_path)
+            print('  adaptive: {} ({:.3f}s, score {})'.format(estimator.last_path, estimator.last_time, estimator.last_score))
+        ok = paths_taken == ['hough', 'cached', 'hough']
+        passed = passed and ok
+        print('{} {}'.format(path, 'ok' if ok else 'FAILED'))
+    return passed
+
+
+if __name__ == '__main__':
+    import glob
+    import sys
+
+    paths = sys.argv[1:] or sorted(glob.glob('yolor_pi/inference_script/images/*.jpg'))
+    if not regression_test(paths) or not adaptive_test(paths):
+        sys.exit(1)
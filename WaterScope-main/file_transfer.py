@@ -0,0 +1,341 @@
+'''
+Chunk hashes and throughput of the Bluetooth file transfer (autofocus.send_file_response).
+
+send_file_response used to read the whole image into memory and SHA-1 a sliced copy of
+every package. chunk_hashes() maps the file with mmap and hashes memoryview slices of it,
+so no package is copied. The hashes are cached next to the file in a hidden
+.<name>.sha1.json sidecar, keyed by package size and valid while the size and mtime of
+the file match. A repeated "get raw image" request does not hash the file again.
+
+TransferMeter times a transfer and logs its throughput.
+
+send_parts() sends the packages and collects the acknowledgements of the app. The app
+asks for a window in the sample instruction ('window': N). Without one the transfer
+stays stop-and-wait: one package, one acknowledgement, as the app always expected.
+With a window, up to N packages are in flight and every package is framed with an
+8 byte header (part index, length) so the app can place it. An 'invalid'
+acknowledgement resends only that package. The acknowledgements are read from the
+bluetooth_protocol.Channel of the connection.
+'''
+
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+
+from bluetooth_protocol import Channel, payload_validation
+from crop_calibration import atomic_write
+
+# Settings
+max_window = 8  # packages in flight, whatever the app asks for
+ack_retries = 5  # 'invalid' replies to a corrupted acknowledgement payload before aborting, as read_payload
+part_header = struct.Struct('>II')  # part index, package length
+
+
+def package_offsets(size, package_size):
+    return range(0, size, package_size)
+
+
+def package_end(size, offset, package_size):
+    end = offset + package_size
+    return end if end < size else size
+
+
+def hash_chunks(path, package_size):
+    ''' SHA-1 of every package of the file, hashed from a memory map without copies '''
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        view = memoryview(mapped)
+        try:
+            return [hashlib.sha1(view[offset:package_end(size, offset, package_size)]).hexdigest()
+                    for offset in package_offsets(size, package_size)]
+        finally:
+            # the map cannot be closed while a view on it exists
+            view.release()
+
+
+def cache_path(path):
+    directory, name = os.path.split(path)
+    return os.path.join(directory, '.{}.sha1.json'.format(name))
+
+
+def chunk_hashes(path, package_size, cache=True):
+    ''' package hashes of a file, from the sidecar cache when the file has not changed since '''
+    stat = os.stat(path)
+    state = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hashes': {}}
+    key = str(package_size)
+    if cache and os.path.exists(cache_path(path)):
+        try:
+            with open(cache_path(path)) as f:
+                cached = json.load(f)
+            if cached['size'] == stat.st_size and cached['mtime_ns'] == stat.st_mtime_ns:
+                state = cached
+                if key in state['hashes']:
+                    logging.debug(f'Using cached hashes of "{path}".')
+                    return state['hashes'][key]
+        except (ValueError, KeyError, TypeError) as e:
+            logging.warning(f'Ignoring unreadable hash cache of "{path}": {e}')
+
+    hashes = hash_chunks(path, package_size)
+    if cache:
+        state['hashes'][key] = hashes
+        try:
+            atomic_write(cache_path(path), json.dumps(state))
+        except OSError as e:
+            logging.warning(f'Could not cache the hashes of "{path}": {e}')
+    return hashes
+
+
+class TransferMeter(object):
+    ''' bytes sent (resent packages included) and elapsed time of one transfer '''
+
+    def __init__(self):
+        self.start = time.time()
+        self.sent = 0
+
+    def add(self, n):
+        self.sent += n
+
+    def throughput(self):
+        ''' kB/s since the meter was created '''
+        elapsed = time.time() - self.start
+        return self.sent / 1024. / elapsed if elapsed > 0 else 0.
+
+    def log(self, file_path):
+        logging.info(f'Sent {self.sent} bytes of "{file_path}" in {time.time() - self.start:.2f}s, '
+                     f'{self.throughput():.1f} kB/s.')
+
+
+class TransferAborted(Exception):
+    pass
+
+
+def reply(channel, response, status):
+    channel.send_message({'id': response.get('id'), 'status': status, 'payload': payload_validation(None)})
+
+
+def read_ack(channel, retries=ack_retries):
+    '''
+    (response, payload) of the next acknowledgement, a response carries a JSON payload with its size and SHA-1
+
+    A payload that does not match its checksum is answered 'invalid' and read again, as read_payload does,
+    the transfer is aborted after retries corrupted payloads.
+    '''
+    response = channel.read_message()
+    if 'instruction' in response:
+        raise TransferAborted(f'received new instruction "{response["instruction"]}" during the transfer')
+    checksum = (response.get('payload') or {}).get('checksum')
+    data = channel.read_payload(response)
+    tries = 0
+    while hashlib.sha1(data).hexdigest() != checksum:
+        if tries == retries:
+            logging.error(f'Acknowledgement checksum does not match after retry #{tries} still. Aborting.')
+            reply(channel, response, 'failed')
+            raise TransferAborted('acknowledgement payload checksum does not match')
+        tries += 1
+        logging.info(f'Acknowledgement checksum does not match. Retry #{tries}.')
+        reply(channel, response, 'invalid')
+        data = channel.read_payload(response)
+    return response, json.loads(data.decode('utf-8'))
+
+
+def negotiate_window(requested):
+    ''' window used for a transfer, 1 (stop-and-wait, unframed) for apps that do not ask for one '''
+    try:
+        return max(1, min(int(requested or 1), max_window))
+    except (TypeError, ValueError):
+        return 1
+
+
+def send_parts(channel, file, size, package_size, id, type, window=1, meter=None, timeout=30):
+    ''' send every package of an open file over a bluetooth_protocol.Channel, window packages in flight '''
+    n_parts = len(package_offsets(size, package_size))
+    in_flight = set()
+    next_part = 0
+    framed = window > 1
+
+    def send(part):
+        offset = part * package_size
+        length = package_end(size, offset, package_size) - offset
+        if framed:
+            channel.sendall(part_header.pack(part, length))
+        channel.sendfile(file, offset, length)
+        if meter is not None:
+            meter.add(length)
+
+    channel.settimeout(timeout)
+    try:
+        while in_flight or next_part < n_parts:
+            while len(in_flight) < window and next_part < n_parts:
+                logging.debug(f'Sending part {next_part}, {calculate_progress(size, next_part * package_size)}%.')
+                send(next_part)
+                in_flight.add(next_part)
+                next_part += 1
+
+            response, payload = read_ack(channel)
+            part = payload.get('part')
+            if payload.get('id') != id or payload.get('type') != type or part not in in_flight:
+                continue
+            status = response.get('status')
+            if status == 'ok':
+                in_flight.discard(part)
+            elif status == 'invalid':
+                logging.warning(f'Part {part} got corrupted, '
+                                f'{calculate_progress(size, part * package_size)}%. Resending this part.')
+                send(part)
+            elif status == 'failed':
+                raise TransferAborted(f'app reported failure at part {part}')
+    finally:
+        channel.settimeout(None)
+
+
+def calculate_progress(size, offset):
+    return round((offset / size) * 100, 2)
+
+
+def _legacy_hashes(path, package_size):
+    with open(path, 'rb') as file:
+        data = file.read()
+    size = len(data)
+    return [hashlib.sha1(data[offset:package_end(size, offset, package_size)]).hexdigest()
+            for offset in package_offsets(size, package_size)]
+
+
+def _simulated_app(connection, size, package_size, hashes, id, type, window, rtt, bandwidth, corrupt=()):
+    ''' the receiving side over a link with the given round trip (s) and bandwidth (bytes/s) '''
+    import threading
+
+    lock = threading.Lock()
+    corrupt = set(corrupt)
+    received = {}
+
+    def recv_exactly(n):
+        data = bytearray()
+        while len(data) < n:
+            data += connection.recv(n - len(data))
+        return data
+
+    def ack(part, status):
+        payload = json.dumps({'part': part, 'id': id, 'type': type}).encode('utf-8')
+        response = json.dumps({'status': status, 'payload': {
+            'size': len(payload), 'checksum': hashlib.sha1(payload).hexdigest()}}).encode('utf-8')
+        with lock:
+            connection.sendall(response + payload)
+
+    next_part = 0
+    while len(received) < len(hashes):
+        if window > 1:
+            part, length = part_header.unpack(recv_exactly(part_header.size))
+        else:
+            part = next_part
+            length = package_end(size, part * package_size, package_size) - part * package_size
+        data = recv_exactly(length)
+        time.sleep(length / float(bandwidth))
+        if part in corrupt:
+            corrupt.discard(part)
+            data[0] ^= 0xff
+        status = 'ok' if hashlib.sha1(data).hexdigest() == hashes[part] else 'invalid'
+        if status == 'ok':
+            received[part] = bytes(data)
+            next_part = part + 1
+        threading.Timer(rtt / 2., ack, (part, status)).start()
+    return b''.join(received[part] for part in range(len(hashes)))
+
+
+def _check_ack_retries():
+    ''' a corrupted acknowledgement is answered 'invalid' and read again, the transfer aborts after ack_retries '''
+    import socket
+
+    from bluetooth_protocol import MessageParser, encode
+
+    payload = json.dumps({'part': 0, 'id': 1, 'type': 'raw image'}).encode('utf-8')
+    header = {'id': 1, 'status': 'ok', 'payload': payload_validation(payload)}
+    corrupted = b'x' + payload[1:]
+    for bad in (1, ack_retries, ack_retries + 1):
+        device, app = socket.socketpair()
+        # the app sends the payload again after each 'invalid', without a header
+        app.sendall(encode(header, corrupted) + corrupted * (bad - 1) + payload)
+        try:
+            response, data = read_ack(Channel(device))
+            aborted = False
+        except TransferAborted:
+            aborted = True
+        device.close()
+        parser = MessageParser()
+        parser.feed(app.recv(65536))
+        app.close()
+        statuses = [message['status'] for message, _ in parser.messages()]
+        assert aborted == (bad > ack_retries), bad
+        assert statuses == ['invalid'] * min(bad, ack_retries) + (['failed'] if aborted else []), statuses
+        assert aborted or data == json.loads(payload.decode('utf-8'))
+    print('corrupted acknowledgements retried, aborted after {} retries'.format(ack_retries))
+
+
+def benchmark(size=1024 * 1024, package_size=50 * 1024, rtt=0.05, bandwidth=250 * 1024, windows=(1, 2, 4, 8)):
+    ''' throughput of the stop-and-wait and the windowed transfer over a socketpair emulating an RFCOMM link '''
+    import socket
+    import tempfile
+    import threading
+
+    path = os.path.join(tempfile.mkdtemp(), 'image.jpg')
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+    hashes = chunk_hashes(path, package_size)
+    for window in windows:
+        for corrupt in ((), (3,)):
+            device, app = socket.socketpair()
+            result = {}
+            client = threading.Thread(target=lambda: result.update(data=_simulated_app(
+                app, size, package_size, hashes, 1, 'raw image', window, rtt, bandwidth, corrupt)))
+            client.start()
+            meter = TransferMeter()
+            with open(path, 'rb') as file:
+                send_parts(Channel(device), file, size, package_size, 1, 'raw image', window=window, meter=meter)
+            client.join()
+            with open(path, 'rb') as file:
+                assert result['data'] == file.read(), 'received file differs'
+            device.close()
+            app.close()
+            print('window {}{:22s}: {:6.1f} kB/s, {} bytes sent'.format(
+                window, ', part 3 corrupted' if corrupt else '', meter.throughput(), meter.sent))
+
+
+if __name__ == '__main__':
+    import tempfile
+    import tracemalloc
+
+    # a quality=100 2592x1944 JPEG is a few MB
+    path = os.path.join(tempfile.mkdtemp(), 'image.jpg')
+    with open(path, 'wb') as f:
+        f.write(os.urandom(4 * 1024 * 1024))
+    package_size = 64 * 1024
+
+    for name, hashes in (('read + slices', lambda: _legacy_hashes(path, package_size)),
+                         ('mmap + memoryview', lambda: hash_chunks(path, package_size)),
+                         ('mmap, first request', lambda: chunk_hashes(path, package_size)),
+                         ('cached', lambda: chunk_hashes(path, package_size))):
+        tracemalloc.start()
+        start = time.time()
+        result = hashes()
+        elapsed = time.time() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        assert result == _legacy_hashes(path, package_size), 'hashes differ'
+        print('{:20s} {:7.1f} ms, peak allocations {:7.0f} kB'.format(name, 1000 * elapsed, peak / 1024.))
+
+    # a changed file is hashed again
+    with open(path, 'r+b') as f:
+        f.write(b'changed')
+    os.utime(path, ns=(time.time_ns(), time.time_ns() + 1))
+    assert chunk_hashes(path, package_size) == _legacy_hashes(path, package_size)
+    print('identical hashes, cache invalidated on change')
+
+    _check_ack_retries()
+
+    # 50 ms round trip, 250 kB/s
+    benchmark()
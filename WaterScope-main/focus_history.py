@@ -0,0 +1,147 @@
+'''
+Focus history of the last captures, the prior of the focus search.
+
+capture_image and defogging used to pd.read_csv the whole database.csv to average the
+last 10 focus positions. FocusHistory keeps those positions in a ring buffer, updated
+once per capture and flushed to a small JSON file with the atomic replace of
+crop_calibration. The first load migrates the focus column of database.csv.
+
+window() centres the focus search on the average of the recent positions, with a half
+width of 3 standard deviations (at least min_half_width), so a stable device scans a
+few positions around its usual focus instead of the whole 900-1000 range. When the best
+focus lands on the edge of the window, FocusSearch searches the whole range after all.
+'''
+
+import csv
+import json
+import math
+import os
+from collections import deque
+
+import numpy as np
+
+from crop_calibration import atomic_write
+
+# Settings
+history_path = 'focus_history.json'
+database_path = 'database.csv'
+min_half_width = 15  # VCM steps either side of the predicted focus
+spread = 3.  # standard deviations covered by the window
+
+
+class FocusHistory(object):
+    '''
+    capacity -> number of captures averaged, as the old tail(10) of database.csv
+    min_samples -> captures needed before the search window is narrowed
+    total -> captures recorded so far (database.csv rows when migrated)
+    '''
+
+    def __init__(self, path=history_path, capacity=10, min_samples=5, database=database_path):
+        self.path = path
+        self.database = database
+        self.capacity = capacity
+        self.min_samples = min_samples
+        self.positions = deque(maxlen=capacity)
+        self.total = 0
+
+    def __len__(self):
+        return len(self.positions)
+
+    def add(self, z):
+        ''' record the focus position of a capture and flush the history '''
+        self.positions.append(float(z))
+        self.total += 1
+        self.save()
+
+    def mean(self):
+        ''' average focus of the recent captures, None without history '''
+        if not self.positions:
+            return None
+        return float(np.mean(self.positions))
+
+    def std(self):
+        if len(self.positions) < 2:
+            return None
+        return float(np.std(self.positions))
+
+    def window(self, z_min=900, z_max=1000, step=5):
+        '''
+        (low, high) VCM range to search, on the step grid from z_min, the full range until
+        min_samples captures are recorded
+        '''
+        if len(self.positions) < self.min_samples:
+            return z_min, z_max
+        half_width = max(min_half_width, spread * self.std())
+        low = z_min + step * math.floor((self.mean() - half_width - z_min) / step)
+        high = z_min + step * math.ceil((self.mean() + half_width - z_min) / step)
+        return int(max(low, z_min)), int(min(high, z_max))
+
+    def save(self):
+        atomic_write(self.path, json.dumps({'total': self.total, 'positions': list(self.positions)}))
+
+    def load(self):
+        ''' restore the saved history, migrating database.csv when there is no history file yet '''
+        self.positions.clear()
+        self.total = 0
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    state = json.load(f)
+                self.positions.extend(float(z) for z in state['positions'])
+                self.total = int(state['total'])
+            except (ValueError, KeyError, TypeError) as e:
+                print('ignoring unreadable focus history {}: {}'.format(self.path, e))
+                self.positions.clear()
+        elif os.path.exists(self.database):
+            self.total, positions = load_database_focus(self.database, self.capacity)
+            self.positions.extend(positions)
+            self.save()
+        return self
+
+
+def load_database_focus(path=database_path, capacity=10):
+    ''' (number of rows, last capacity focus positions) of database.csv, rows without a focus are skipped '''
+    positions = deque(maxlen=capacity)
+    rows = 0
+    with open(path, newline='', encoding='utf-8', errors='replace') as f:
+        for row in csv.DictReader(line.replace('\x00', '') for line in f):
+            rows += 1
+            try:
+                positions.append(float(row['focus']))
+            except (KeyError, TypeError, ValueError):
+                continue
+    return rows, list(positions)
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    import focus_search
+
+    # a reload keeps the history, the window follows the recent positions
+    directory = tempfile.mkdtemp()
+    history = FocusHistory(os.path.join(directory, history_path))
+    assert history.window() == (900, 1000)
+    for z in (950, 955, 945, 950, 960, 950, 955):
+        history.add(z)
+    restored = FocusHistory(history.path).load()
+    assert restored.mean() == history.mean() and restored.total == 7
+    print('history mean {:.1f}, std {:.1f}, window {}'.format(history.mean(), history.std(), history.window()))
+
+    # migrating database.csv reads the focus column once
+    database = os.path.join(directory, 'database.csv')
+    with open(database, 'w') as f:
+        f.write('UID,sample_ID,image_seq,timestamp,focus,yolo_eco\n')
+        for i, z in enumerate([1000, 990, 'NA'] + [950] * 12):
+            f.write('id{},s,{},t,{},0\n'.format(i, i, z))
+    migrated = FocusHistory(os.path.join(directory, 'migrated.json'), database=database).load()
+    assert migrated.total == 15 and list(migrated.positions) == [950.] * 10
+
+    # frames captured per sample with and without the prior
+    for best_z in (948, 955, 962):
+        for label, (low, high) in (('full range', (900, 1000)), ('prior window', history.window())):
+            lens = focus_search.SimulatedLens(best_z=best_z)
+            search = focus_search.FocusSearch(lens.move, lens.measure, z_min=low, z_max=high, print_log=False,
+                                              settle_time=0, final_settle_time=0)
+            z, _ = search.run()
+            print('peak {} {:12s} {}-{}: found {} in {:2d} frames'.format(best_z, label, low, high, z, len(search.trace)))
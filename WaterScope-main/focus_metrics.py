@@ -0,0 +1,152 @@
+'''
+Focus metrics for the autofocus sweep.
+
+variance_of_laplacian used to run cv2.Laplacian with float64 output on the 3 channel
+BGR ROI and to write the score onto the frame at every step. Here the ROI is first
+turned into one grayscale float32 image, optionally downsampled by an integer factor
+with INTER_AREA, and scored with one of:
+
+    'laplacian'            variance of the Laplacian, the original metric
+    'tenengrad'            mean squared Sobel gradient magnitude
+    'normalized_variance'  gray level variance divided by the mean intensity
+
+Scores of the different metrics (and downsampling factors) are on different scales. Even
+'laplacian' is lower than the original BGR float64 score, about legacy_laplacian_scale
+times it (82 -> 40, 322 -> 144, 1273 -> 574), so the blank plate thresholds of
+autofocus.py are the old ones rescaled by it. legacy_ratio() measures the factor of a
+metric on a focus stack.
+Drawing the ROI box and the score is left to draw_focus(), for previews only.
+
+benchmark() reports the cost per frame and whether each metric peaks at the same
+position of a focus stack as the original BGR float64 Laplacian.
+'''
+
+import glob
+import os
+import time
+
+import cv2
+import numpy as np
+
+# Settings
+legacy_laplacian_scale = 0.45  # 'laplacian' score / original BGR float64 score, near the blank plate thresholds
+
+
+def prepare(roi, downsample=1):
+    ''' grayscale float32 copy of a BGR (or already gray) ROI, shrunk by an integer factor '''
+    gray = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY) if roi.ndim == 3 else roi
+    if downsample > 1:
+        gray = cv2.resize(gray, (gray.shape[1] // downsample, gray.shape[0] // downsample),
+                          interpolation=cv2.INTER_AREA)
+    return gray.astype(np.float32)
+
+
+def laplacian_variance(gray):
+    _, std = cv2.meanStdDev(cv2.Laplacian(gray, cv2.CV_32F))
+    return float(std[0, 0] ** 2)
+
+
+def tenengrad(gray):
+    gx = cv2.Sobel(gray, cv2.CV_32F, 1, 0, ksize=3)
+    gy = cv2.Sobel(gray, cv2.CV_32F, 0, 1, ksize=3)
+    return float(cv2.mean(cv2.magnitude(gx, gy) ** 2)[0])
+
+
+def normalized_variance(gray):
+    mean, std = cv2.meanStdDev(gray)
+    return float(std[0, 0] ** 2 / max(mean[0, 0], 1e-6))
+
+
+metrics = {
+    'laplacian': laplacian_variance,
+    'tenengrad': tenengrad,
+    'normalized_variance': normalized_variance,
+}
+
+
+def focus_score(roi, metric='laplacian', downsample=1):
+    ''' sharpness of a BGR ROI, higher is sharper '''
+    if metric not in metrics:
+        raise ValueError('unknown focus metric {}'.format(metric))
+    return metrics[metric](prepare(roi, downsample))
+
+
+def draw_focus(image, roi_box, score):
+    ''' draw the ROI box (outside the ROI) and the focus score onto a preview frame '''
+    cv2.rectangle(image, pt1=(roi_box['x1'] - 5, roi_box['y1'] - 5), pt2=(roi_box['x2'] + 5, roi_box['y2'] + 5),
+                  color=(0, 0, 255), thickness=2)
+    cv2.putText(image, 'f: {:.2f}'.format(score), (int(image.shape[0] * 0.1), int(image.shape[1] * 0.1)),
+                cv2.FONT_HERSHEY_DUPLEX, 2, (0, 0, 255))
+    return image
+
+
+def _legacy_laplacian(roi):
+    return cv2.Laplacian(roi, cv2.CV_64F).var()
+
+
+def legacy_ratio(stack, metric='laplacian', downsample=1):
+    ''' median of score / original score over the ROIs of a stack, to rescale thresholds set for the original '''
+    return float(np.median([focus_score(roi, metric, downsample) / max(_legacy_laplacian(roi), 1e-6)
+                            for roi in stack]))
+
+
+def synthetic_stack(positions, best_z=955, size=(128, 128), seed=0):
+    ''' BGR ROIs (128 px, the 0.2 focus box of a 640x480 frame) of a textured plate, blurred more the
+    further the position is from best_z '''
+    generator = np.random.RandomState(seed)
+    plate = np.full(size + (3,), (180, 190, 200), dtype=np.uint8)
+    for _ in range(50):
+        x, y = generator.randint(0, size[1]), generator.randint(0, size[0])
+        colour = tuple(int(c) for c in generator.randint(40, 160, 3))
+        cv2.circle(plate, (x, y), int(generator.randint(1, 6)), colour, -1)
+    stack = []
+    for z in positions:
+        sigma = 0.3 + abs(z - best_z) / 8.
+        frame = cv2.GaussianBlur(plate, (0, 0), sigma)
+        noise = generator.normal(0, 2, frame.shape)
+        stack.append(np.clip(frame + noise, 0, 255).astype(np.uint8))
+    return stack
+
+
+def benchmark(stack, positions, repeat=5, downsamples=(1, 2, 4)):
+    ''' cost per frame and peak position of every metric, against the original BGR float64 Laplacian '''
+    start = time.time()
+    for _ in range(repeat):
+        legacy = [_legacy_laplacian(roi) for roi in stack]
+    legacy_time = (time.time() - start) / (repeat * len(stack))
+    legacy_peak = positions[int(np.argmax(legacy))]
+    print('{:34s} {:6.2f} ms per frame, peak {}'.format('legacy BGR float64 laplacian', 1000 * legacy_time,
+                                                        legacy_peak))
+    results = {}
+    for name in metrics:
+        for downsample in downsamples:
+            start = time.time()
+            for _ in range(repeat):
+                scores = [focus_score(roi, name, downsample) for roi in stack]
+            elapsed = (time.time() - start) / (repeat * len(stack))
+            peak = positions[int(np.argmax(scores))]
+            results[(name, downsample)] = (elapsed, peak)
+            print('{:34s} {:6.2f} ms per frame, peak {} ({}), {:.3f}x the original score'.format(
+                '{} /{}'.format(name, downsample), 1000 * elapsed, peak,
+                'agrees' if peak == legacy_peak else 'off by {}'.format(peak - legacy_peak),
+                legacy_ratio(stack, name, downsample)))
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='compare the focus metrics on a focus stack')
+    parser.add_argument('folder', nargs='?',
+                        help='frames named <VCM position>.jpg/.png, a synthetic stack if omitted')
+    args = parser.parse_args()
+
+    if args.folder:
+        paths = glob.glob(os.path.join(args.folder, '*.jpg')) + glob.glob(os.path.join(args.folder, '*.png'))
+        paths.sort(key=lambda path: int(os.path.splitext(os.path.basename(path))[0]))
+        positions = [int(os.path.splitext(os.path.basename(path))[0]) for path in paths]
+        stack = [cv2.imread(path) for path in paths]
+    else:
+        positions = list(range(900, 1001, 5))
+        stack = synthetic_stack(positions)
+    benchmark(stack, positions)
@@ -0,0 +1,229 @@
+'''
+Focus search over the VCM range for autofocus.capture_image.
+
+capture_image used to step the VCM from 900 to 1000 in steps of 5, score every frame
+and sleep 3 s once the lens was back at the best position. FocusSearch only needs a
+move(z) and a measure() callable and searches the same range (or a narrower window
+around the predicted focus, see focus_history.py) with one of:
+
+    'sweep'        every step from z_min to z_max, the old behaviour, with early stopping
+    'coarse_fine'  a coarse sweep with early stopping, then the fine steps around its best
+    'golden'       golden-section search on the step grid, assumes a single peak
+
+The early stop ends a sweep once the score has clearly peaked: patience consecutive
+positions more than `drop` below the best score so far. Every measurement waits
+settle_time after the move, and the final move waits final_settle_time. Both come from
+config_picamera.yaml (focus_settle_time, focus_final_settle_time), and
+measure_settle_time() measures them on the device. Each search keeps its trace (step,
+position, score, time) and prints it.
+'''
+
+import math
+import time
+
+# Settings
+z_min = 900
+z_max = 1000
+z_step = 5
+coarse_step = 20
+settle_time = 0.05  # seconds between a VCM step and the frame that is scored
+final_settle_time = 0.5  # seconds after the move to the best position, before the capture
+drop = 0.2  # relative score drop that counts as past the peak
+patience = 2  # positions past the peak before the sweep stops
+
+
+class FocusSearch(object):
+    '''
+    move -> callable moving the lens to a VCM position
+    measure -> callable returning the focus score of a new frame
+    method -> 'sweep', 'coarse_fine' or 'golden'
+    '''
+
+    def __init__(self, move, measure, method='coarse_fine', z_min=z_min, z_max=z_max, step=z_step,
+                 coarse_step=coarse_step, settle_time=settle_time, final_settle_time=final_settle_time,
+                 drop=drop, patience=patience, limits=(z_min, z_max), print_log=True):
+        if method not in ('sweep', 'coarse_fine', 'golden'):
+            raise ValueError('unknown focus search {}'.format(method))
+        self.move = move
+        self.measure = measure
+        self.method = method
+        self.z_min = z_min
+        self.z_max = z_max
+        self.step = step
+        self.coarse_step = coarse_step
+        self.settle_time = settle_time
+        self.final_settle_time = final_settle_time
+        self.drop = drop
+        self.patience = patience
+        self.limits = limits
+        self.print_log = print_log
+        self.table = {}
+        self.trace = []
+
+    def score(self, z):
+        ''' focus score at VCM position z, each position is only measured once per search '''
+        z = int(min(max(z, self.z_min), self.z_max))
+        if z not in self.table:
+            self.move(z)
+            # the lens comes from anywhere before the first measurement, give it the long settle time
+            time.sleep(self.settle_time if self.trace else self.final_settle_time)
+            self.table[z] = self.measure()
+            self.trace.append((len(self.trace), z, self.table[z], time.time() - self.start))
+            if self.print_log:
+                print('{},{}'.format(z, self.table[z]))
+        return self.table[z]
+
+    def best(self):
+        return max(self.table, key=self.table.get)
+
+    def sweep(self, positions):
+        ''' score the positions in order until the curve has clearly peaked '''
+        best_score = None
+        past_peak = 0
+        for z in positions:
+            score = self.score(z)
+            if best_score is None or score > best_score:
+                best_score = score
+                past_peak = 0
+            elif score < (1 - self.drop) * best_score:
+                past_peak += 1
+                if past_peak >= self.patience:
+                    break
+            else:
+                past_peak = 0
+
+    def grid(self, start, stop, step):
+        return list(range(int(start), int(stop) + 1, int(step)))
+
+    def coarse_fine(self):
+        self.sweep(self.grid(self.z_min, self.z_max, self.coarse_step))
+        best = self.best()
+        # the fine steps between the coarse neighbours of the best coarse position
+        low = max(self.z_min, best - self.coarse_step + self.step)
+        high = min(self.z_max, best + self.coarse_step - self.step)
+        for z in self.grid(low, high, self.step):
+            self.score(z)
+
+    def golden(self):
+        ''' golden-section search over the grid indices of the step grid '''
+        grid = self.grid(self.z_min, self.z_max, self.step)
+        ratio = (math.sqrt(5) - 1) / 2
+        low, high = 0, len(grid) - 1
+        while high - low > 2:
+            a = int(round(high - ratio * (high - low)))
+            b = int(round(low + ratio * (high - low)))
+            if a == b:
+                b = a + 1
+            if self.score(grid[a]) < self.score(grid[b]):
+                low = a
+            else:
+                high = b
+        for i in range(low, high + 1):
+            self.score(grid[i])
+
+    def search(self):
+        if self.method == 'sweep':
+            self.sweep(self.grid(self.z_min, self.z_max, self.step))
+        elif self.method == 'coarse_fine':
+            self.coarse_fine()
+        else:
+            self.golden()
+
+    def run(self):
+        '''
+        search the range, move the lens to the best position and wait for it to settle
+
+        :return: (best position, its score)
+        '''
+        self.table = {}
+        self.trace = []
+        self.start = time.time()
+        self.search()
+        best = self.best()
+        if (best == self.z_min and self.z_min > self.limits[0]) or (best == self.z_max and self.z_max < self.limits[1]):
+            # the focus is at the edge of a narrowed window, it may lie outside: search the whole range
+            if self.print_log:
+                print('best focus {} on the edge of {}-{}, searching {}-{}'.format(
+                    best, self.z_min, self.z_max, self.limits[0], self.limits[1]))
+            self.z_min, self.z_max = self.limits
+            self.search()
+            best = self.best()
+        self.move(best)
+        time.sleep(self.final_settle_time)
+        self.duration = time.time() - self.start
+        if self.print_log:
+            self.log_trace()
+        return best, self.table[best]
+
+    def log_trace(self):
+        print('focus search {}: {} steps, best {} ({:.1f}), {:.2f}s'.format(
+            self.method, len(self.trace), self.best(), self.table[self.best()], self.duration))
+        for step, z, score, t in self.trace:
+            print('  step {:2d}: z {:4d}, score {:8.2f}, t {:.3f}s'.format(step, z, score, t))
+
+
+def from_config(config, move, measure, **kwargs):
+    ''' FocusSearch with the settle times and method of config_picamera.yaml (defaults above when missing) '''
+    return FocusSearch(move, measure, method=config.get('focus_search', 'coarse_fine'),
+                       settle_time=config.get('focus_settle_time', settle_time),
+                       final_settle_time=config.get('focus_final_settle_time', final_settle_time), **kwargs)
+
+
+def measure_settle_time(move, measure, z_from=z_min, z_to=z_max, tolerance=0.02, stable_frames=3, timeout=3.):
+    '''
+    time from a full range VCM move until the focus score stops changing, the value for
+    focus_final_settle_time (and an upper bound for focus_settle_time, the steps are smaller)
+
+    :return: seconds until stable_frames consecutive scores are within tolerance of each other
+    '''
+    move(z_from)
+    time.sleep(timeout)
+    move(z_to)
+    start = time.time()
+    scores = []
+    while time.time() - start < timeout:
+        scores.append(measure())
+        recent = scores[-stable_frames:]
+        if len(recent) == stable_frames and max(recent) - min(recent) <= tolerance * max(max(recent), 1e-6):
+            return time.time() - start
+    return timeout
+
+
+class SimulatedLens(object):
+    ''' a focus curve peaking at best_z, with a lens that takes lag seconds to reach a new position '''
+
+    def __init__(self, best_z=955, width=25., lag=0.02, noise=0.02, frame_time=1 / 30., seed=0):
+        import random
+        self.random = random.Random(seed)
+        self.best_z = best_z
+        self.width = width
+        self.lag = lag
+        self.noise = noise
+        self.frame_time = frame_time
+        self.z = self.target = z_min
+        self.moved = time.time()
+
+    def move(self, z):
+        self.z, self.target, self.moved = self.position(), z, time.time()
+
+    def position(self):
+        if time.time() - self.moved >= self.lag:
+            return self.target
+        return self.z + (self.target - self.z) * (time.time() - self.moved) / self.lag
+
+    def measure(self):
+        time.sleep(self.frame_time)
+        score = 200 * math.exp(-((self.position() - self.best_z) / self.width) ** 2) + 5
+        return score * (1 + self.noise * self.random.uniform(-1, 1))
+
+
+if __name__ == '__main__':
+    for best_z in (905, 935, 955, 990):
+        for method in ('sweep', 'coarse_fine', 'golden'):
+            lens = SimulatedLens(best_z=best_z)
+            search = FocusSearch(lens.move, lens.measure, method=method, print_log=False)
+            z, score = search.run()
+            print('peak {} {:12s}: found {:4d} in {:2d} steps, {:.2f}s'.format(
+                best_z, method, z, len(search.trace), search.duration))
+    lens = SimulatedLens()
+    print('simulated settle time {:.3f}s'.format(measure_settle_time(lens.move, lens.measure, timeout=0.5)))
@@ -0,0 +1,278 @@
+'''
+Background encoding of the images derived from a capture.
+
+capture_image used to reopen the quality=100 capture with PIL on the capture thread and
+save it twice with optimize=True (_preview.jpg for new samples, _compressed.jpg always),
+and Chlorine_analysis saved its annotated _result.jpg the same way. analysis_result
+waited for all of it before the analysis could start.
+
+ImageEncoder runs these encodes in a small thread pool. A job gets either the path of
+the capture, decoded once in the worker, or a frame that is already decoded (a BGR
+array), and writes every output from it with cv2.imencode, which releases the GIL.
+Each output is either
+
+    {'quality': q}          a fixed JPEG quality, as before
+    {'target_size': bytes}  the highest quality that fits (estimated on a quarter area
+                            copy, then searched on the full image from there), halving
+                            the resolution when even min_quality does not, for the
+                            previews sent over Bluetooth. Never below the old fixed
+                            preview quality when that quality fits.
+
+Outputs are written through a temporary file and os.replace, so a file that is being
+encoded is never sent half written. send_file_response calls wait() on the path
+before it opens the file.
+
+`python image_encoder.py` times the old inline re-encodes against submit() on a
+full resolution synthetic capture, i.e. the latency taken off analysis_result.
+'''
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+# Settings
+encoder_workers = 2
+preview_target_size = 200 * 1024  # bytes, the preview is sent before the app shows anything
+min_quality = 20
+max_quality = 90
+preview_quality = 40  # quality of the old fixed previews, kept whenever it fits the target size
+quality_step = 5  # first steps of the search on the full image, from the quarter area estimate
+optimize = True  # optimised Huffman tables, as PIL's optimize=True
+
+
+def encode(image, quality):
+    params = [int(cv2.IMWRITE_JPEG_QUALITY), int(quality), int(cv2.IMWRITE_JPEG_OPTIMIZE), int(optimize)]
+    ok, data = cv2.imencode('.jpg', image, params)
+    if not ok:
+        raise ValueError('JPEG encoding failed')
+    return data
+
+
+def bisect_quality(image, target_size, min_quality=min_quality, max_quality=max_quality):
+    ''' highest quality whose JPEG is at most target_size bytes, None when min_quality is too large '''
+    low, high = min_quality, max_quality
+    best = None
+    while low <= high:
+        quality = (low + high) // 2
+        if len(encode(image, quality)) <= target_size:
+            best = quality
+            low = quality + 1
+        else:
+            high = quality - 1
+    return best
+
+
+def refine_quality(image, target_size, quality, min_quality=min_quality, max_quality=max_quality, floor=None):
+    '''
+    highest quality whose JPEG of the full image is at most target_size bytes, searched from a first guess
+
+    Steps of quality_step up (or down) from the guess until the size crosses the target, then bisects the
+    last step. The floor quality is never stepped over on the way down, so it is kept when it fits.
+
+    :return: (encoded bytes, quality), at min_quality when nothing fits
+    '''
+    quality = min(max(quality, min_quality), max_quality)
+    data = encode(image, quality)
+    if len(data) <= target_size:
+        fit, fit_data, too_large = quality, data, None
+        while fit < max_quality:
+            quality = min(fit + quality_step, max_quality)
+            data = encode(image, quality)
+            if len(data) > target_size:
+                too_large = quality
+                break
+            fit, fit_data = quality, data
+    else:
+        fit, fit_data, too_large = None, None, quality
+        while too_large > min_quality:
+            quality = max(too_large - quality_step, min_quality)
+            if floor is not None and quality < floor < too_large:
+                quality = floor
+            data = encode(image, quality)
+            if len(data) <= target_size:
+                fit, fit_data = quality, data
+                break
+            too_large = quality
+        if fit is None:
+            return data, quality
+    if too_large is not None:
+        low, high = fit + 1, too_large - 1
+        while low <= high:
+            quality = (low + high) // 2
+            data = encode(image, quality)
+            if len(data) <= target_size:
+                fit, fit_data = quality, data
+                low = quality + 1
+            else:
+                high = quality - 1
+    return fit_data, fit
+
+
+def encode_to_size(image, target_size, min_quality=min_quality, max_quality=max_quality, floor=preview_quality):
+    '''
+    JPEG of the highest quality that is at most target_size bytes, on a half resolution image when
+    min_quality is still too large
+
+    The quality is estimated by bisecting a quarter area copy against a quarter of the target, which
+    comes out low, then refined on the full image from max(estimate, floor).
+
+    :return: (encoded bytes, quality, scale)
+    '''
+    scale = 1.
+    while True:
+        sample = cv2.resize(image, (image.shape[1] // 2, image.shape[0] // 2), interpolation=cv2.INTER_AREA)
+        quality = bisect_quality(sample, target_size / 4., min_quality, max_quality)
+        if quality is None:
+            quality = min_quality
+        if floor is not None:
+            quality = max(quality, floor)
+        data, quality = refine_quality(image, target_size, quality, min_quality, max_quality, floor)
+        if len(data) <= target_size or min(image.shape[:2]) < 128:
+            return data, quality, scale
+        image = sample
+        scale /= 2
+
+
+def write(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class ImageEncoder(object):
+    '''
+    workers -> encodes running at a time, each one holds a decoded full resolution frame (~50 MB on the
+    4656x3496 sensor), keep it low on the Pi
+    '''
+
+    def __init__(self, workers=encoder_workers):
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='encoder')
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def submit(self, source, outputs):
+        '''
+        :param source: path of a JPEG to decode, or a decoded BGR frame the caller no longer changes
+        :param outputs: {path: {'quality': q} or {'target_size': bytes}}, encoded in this order
+        :return: Future of {path: (size in bytes, quality, scale)}
+        '''
+        future = self.executor.submit(self.run, source, dict(outputs), time.time())
+        with self.lock:
+            for path in outputs:
+                self.pending[os.path.abspath(path)] = future
+        future.add_done_callback(lambda _: self.forget(outputs, future))
+        return future
+
+    def forget(self, outputs, future):
+        with self.lock:
+            for path in outputs:
+                if self.pending.get(os.path.abspath(path)) is future:
+                    del self.pending[os.path.abspath(path)]
+        # nobody may ever wait for the result, a failed encode is logged here
+        if not future.cancelled() and future.exception() is not None:
+            error = future.exception()
+            logging.error(f'Encoding {", ".join(outputs)} failed: {error!r}', exc_info=error)
+
+    def run(self, source, outputs, queued_at):
+        started_at = time.time()
+        image = cv2.imread(source) if isinstance(source, str) else source
+        if image is None:
+            raise IOError('could not read {}'.format(source))
+        results = {}
+        for path, options in outputs.items():
+            if 'target_size' in options:
+                data, quality, scale = encode_to_size(image, options['target_size'])
+            else:
+                data, quality, scale = encode(image, options['quality']), options['quality'], 1.
+            write(path, data.tobytes())
+            results[path] = (len(data), quality, scale)
+        logging.info(f'Encoded {", ".join(os.path.basename(path) for path in outputs)} '
+                     f'in {time.time() - started_at:.2f}s, {started_at - queued_at:.2f}s after submission.')
+        return results
+
+    def wait(self, path, timeout=None):
+        ''' block until a pending encode of path is written, a path that is not pending returns at once '''
+        with self.lock:
+            future = self.pending.get(os.path.abspath(path))
+        if future is not None:
+            future.result(timeout)
+
+
+_encoder = None
+_encoder_lock = threading.Lock()
+
+
+def start(workers=encoder_workers):
+    ''' the shared encoder, created on first use '''
+    global _encoder
+    with _encoder_lock:
+        if _encoder is None:
+            _encoder = ImageEncoder(workers)
+    return _encoder
+
+
+def submit(source, outputs):
+    return start().submit(source, outputs)
+
+
+def wait(path, timeout=None):
+    return start().wait(path, timeout)
+
+
+def synthetic_capture(path, size=(3496, 4656)):
+    ''' a quality=100 JPEG of a plate with colonies, at the resolution of the WaterScope Zero sensor '''
+    generator = np.random.RandomState(0)
+    image = np.full(size + (3,), (170, 180, 190), dtype=np.uint8)
+    cv2.circle(image, (size[1] // 2, size[0] // 2), min(size) // 2 - 50, (120, 150, 200), -1)
+    for _ in range(300):
+        x, y = generator.randint(0, size[1]), generator.randint(0, size[0])
+        colour = tuple(int(c) for c in generator.randint(20, 200, 3))
+        cv2.circle(image, (x, y), int(generator.randint(5, 40)), colour, -1)
+    noise = generator.normal(0, 4, image.shape)
+    image = np.clip(image + noise, 0, 255).astype(np.uint8)
+    cv2.imwrite(path, image, [int(cv2.IMWRITE_JPEG_QUALITY), 100])
+
+
+def _legacy_derive(filename, new_sample=1, chlorine=0):
+    ''' the re-encodes capture_image ran inline '''
+    from PIL import Image
+
+    image = Image.open(filename)
+    if new_sample == 1:
+        image.save(filename.replace('.jpg', '_preview.jpg'), quality=40, optimize=True)
+    image.save(filename.replace('.jpg', '_compressed.jpg'), quality=40 if chlorine == 1 else 75, optimize=True)
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    logging.basicConfig(level=logging.INFO, format='[%(levelname)s]\t(%(asctime)s)\t\t%(message)s')
+    filename = os.path.join(tempfile.mkdtemp(), '0000_capture.jpg')
+    synthetic_capture(filename)
+    print('capture {:.1f} MB'.format(os.path.getsize(filename) / 1024. / 1024.))
+
+    start_time = time.time()
+    _legacy_derive(filename)
+    legacy = time.time() - start_time
+    print('inline PIL re-encodes: {:.2f}s of analysis_result, preview {:.0f} kB'.format(
+        legacy, os.path.getsize(filename.replace('.jpg', '_preview.jpg')) / 1024.))
+
+    encoder = ImageEncoder()
+    start_time = time.time()
+    future = encoder.submit(filename, {
+        filename.replace('.jpg', '_preview.jpg'): {'target_size': preview_target_size},
+        filename.replace('.jpg', '_compressed.jpg'): {'quality': 75},
+    })
+    submitted = time.time() - start_time
+    encoder.wait(filename.replace('.jpg', '_preview.jpg'))
+    done = time.time() - start_time
+    for path, (size, quality, scale) in future.result().items():
+        print('  {:24s} {:6.0f} kB, quality {}, scale {}'.format(os.path.basename(path), size / 1024., quality, scale))
+    print('encoder pool: {:.3f}s of analysis_result, written {:.2f}s later in the background, {:.2f}s saved'.format(
+        submitted, done, legacy - submitted))
@@ -0,0 +1,146 @@
+'''
+Pool of TFLite interpreters that can be shared by several threads.
+
+A TFLite interpreter must not be used by two threads at the same time, so the pool
+keeps `size` interpreters of the same model (each running its kernels on `num_threads`
+threads) and hands one out per call. Inputs are written straight into the input tensor
+through the interpreter's tensor() view and the outputs are read through the same kind
+of view, without the set_tensor/get_tensor copies.
+
+    with pool.interpreter() as unet:
+        unet.input()[0] = cropped_img
+        unet.invoke()
+        blue = unet.output()[0, :, :, 0] < 0.42
+
+The views are only valid while the interpreter is checked out, and TFLite refuses to
+invoke while a view of its buffers is still referenced: index the view returned by
+input() straight away instead of keeping it in a variable, and copy whatever output
+has to outlive the with block.
+'''
+
+import queue
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    from tflite_runtime.interpreter import Interpreter  # on Pi
+except ImportError:
+    from tensorflow.lite import Interpreter
+
+
+class PooledInterpreter(object):
+    ''' one interpreter of the pool with views on its first input and output tensors '''
+
+    def __init__(self, model_path, num_threads, interpreter_class=Interpreter):
+        self.interpreter = interpreter_class(model_path=model_path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self.input_details = self.interpreter.get_input_details()
+        self.output_details = self.interpreter.get_output_details()
+        self._input = self.interpreter.tensor(self.input_details[0]['index'])
+        self._output = self.interpreter.tensor(self.output_details[0]['index'])
+
+    def input(self):
+        ''' writable view on the input tensor '''
+        return self._input()
+
+    def output(self):
+        ''' view on the output tensor, overwritten by the next invoke '''
+        return self._output()
+
+    def invoke(self):
+        self.interpreter.invoke()
+
+
+class InterpreterPool(object):
+    '''
+    model_path -> .tflite model
+    size -> number of interpreters, i.e. of calls that can run at the same time
+    num_threads -> kernel threads of each interpreter
+    '''
+
+    def __init__(self, model_path, size=1, num_threads=1, interpreter_class=Interpreter):
+        self.model_path = model_path
+        self.size = size
+        self.num_threads = num_threads
+        self._idle = queue.LifoQueue()
+        for _ in range(size):
+            self._idle.put(PooledInterpreter(model_path, num_threads, interpreter_class))
+        # the same for every interpreter of the pool
+        self.input_details = self._idle.queue[0].input_details
+        self.output_details = self._idle.queue[0].output_details
+
+    @contextmanager
+    def interpreter(self):
+        ''' check out an idle interpreter, waiting for one if they are all busy '''
+        interpreter = self._idle.get()
+        try:
+            yield interpreter
+        finally:
+            self._idle.put(interpreter)
+
+    def run(self, img, read=None):
+        '''
+        copy img into the input tensor (img broadcasts to the input shape), invoke and return
+        read(output view), or a copy of the output when read is None
+        '''
+        with self.interpreter() as interpreter:
+            interpreter.input()[...] = img
+            interpreter.invoke()
+            if read is None:
+                return interpreter.output().copy()
+            return read(interpreter.output())
+
+    def warm_up(self):
+        ''' one dummy pass through every interpreter, so the first sample does not pay for the lazy allocations '''
+        interpreters = [self._idle.get() for _ in range(self.size)]
+        try:
+            for interpreter in interpreters:
+                interpreter.input()[...] = 0
+                interpreter.invoke()
+        finally:
+            for interpreter in interpreters:
+                self._idle.put(interpreter)
+
+
+def benchmark(model_path, n_images=64, size=4, num_threads=1, interpreter_class=Interpreter):
+    ''' check the pool against a plain set_tensor/get_tensor interpreter, then time it from 1 and from size threads '''
+    from concurrent.futures import ThreadPoolExecutor
+
+    reference = interpreter_class(model_path=model_path, num_threads=num_threads)
+    reference.allocate_tensors()
+    input_details = reference.get_input_details()[0]
+    output_index = reference.get_output_details()[0]['index']
+    generator = np.random.RandomState(0)
+    images = [generator.random_sample(input_details['shape']).astype(input_details['dtype']) for _ in range(n_images)]
+
+    start = time.time()
+    expected = []
+    for img in images:
+        reference.set_tensor(input_details['index'], img)
+        reference.invoke()
+        expected.append(reference.get_tensor(output_index))
+    print('set_tensor/get_tensor: {:.2f} ms per image'.format(1000 * (time.time() - start) / n_images))
+
+    pool = InterpreterPool(model_path, size, num_threads, interpreter_class)
+    pool.warm_up()
+    for workers in (1, size):
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            outputs = list(executor.map(pool.run, images))
+        print('pool of {}, {} threads: {:.2f} ms per image'.format(size, workers,
+                                                                 1000 * (time.time() - start) / n_images))
+        assert all(np.array_equal(a, b) for a, b in zip(outputs, expected)), 'pool output differs'
+    print('pool outputs identical to set_tensor/get_tensor')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='check and time the TFLite interpreter pool')
+    parser.add_argument('model', nargs='?', default='RGB_CNN_model.tflite')
+    parser.add_argument('--size', type=int, default=4)
+    parser.add_argument('--num-threads', type=int, default=1)
+    args = parser.parse_args()
+    benchmark(args.model, size=args.size, num_threads=args.num_threads)
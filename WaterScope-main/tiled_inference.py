@@ -0,0 +1,157 @@
+'''
+Tiled YOLOR inference on the full resolution dish crop.
+
+analysis_image normally squashes the dish crop (about 2800 px across on the 4656x3496
+WaterScope Zero sensor) into 640x640, and the smallest colonies are gone after that.
+detect_tiled() runs the model instead on overlapping imgsz x imgsz tiles of the crop.
+Only the tiles touching the circular ROI are used, and they go through Darknet
+batch_size at a time.
+
+Each tile gets the usual NMS. Boxes touching a tile edge that lies inside the crop are
+dropped, because the overlap (larger than a colony) puts the whole colony in the
+neighbouring tile. The remaining boxes are shifted into crop coordinates and merged
+with a cross-tile NMS based on box_iou.
+
+Memory stays bounded: the tiles are copied into one reused uint8 batch buffer, and only
+batch_size tiles are in the model at a time.
+'''
+
+import math
+import time
+
+import numpy as np
+import torch
+
+from yolor_pi.inference_script.utils.general import box_iou, non_max_suppression
+
+# Settings
+tile_overlap = 128  # pixels shared by neighbouring tiles, larger than the biggest colony
+tile_batch_size = 1  # tiles per forward pass, each tile adds ~120 MB of activations, keep it low on the 1 GB Pi
+edge_margin = 2  # boxes within this many pixels of an inner tile edge are left to the neighbouring tile
+
+
+def tile_origins(size, tile=640, overlap=tile_overlap):
+    ''' tile start positions covering [0, size), spread evenly so neighbours share at least overlap pixels '''
+    if size <= tile:
+        return [0]
+    n = int(math.ceil((size - tile) / float(tile - overlap))) + 1
+    return [int(round(v)) for v in np.linspace(0, size - tile, n)]
+
+
+def roi_tiles(height, width, tile=640, overlap=tile_overlap):
+    ''' (x0, y0) of the tiles that touch the circle inscribed in the crop '''
+    cx, cy, r = width / 2., height / 2., min(width, height) / 2.
+    tiles = []
+    for y0 in tile_origins(height, tile, overlap):
+        for x0 in tile_origins(width, tile, overlap):
+            # distance from the centre to the closest point of the tile
+            dx = max(x0 - cx, 0, cx - (x0 + tile))
+            dy = max(y0 - cy, 0, cy - (y0 + tile))
+            if dx * dx + dy * dy < r * r:
+                tiles.append((x0, y0))
+    return tiles
+
+
+def inner_edge_boxes(det, x0, y0, tile, height, width, margin=edge_margin):
+    ''' True for the boxes cut by an edge of the tile that is not an edge of the crop '''
+    cut = torch.zeros(len(det), dtype=torch.bool, device=det.device)
+    if x0 > 0:
+        cut |= det[:, 0] <= margin
+    if y0 > 0:
+        cut |= det[:, 1] <= margin
+    if x0 + tile < width:
+        cut |= det[:, 2] >= tile - margin
+    if y0 + tile < height:
+        cut |= det[:, 3] >= tile - margin
+    return cut
+
+
+def merge_tiles(det, iou_thresh=0.5):
+    ''' cross-tile NMS: keep the most confident of the boxes overlapping by more than iou_thresh (class agnostic) '''
+    if len(det) == 0:
+        return det
+    det = det[det[:, 4].argsort(descending=True)]
+    iou = box_iou(det[:, :4], det[:, :4])
+    keep = torch.ones(len(det), dtype=torch.bool, device=det.device)
+    for i in range(len(det)):
+        if keep[i]:
+            keep[i + 1:] &= iou[i, i + 1:] <= iou_thresh
+    return det[keep]
+
+
+def detect_tiled(model, crop, tile=640, conf_thresh=0.17, iou_thresh=0.5, overlap=tile_overlap,
+                 batch_size=tile_batch_size, device='cpu', half=False):
+    '''
+    :param model: Darknet or an inference backend, called as model(img)[0]
+    :param crop: BGR dish crop at full resolution, black outside the dish
+    :return: (n, 6) tensor of x1, y1, x2, y2, conf, cls in crop pixels, and the number of tiles
+    '''
+    height, width = crop.shape[:2]
+    tiles = roi_tiles(height, width, tile, overlap)
+    batch = np.zeros((min(batch_size, len(tiles)), 3, tile, tile), dtype=np.uint8)
+    detections = []
+    for start in range(0, len(tiles), batch_size):
+        origins = tiles[start:start + batch_size]
+        batch[:] = 0
+        for k, (x0, y0) in enumerate(origins):
+            region = crop[y0:y0 + tile, x0:x0 + tile]
+            # BGR to RGB, HWC to CHW, padded with black at the right and bottom crop edges
+            batch[k, :, :region.shape[0], :region.shape[1]] = region[:, :, ::-1].transpose(2, 0, 1)
+
+        with torch.no_grad():
+            img = torch.from_numpy(batch[:len(origins)]).to(device)
+            img = img.half() if half else img.float()
+            img /= 255.0
+            pred = model(img, augment=False)[0]
+            pred = non_max_suppression(pred, conf_thresh, iou_thresh, classes=None, agnostic=True)
+
+        for (x0, y0), det in zip(origins, pred):
+            if det is None or len(det) == 0:
+                continue
+            det = det[~inner_edge_boxes(det, x0, y0, tile, height, width)]
+            det[:, [0, 2]] += x0
+            det[:, [1, 3]] += y0
+            detections.append(det)
+
+    det = torch.cat(detections) if detections else torch.zeros((0, 6), device=device)
+    return merge_tiles(det, iou_thresh), len(tiles)
+
+
+if __name__ == '__main__':
+    import argparse
+    import resource
+
+    import cv2
+    from yolor_model import load_model
+    from yolor_pi.inference_script.models.models import Darknet
+
+    parser = argparse.ArgumentParser(description='time tiled inference on a dish crop')
+    parser.add_argument('image', nargs='?', help='full resolution dish crop, a synthetic 2800 px dish if omitted')
+    parser.add_argument('--cfg', default='yolor_pi/inference_script/yolor_p6small_filter')
+    parser.add_argument('--weights', help='trained weights, random weights are used for timing if omitted')
+    parser.add_argument('--batch-size', type=int, default=tile_batch_size)
+    args = parser.parse_args()
+
+    # boxes of one colony seen by two tiles merge, separate colonies do not
+    det = torch.tensor([[10., 10., 30., 30., 0.9, 0], [11., 10., 31., 30., 0.8, 0], [40., 40., 60., 60., 0.7, 1]])
+    assert len(merge_tiles(det)) == 2
+    cut = inner_edge_boxes(torch.tensor([[0., 5., 20., 20.], [300., 300., 320., 320.], [630., 5., 640., 20.]]),
+                           x0=640, y0=0, tile=640, height=2000, width=2000)
+    assert cut.tolist() == [True, False, True]
+
+    if args.image:
+        crop = cv2.imread(args.image)
+    else:
+        crop = np.zeros((2800, 2800, 3), dtype=np.uint8)
+        cv2.circle(crop, (1400, 1400), 1400, (200, 210, 220), -1)
+    if args.weights:
+        model = load_model(args.cfg, args.weights)
+    else:
+        torch.manual_seed(0)
+        model = Darknet(args.cfg, 640).cpu().eval()
+
+    start = time.time()
+    det, n_tiles = detect_tiled(model, crop, batch_size=args.batch_size)
+    print('{} tiles of {}x{} px: {} detections in {:.1f}s, peak memory {:.0f} MB'.format(
+        n_tiles, crop.shape[1], crop.shape[0], len(det), time.time() - start,
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.))
@@ -0,0 +1,260 @@
+'''
+Resumable receive path of the update file sent by the app (autofocus.update).
+
+update() used to grow a bytearray with buffer += connection.recv(...) for every part,
+hash it once complete and append it to a file named after the instruction ('update').
+A dropped connection meant sending the whole file again.
+
+receive_update() reads every part with recv_into into one buffer allocated up front,
+and feeds the SHA-1 with each received chunk. Verified parts are written at their
+offset of the pre-sized file in update_folder. Every checkpoint_parts parts (and when
+the transfer ends or drops) they are synced to the card and recorded in the sidecar
+manifest .<name>.parts.json (atomic replace, as the other state files). The manifest
+is keyed by the size, package size and part hashes of the file, so a different file
+starts over.
+
+When the app asks to resume ('resume': true in the update details), the device answers
+with the first missing part and the app starts there. Apps that do not ask send the
+file from the start, as before.
+
+`python update_receiver.py` times the old and the new receive path on a multi-megabyte
+file over a socketpair, and drops the connection halfway to check the resume.
+'''
+
+import hashlib
+import json
+import logging
+import os
+import socket
+
+from crop_calibration import atomic_write
+from file_transfer import calculate_progress, package_end, package_offsets
+
+# Settings
+update_folder = 'updates'
+part_timeout = 45  # seconds to receive one part
+checkpoint_parts = 8  # parts written between two fsyncs and manifest updates, resent at most after a power cut
+
+
+def update_path(name):
+    ''' where an update file is stored, never outside update_folder '''
+    return os.path.join(update_folder, os.path.basename(str(name)) or 'update')
+
+
+def manifest_path(path):
+    directory, name = os.path.split(path)
+    return os.path.join(directory, '.{}.parts.json'.format(name))
+
+
+class UpdateManifest(object):
+    '''
+    path -> update file the parts are written to
+    verified -> parts written and matching their hash
+    '''
+
+    def __init__(self, path, size, package_size, hashes):
+        self.path = path
+        self.size = size
+        self.package_size = package_size
+        self.hashes = list(hashes)
+        self.key = hashlib.sha1(''.join(self.hashes).encode('utf-8')).hexdigest()
+        self.verified = set()
+
+    def load(self):
+        ''' restore the verified parts of the same file, and size the update file '''
+        if os.path.exists(manifest_path(self.path)) and os.path.exists(self.path):
+            try:
+                with open(manifest_path(self.path)) as f:
+                    state = json.load(f)
+                if (state['size'], state['packageSize'], state['key']) == (self.size, self.package_size, self.key):
+                    self.verified = set(int(part) for part in state['verified'])
+            except (ValueError, KeyError, TypeError) as e:
+                logging.warning(f'Ignoring unreadable update manifest of "{self.path}": {e}')
+        if not self.verified and os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'r+b' if self.verified else 'wb') as file:
+            file.truncate(self.size)
+        return self
+
+    def save(self):
+        atomic_write(manifest_path(self.path), json.dumps({
+            'size': self.size,
+            'packageSize': self.package_size,
+            'key': self.key,
+            'verified': sorted(self.verified),
+        }))
+
+    def mark(self, parts):
+        self.verified.update(parts)
+        self.save()
+
+    def first_missing(self):
+        for part in range(len(self.hashes)):
+            if part not in self.verified:
+                return part
+        return len(self.hashes)
+
+    def complete(self):
+        return len(self.verified) == len(self.hashes)
+
+    def received(self):
+        ''' bytes verified so far '''
+        return sum(package_end(self.size, part * self.package_size, self.package_size) - part * self.package_size
+                   for part in self.verified)
+
+    def remove(self):
+        if os.path.exists(manifest_path(self.path)):
+            os.remove(manifest_path(self.path))
+
+
+def receive_part(channel, view):
+    ''' fill view from the channel, SHA-1 of the bytes computed as they arrive '''
+    digest = hashlib.sha1()
+    received = 0
+    while received < len(view):
+        n = channel.recv_into(view[received:])
+        if n == 0:
+            raise ConnectionError('connection closed')
+        digest.update(view[received:received + n])
+        received += n
+    return digest.hexdigest()
+
+
+def receive_update(channel, manifest, acknowledge, first_part=0):
+    '''
+    receive the parts from first_part on, writing and recording the ones that match their hash
+
+    :param acknowledge: callable (part, status) answering the app, 'ok' or 'invalid' (the app sends the part again)
+    '''
+    buffer = bytearray(manifest.package_size)
+    view = memoryview(buffer)
+    fd = os.open(manifest.path, os.O_RDWR)
+    written = []
+
+    def checkpoint():
+        # the parts are on the card before the manifest says so
+        if written:
+            os.fsync(fd)
+            manifest.mark(written)
+            del written[:]
+
+    channel.settimeout(part_timeout)
+    try:
+        for offset in package_offsets(manifest.size, manifest.package_size)[first_part:]:
+            part = offset // manifest.package_size
+            part_view = view[:package_end(manifest.size, offset, manifest.package_size) - offset]
+            while True:
+                if receive_part(channel, part_view) == manifest.hashes[part]:
+                    os.pwrite(fd, part_view, offset)
+                    written.append(part)
+                    if len(written) >= checkpoint_parts:
+                        checkpoint()
+                    acknowledge(part, 'ok')
+                    break
+                logging.warning(
+                    f'Update file got corrupted at offset {offset}, '
+                    f'which is equals to {calculate_progress(manifest.size, offset)}%. '
+                    f'Retrying transmission from this offset.'
+                )
+                acknowledge(part, 'invalid')
+    finally:
+        channel.settimeout(None)
+        try:
+            checkpoint()
+        finally:
+            os.close(fd)
+    return manifest.complete()
+
+
+def _legacy_receive(connection, path, size, package_size, hashes, acknowledge):
+    ''' the receive loop of the old update() '''
+    buffer_size = package_size
+    with open(path, 'w+b') as file:
+        for part, hash in enumerate(hashes):
+            if part == (len(hashes) - 1):
+                buffer_size = size - part * buffer_size
+            checksum = None
+            while checksum != hash:
+                buffer = bytearray()
+                while buffer_size != len(buffer):
+                    buffer += connection.recv(buffer_size - len(buffer))
+                checksum = hashlib.sha1(buffer).hexdigest()
+                if checksum == hash:
+                    file.write(buffer)
+                    acknowledge(part, 'ok')
+                else:
+                    acknowledge(part, 'invalid')
+
+
+def _send_update(connection, data, package_size, first_part=0, stop_part=None):
+    ''' the app side: send the parts from first_part, waiting for each one byte acknowledgement '''
+    for offset in package_offsets(len(data), package_size)[first_part:stop_part]:
+        connection.sendall(data[offset:package_end(len(data), offset, package_size)])
+        connection.recv(1)
+    if stop_part is not None:
+        # the connection drops
+        connection.shutdown(socket.SHUT_WR)
+
+
+if __name__ == '__main__':
+    import tempfile
+    import threading
+    import time
+    import tracemalloc
+
+    from bluetooth_protocol import Channel
+
+    size = 8 * 1024 * 1024 + 12345
+    package_size = 50 * 1024
+    data = os.urandom(size)
+    hashes = [hashlib.sha1(data[offset:package_end(size, offset, package_size)]).hexdigest()
+              for offset in package_offsets(size, package_size)]
+    directory = tempfile.mkdtemp()
+
+    def run(receive, first_part=0, stop_part=None):
+        device, app = socket.socketpair()
+        sender = threading.Thread(target=_send_update, args=(app, data, package_size, first_part, stop_part))
+        sender.start()
+        tracemalloc.start()
+        start = time.time()
+        try:
+            receive(device, lambda part, status: device.sendall(b'1'))
+        except ConnectionError:
+            pass
+        elapsed = time.time() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        sender.join()
+        device.close()
+        app.close()
+        return elapsed, peak
+
+    path = os.path.join(directory, 'legacy')
+    elapsed, peak = run(lambda connection, acknowledge: _legacy_receive(
+        connection, path, size, package_size, hashes, acknowledge))
+    with open(path, 'rb') as f:
+        assert f.read() == data
+    print('{:22s} {:6.0f} ms, {:6.1f} MB/s, peak allocations {:6.0f} kB'.format(
+        'bytearray += recv', 1000 * elapsed, size / elapsed / 1024 / 1024, peak / 1024.))
+
+    path = os.path.join(directory, 'update')
+    elapsed, peak = run(lambda connection, acknowledge: receive_update(
+        Channel(connection), UpdateManifest(path, size, package_size, hashes).load(), acknowledge))
+    with open(path, 'rb') as f:
+        assert f.read() == data
+    print('{:22s} {:6.0f} ms, {:6.1f} MB/s, peak allocations {:6.0f} kB'.format(
+        'recv_into + manifest', 1000 * elapsed, size / elapsed / 1024 / 1024, peak / 1024.))
+
+    # the connection drops after 60% of the parts, the next connection resumes at the first missing part
+    path = os.path.join(directory, 'resumed')
+    stop = int(0.6 * len(hashes))
+    run(lambda connection, acknowledge: receive_update(
+        Channel(connection), UpdateManifest(path, size, package_size, hashes).load(), acknowledge), stop_part=stop)
+    manifest = UpdateManifest(path, size, package_size, hashes).load()
+    assert manifest.first_missing() == stop
+    elapsed, _ = run(lambda connection, acknowledge: receive_update(
+        Channel(connection), manifest, acknowledge, manifest.first_missing()), first_part=stop)
+    with open(path, 'rb') as f:
+        assert f.read() == data and manifest.complete()
+    print('dropped after part {} of {}, resumed there: {} parts ({:.0f} ms) instead of all of them'.format(
+        stop, len(hashes), len(hashes) - stop, 1000 * elapsed))
@@ -0,0 +1,250 @@
+'''
+Load the YOLOR colony model ready for inference on the Pi.
+
+prepare_model() is run once at load time: Conv2d + BatchNorm2d pairs are fused
+(Darknet.fuse), the ImplicitA/ImplicitM layers of the detection heads are folded into
+their 1x1 output convs (Darknet.fold_implicit) and torch uses the 4 cores of the Pi.
+With check=True the prepared model is compared with the unprepared one on the same
+input, the raw predictions and the detections after NMS have to match. The check
+costs a copy of the model and two forwards, so load_model() skips it unless asked;
+the export and the benchmark below always run it.
+
+The prepared model can be exported (traced) to TorchScript or ONNX and run through
+load_backend(), which avoids the per-layer Python dispatch of Darknet.forward_once.
+'''
+
+import copy
+import inspect
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from yolor_pi.inference_script.models.models import Darknet
+from yolor_pi.inference_script.utils.datasets import letterbox
+from yolor_pi.inference_script.utils.general import non_max_suppression
+
+# Settings
+num_threads = 4  # Raspberry Pi 4 cores
+quantized_engine = 'qnnpack'  # int8 kernels for ARM
+
+
+def letterbox_tensor(cropped, imgsz=640):
+    ''' letterbox a BGR crop and convert it to a contiguous 3 x H x W RGB array, as LoadImages does for a file '''
+    img = letterbox(cropped, new_shape=imgsz, auto_size=64)[0]
+    return np.ascontiguousarray(img[:, :, ::-1].transpose(2, 0, 1))
+
+
+def predictions_match(reference, prepared, img, conf_thresh=0.17, iou_thresh=0.5, rtol=1e-3, atol=1e-3):
+    ''' run both models on img and compare the raw predictions and the NMS detections
+
+    :return: (match, max abs difference of the raw predictions)
+    '''
+    with torch.no_grad():
+        pred_ref = reference(img)[0]
+        pred = prepared(img)[0]
+    max_diff = float((pred_ref - pred).abs().max())
+    match = torch.allclose(pred_ref, pred, rtol=rtol, atol=atol)
+
+    det_ref = non_max_suppression(pred_ref, conf_thresh, iou_thresh, classes=None, agnostic=True)
+    det = non_max_suppression(pred, conf_thresh, iou_thresh, classes=None, agnostic=True)
+    for a, b in zip(det_ref, det):
+        if a is None or b is None:
+            match = match and a is None and b is None
+        else:
+            # same boxes (within a pixel), same classes
+            match = match and a.shape == b.shape and torch.allclose(a[:, :4], b[:, :4], atol=1.) and \
+                    torch.equal(a[:, -1], b[:, -1])
+    return match, max_diff
+
+
+def prepare_model(model, imgsz=640, threads=num_threads, check=True, check_img=None):
+    ''' fuse and fold the model in place for inference, optionally checking it against the original
+
+    :param model: Darknet in eval mode with its weights loaded
+    :param check_img: (1, 3, imgsz, imgsz) float tensor for the check, random if None
+    :return: the prepared model
+    '''
+    torch.set_num_threads(threads)
+    reference = copy.deepcopy(model) if check else None
+
+    start = time.time()
+    model.fuse()
+    model.fold_implicit()
+    model.eval()
+    print('model prepared in {:.2f}s, {} threads'.format(time.time() - start, torch.get_num_threads()))
+
+    if check:
+        if check_img is None:
+            check_img = torch.rand((1, 3, imgsz, imgsz), generator=torch.Generator().manual_seed(0))
+        check_img = check_img.to(next(model.parameters()).device)
+        match, max_diff = predictions_match(reference, model, check_img)
+        print('prepared model {} the original (max difference {:.2e})'.format(
+            'matches' if match else 'DOES NOT MATCH', max_diff))
+        if not match:
+            raise RuntimeError('prepared model does not match the original, max difference {:.2e}'.format(max_diff))
+    return model
+
+
+def load_model(cfg, weights, imgsz=640, device='cpu', prepare=True, check=False):
+    ''' build the Darknet model from cfg, load the weights and prepare it for inference, check=True compares it with the original '''
+    model = Darknet(cfg, imgsz).cpu()
+    model.load_state_dict(torch.load(weights, map_location=device)['model'])
+    model.to(device).eval()
+    if prepare:
+        prepare_model(model, imgsz, check=check)
+    return model
+
+
+class ExportWrapper(torch.nn.Module):
+    ''' Darknet returning only the inference predictions, the graph that gets exported '''
+
+    def __init__(self, model):
+        super(ExportWrapper, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model(x)[0]
+
+
+def default_export_path(backend, imgsz=640):
+    return 'yolor_{}{}'.format(imgsz, {'onnx': '.onnx', 'int8': '_int8.torchscript.pt'}.get(backend, '.torchscript.pt'))
+
+
+def export_format(path):
+    return 'onnx' if path.endswith('.onnx') else 'torchscript'
+
+
+def export_model(model, path, imgsz=640):
+    ''' trace the prepared model at imgsz x imgsz into a TorchScript (.pt) or ONNX (.onnx) file
+
+    The YOLO grids are built for imgsz during the trace, so the exported graph only
+    takes (N, 3, imgsz, imgsz) inputs.
+    '''
+    model.eval()
+    wrapper = ExportWrapper(model).eval()
+    img = torch.zeros((1, 3, imgsz, imgsz))
+    start = time.time()
+    with torch.no_grad():
+        # the YOLO layers build their grids on the first forward, build them before tracing
+        wrapper(img)
+        if export_format(path) == 'onnx':
+            options = {}
+            if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+                # newer torch defaults to the dynamo exporter, keep the tracing one of older releases
+                options['dynamo'] = False
+            torch.onnx.export(wrapper, img, path, input_names=['images'], output_names=['pred'], opset_version=12,
+                              dynamic_axes={'images': {0: 'batch'}, 'pred': {0: 'batch'}}, **options)
+        else:
+            traced = torch.jit.freeze(torch.jit.trace(wrapper, img))
+            traced.save(path)
+    print('exported {} in {:.1f}s'.format(path, time.time() - start))
+    return path
+
+
+class TorchScriptBackend(object):
+    ''' runs an exported TorchScript graph, called like Darknet: backend(img)[0] are the predictions '''
+
+    def __init__(self, path, device='cpu'):
+        self.module = torch.jit.load(path, map_location=device)
+
+    def __call__(self, img, augment=False):
+        return self.module(img), None
+
+
+class OnnxBackend(object):
+    ''' runs an exported ONNX graph with onnxruntime on the CPU, called like Darknet '''
+
+    def __init__(self, path, threads=num_threads):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+    def __call__(self, img, augment=False):
+        pred = self.session.run(None, {'images': img.cpu().numpy()})[0]
+        return torch.from_numpy(pred), None
+
+
+def load_backend(backend, model, path=None, imgsz=640):
+    ''' wrap the prepared model into an inference backend: 'eager' (the model itself),
+    'torchscript', 'onnx' or 'int8' (quantised TorchScript from yolor_quantize.py).
+    The graph is exported to path first when the file does not exist. '''
+    if backend == 'eager':
+        return model
+    if backend not in ('torchscript', 'onnx', 'int8'):
+        raise ValueError('unknown inference backend {}'.format(backend))
+    if path is None:
+        path = default_export_path(backend, imgsz)
+    if backend == 'int8':
+        # only yolor_quantize.py can build it, it needs calibration plates
+        if not os.path.exists(path):
+            print('int8 model {} not found, run yolor_quantize.py first. Using the fp32 model'.format(path))
+            return model
+        torch.backends.quantized.engine = quantized_engine
+        print('running the model through int8 TorchScript ({})'.format(path))
+        return TorchScriptBackend(path)
+    if export_format(path) != backend:
+        raise ValueError('{} is not a {} file'.format(path, backend))
+    if not os.path.exists(path):
+        export_model(model, path, imgsz)
+    print('running the model through {} ({})'.format(backend, path))
+    if backend == 'onnx':
+        return OnnxBackend(path)
+    return TorchScriptBackend(path, device=next(model.parameters()).device)
+
+
+def benchmark(model, imgsz=640, repeat=5, backends=('torchscript', 'onnx')):
+    ''' average forward time of the eager model, its prepared copy and the exported backends '''
+    img = torch.rand((1, 3, imgsz, imgsz), generator=torch.Generator().manual_seed(0))
+    prepared = prepare_model(copy.deepcopy(model), imgsz)
+    runners = [('eager', model), ('eager prepared', prepared)]
+    directory = tempfile.mkdtemp()
+    for backend in backends:
+        path = os.path.join(directory, 'yolor.onnx' if backend == 'onnx' else 'yolor.torchscript.pt')
+        try:
+            runners.append((backend, load_backend(backend, prepared, path, imgsz)))
+        except ImportError as e:
+            print('skipping {}: {}'.format(backend, e))
+
+    with torch.no_grad():
+        reference = model(img)[0]
+        for name, runner in runners:
+            pred = runner(img)[0]
+            start = time.time()
+            for _ in range(repeat):
+                runner(img)
+            print('{}: {:.3f}s per image, max difference {:.2e}'.format(
+                name, (time.time() - start) / repeat, float((pred - reference).abs().max())))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='prepare, export and benchmark the YOLOR model')
+    parser.add_argument('--cfg', default='yolor_pi/inference_script/yolor_p6small_filter')
+    parser.add_argument('--weights', help='trained weights, random weights are used for timing if omitted')
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--export', help='write the prepared model to this .pt (TorchScript) or .onnx file')
+    args = parser.parse_args()
+
+    torch.set_num_threads(num_threads)
+    if args.weights:
+        model = Darknet(args.cfg, args.imgsz).cpu()
+        model.load_state_dict(torch.load(args.weights, map_location='cpu')['model'])
+    else:
+        # random weights, with trained-like batchnorm statistics and implicit knowledge
+        torch.manual_seed(0)
+        model = Darknet(args.cfg, args.imgsz).cpu()
+        for module in model.modules():
+            if isinstance(module, torch.nn.BatchNorm2d):
+                torch.nn.init.uniform_(module.running_mean, -0.1, 0.1)
+                torch.nn.init.uniform_(module.running_var, 0.5, 1.5)
+    model.eval()
+
+    if args.export:
+        export_model(prepare_model(model, args.imgsz), args.export, args.imgsz)
+    else:
+        benchmark(model, args.imgsz)
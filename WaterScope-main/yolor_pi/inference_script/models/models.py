@@ -641,6 +641,44 @@ class Darknet(nn.Module):
         self.module_list = fused_list
         self.info() if not ONNX_EXPORT else None  # yolov3-spp reduced from 225 to 152 layers
 
+    def fold_implicit(self):
+        # Fold the ImplicitA/ImplicitM knowledge of the yolor heads into their 1x1 output conv (inference only)
+        # shift_channels -> conv -> control_channels computes m * (W (x + a) + b) = (m W) x + m (W a + b)
+        # Only folded when the conv is a plain 1x1 Conv2d and the intermediate outputs are not read by other layers
+        referenced = set()  # outputs read by other layers (routs also flags every conv without bn)
+        for j, module in enumerate(self.module_list):
+            referenced.update(j + l if l < 0 else l for l in getattr(module, 'layers', []))
+        folded = 0
+        for i, module in enumerate(self.module_list):
+            if i + 2 >= len(self.module_list) or module.__class__.__name__ != 'ShiftChannel':
+                continue
+            shift, conv, control = module, self.module_list[i + 1], self.module_list[i + 2]
+            if isinstance(conv, nn.Sequential) and len(conv) == 1:
+                conv = conv[0]
+            if not (isinstance(conv, nn.Conv2d) and conv.kernel_size == (1, 1) and conv.padding == (0, 0) and conv.groups == 1 and
+                    control.__class__.__name__ == 'ControlChannel' and
+                    self.module_list[shift.layers[0]].__class__.__name__ == 'ImplicitA' and
+                    self.module_list[control.layers[0]].__class__.__name__ == 'ImplicitM' and
+                    i not in referenced and i + 1 not in referenced):
+                continue
+
+            with torch.no_grad():
+                a = self.module_list[shift.layers[0]].implicit.view(-1)
+                m = self.module_list[control.layers[0]].implicit.view(-1)
+                w = conv.weight.view(conv.out_channels, -1)
+                b = conv.bias if conv.bias is not None else torch.zeros(conv.out_channels, device=w.device)
+                fusedconv = nn.Conv2d(conv.in_channels, conv.out_channels, kernel_size=1, stride=conv.stride,
+                                      bias=True).requires_grad_(False).to(w.device)
+                fusedconv.weight.copy_((w * m.view(-1, 1)).view_as(conv.weight))
+                fusedconv.bias.copy_((torch.mv(w, a) + b) * m)
+
+            self.module_list[i] = nn.Identity()
+            self.module_list[i + 1] = nn.Sequential(fusedconv)
+            self.module_list[i + 2] = nn.Identity()
+            folded += 1
+        print('Folded %g implicit layer pairs' % folded)
+        return folded
+
     def info(self, verbose=False):
         torch_utils.model_info(self, verbose)
 
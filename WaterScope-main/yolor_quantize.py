@@ -0,0 +1,176 @@
+'''
+Int8 variant of the YOLOR colony model for the Pi (qnnpack).
+
+Every convolution of the prepared (fused and folded) model is wrapped between a
+QuantStub and a DeQuantStub, so the convolutions run in int8 while the SiLU
+activations, shortcuts, concatenations and YOLO layers stay in fp32 (eager mode
+quantisation has no int8 SiLU). The activation ranges are calibrated on a folder of
+cropped plates (the cropped/ images written by analysis_image(save_crop=True)) and the
+converted model is traced to TorchScript, which count_colony_yolor runs with
+inference_backend = 'int8'.
+
+accuracy_report() runs the fp32 and the int8 model on a reference set of cropped
+plates and prints the E. coli and coliform counts of both next to their latency.
+'''
+
+import sys
+sys.path.append("/home/pi/.local/lib/python3.7/site-packages")
+import copy
+import glob
+import os
+import time
+
+import cv2
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.quantization
+
+from yolor_pi.inference_script.utils.general import non_max_suppression
+from yolor_model import load_model, export_model, default_export_path, letterbox_tensor, quantized_engine
+
+# Settings
+conf_thresh = 0.17
+iou_thresh = 0.5
+
+
+class QuantizedConv(nn.Module):
+    ''' int8 convolution inside an fp32 model: quantise the input, convolve, dequantise the output '''
+
+    def __init__(self, conv):
+        super(QuantizedConv, self).__init__()
+        self.quant = torch.quantization.QuantStub()
+        self.conv = conv
+        self.dequant = torch.quantization.DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.conv(self.quant(x)))
+
+
+def wrap_convs(model, qconfig):
+    ''' put every Conv2d of the Darknet layers in a QuantizedConv carrying qconfig '''
+    wrapped = 0
+    for layer in model.module_list:
+        if not isinstance(layer, nn.Sequential):
+            continue
+        for name, module in list(layer.named_children()):
+            if isinstance(module, nn.Conv2d):
+                block = QuantizedConv(module)
+                block.qconfig = qconfig
+                setattr(layer, name, block)
+                wrapped += 1
+    return wrapped
+
+
+def load_plates(folder, imgsz=640, max_images=None):
+    ''' cropped plate images of a folder as (1, 3, imgsz, imgsz) float tensors, prepared like analysis_image '''
+    paths = sorted(glob.glob(os.path.join(folder, '*.jpg')) + glob.glob(os.path.join(folder, '*.png')))
+    if max_images is not None:
+        paths = paths[:max_images]
+    plates = []
+    for path in paths:
+        cropped = cv2.imread(path)
+        if cropped is None:
+            print('skipping unreadable {}'.format(path))
+            continue
+        if cropped.shape[:2] != (imgsz, imgsz):
+            cropped = cv2.resize(cropped, (imgsz, imgsz), interpolation=cv2.INTER_AREA)
+        img = torch.from_numpy(letterbox_tensor(cropped, imgsz)).float() / 255.0
+        plates.append((path, img.unsqueeze(0)))
+    if not plates:
+        raise IOError('no cropped plates found in {}'.format(folder))
+    return plates
+
+
+def quantize_model(model, calibration_plates, engine=quantized_engine):
+    ''' int8 copy of a prepared fp32 model, calibrated on the given (path, tensor) plates '''
+    torch.backends.quantized.engine = engine
+    qmodel = copy.deepcopy(model).eval()
+    wrapped = wrap_convs(qmodel, torch.quantization.get_default_qconfig(engine))
+    torch.quantization.prepare(qmodel, inplace=True)
+
+    start = time.time()
+    with torch.no_grad():
+        for _, img in calibration_plates:
+            qmodel(img)
+    print('calibrated {} convolutions on {} plates in {:.1f}s'.format(wrapped, len(calibration_plates),
+                                                                       time.time() - start))
+    torch.quantization.convert(qmodel, inplace=True)
+    return qmodel
+
+
+def count_colonies(pred):
+    ''' (E. coli, coliform) counts of one image after NMS, with the analysis_image thresholds '''
+    det = non_max_suppression(pred, conf_thresh, iou_thresh, classes=None, agnostic=True)[0]
+    if det is None:
+        return 0, 0
+    return int((det[:, -1] == 0).sum()), int((det[:, -1] == 1).sum())
+
+
+def accuracy_report(fp32_model, int8_model, plates):
+    ''' count drift and latency of the int8 model against fp32 on the reference plates
+
+    :return: one record per plate
+    '''
+    records = []
+    print('{:40s} {:>14s} {:>14s} {:>9s} {:>9s}'.format('plate', 'fp32 eco/col', 'int8 eco/col', 'fp32 s', 'int8 s'))
+    with torch.no_grad():
+        for path, img in plates:
+            record = {'plate': path}
+            for name, model in (('fp32', fp32_model), ('int8', int8_model)):
+                start = time.time()
+                pred = model(img)[0]
+                record[name + '_time'] = time.time() - start
+                record[name + '_e.coli'], record[name + '_coliform'] = count_colonies(pred)
+            records.append(record)
+            print('{:40s} {:>14s} {:>14s} {:9.3f} {:9.3f}'.format(
+                os.path.basename(path)[-40:],
+                '{}/{}'.format(record['fp32_e.coli'], record['fp32_coliform']),
+                '{}/{}'.format(record['int8_e.coli'], record['int8_coliform']),
+                record['fp32_time'], record['int8_time']))
+
+    fp32_time = np.mean([r['fp32_time'] for r in records])
+    int8_time = np.mean([r['int8_time'] for r in records])
+    for colony in ('e.coli', 'coliform'):
+        drift = [r['int8_' + colony] - r['fp32_' + colony] for r in records]
+        total = sum(r['fp32_' + colony] for r in records)
+        print('{} count drift: mean {:+.2f}, mean absolute {:.2f}, max {:d} ({:.1%} of the fp32 count)'.format(
+            colony, np.mean(drift), np.mean(np.abs(drift)), int(np.max(np.abs(drift))),
+            np.sum(np.abs(drift)) / total if total else 0.))
+    print('latency: fp32 {:.3f}s, int8 {:.3f}s per plate ({:.2f}x)'.format(fp32_time, int8_time, fp32_time / int8_time))
+    return records
+
+
+def build_int8_model(cfg, weights, calibration_folder, reference_folder=None, output=None, imgsz=640,
+                     max_images=None):
+    ''' quantise the trained weights, report the count drift and save the int8 TorchScript model '''
+    if output is None:
+        output = default_export_path('int8', imgsz)
+    model = load_model(cfg, weights, imgsz, check=True)
+    calibration_plates = load_plates(calibration_folder, imgsz, max_images)
+    qmodel = quantize_model(model, calibration_plates)
+
+    reference_plates = load_plates(reference_folder, imgsz) if reference_folder else calibration_plates
+    if not reference_folder:
+        print('no reference folder, reporting on the calibration plates')
+    records = accuracy_report(model, qmodel, reference_plates)
+
+    export_model(qmodel, output, imgsz)
+    return output, records
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='build the int8 (qnnpack) YOLOR model and report its count drift')
+    parser.add_argument('calibration', help='folder of cropped plates used to calibrate the activation ranges')
+    parser.add_argument('--reference', help='folder of cropped plates for the fp32/int8 comparison')
+    parser.add_argument('--cfg', default='yolor_pi/inference_script/yolor_p6small_filter')
+    parser.add_argument('--weights', default='yolor_pi/inference_script/best_p6_small_filter.pt')
+    parser.add_argument('--output', help='int8 TorchScript file, count_colony_yolor loads yolor_640_int8.torchscript.pt')
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--max-images', type=int, help='use at most this many calibration plates')
+    args = parser.parse_args()
+
+    build_int8_model(args.cfg, args.weights, args.calibration, args.reference, args.output, args.imgsz,
+                     args.max_images)